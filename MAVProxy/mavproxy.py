@@ -13,12 +13,10 @@ import glob
 import json
 import os
 import platform
-import select
 import serial
 import shlex
 import signal
 import socket
-import struct
 import sys
 import threading
 import time
@@ -40,15 +38,24 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_eventloop
+from MAVProxy.modules.lib import mp_linkworker
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import mp_registry
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
+# used for the --profile-startup report
+startup_time = time.time()
+
 # adding all this allows pyinstaller to build a working windows executable
-# note that using --hidden-import does not work for these modules
+# note that using --hidden-import does not work for these modules. The
+# imports are only run in a frozen build, as matplotlib is slow to import
 try:
     multiproc.freeze_support()
-    from pymavlink import mavwp  # noqa
-    import matplotlib  # noqa
-    import HTMLParser  # noqa
+    if getattr(sys, 'frozen', False):
+        from pymavlink import mavwp  # noqa
+        import matplotlib  # noqa
+        import HTMLParser  # noqa
 except Exception:
     pass
 
@@ -73,6 +80,7 @@ if __name__ == '__main__':
 # The MAVLink version being used (None, "1.0", "2.0")
 mavversion = None
 mpstate = None
+main_tick_timer = None
 
 
 class MPStatus(object):
@@ -160,6 +168,8 @@ class MPStatus(object):
                 f.write('%s:%s ' % (c, self.counters[c]))
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
+            if mpstate.logwriter is not None:
+                f.write('Log: %s\n' % mpstate.logwriter.status())
             f.write(str(self.gps)+'\n')
         for m in sorted(self.msgs.keys()):
             if pattern is not None:
@@ -242,6 +252,7 @@ class MPState(object):
         self.aircraft_dir = None
         self.logqueue_raw = None
         self.logqueue = None
+        self.logwriter = None
         self.rl = None
         self.input_queue = None
         self.input_count = None
@@ -261,6 +272,8 @@ class MPState(object):
             MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0, 10000000), increment=1),
             MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
             MPSetting('select_timeout', float, 0.01, 'select timeout'),
+            MPSetting('link_workers', bool, False, 'decode master links in worker processes'),
+            MPSetting('router', bool, False, 'forward raw frames, only decoding needed message types'),
 
             MPSetting('altreadout', int, 10, 'Altitude Readout',
                       range=(0, 100), increment=1, tab='Announcements'),
@@ -270,6 +283,8 @@ class MPState(object):
             MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
             MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0, 3), tab='Debug'),
             MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+            MPSetting('log_flush_interval', float, 0.5, 'Log write interval (s)', range=(0.01, 10), increment=0.1),
+            MPSetting('log_fsync_interval', float, 0, 'Log fsync interval (s), 0 to disable', range=(0, 600), increment=1),
             MPSetting('requireexit', bool, False, 'Require exit command'),
             MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
             MPSetting('wpterrainadjust', bool, True, 'Adjust alt of moved wp using terrain'),
@@ -340,9 +355,18 @@ class MPState(object):
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system, self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
+        # bumped whenever the module list or module subscriptions change
+        self.modules_generation = 0
         self.public_modules = {}
+        # modules which are loaded on demand
+        self.registry = mp_registry.ModuleRegistry(self)
         self.functions = MAVFunctions()
+        self.event_loop = mp_eventloop.MPEventLoop()
+        # deprecated, use register_fd(). fd -> (fn, args) for modules
+        # which haven't moved to it, registered by the main loop
         self.select_extra = {}
+        # LinkWorker objects for master links, keyed by link
+        self.link_workers = {}
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -369,10 +393,13 @@ class MPState(object):
         '''Find a public module (most modules are private)'''
         if name in self.public_modules:
             return self.public_modules[name]
+        if self.registry.is_deferred(name):
+            return self.registry.public_module(name)
         return None
 
-    def load_module(self, modname, quiet=False, **kwargs):
-        '''load a module'''
+    def load_module(self, modname, quiet=False, load_reason=None, **kwargs):
+        '''load a module. load_reason is given when a deferred module
+        is loaded on demand'''
         modpaths = ['MAVProxy.modules.mavproxy_%s' % modname, modname]
         for (m, pm) in mpstate.modules:
             if m.name == modname and modname not in mpstate.multi_instance:
@@ -380,14 +407,23 @@ class MPState(object):
                     print("module %s already loaded" % modname)
                 # don't report an error
                 return True
+        self.registry.undefer(modname)
         ex = None
         for modpath in modpaths:
             try:
+                t0 = time.time()
+                # only reload modules imported before, so a module is
+                # not run twice on its first load
+                imported = modpath in sys.modules
                 m = import_package(modpath)
-                reload(m)
+                if imported:
+                    reload(m)
+                t1 = time.time()
                 module = m.init(mpstate, **kwargs)
                 if isinstance(module, mp_module.MPModule):
                     mpstate.modules.append((module, m))
+                    mpstate.modules_changed()
+                    self.registry.add_timing(modname, t1 - t0, time.time() - t1, load_reason)
                     if not quiet:
                         if kwargs:
                             print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -409,6 +445,9 @@ class MPState(object):
 
     def unload_module(self, modname):
         '''unload a module'''
+        if self.registry.undefer(modname):
+            print("Unloaded deferred module %s" % modname)
+            return True
         for (m, pm) in mpstate.modules:
             if m.name == modname:
                 if hasattr(m, 'unload'):
@@ -418,8 +457,10 @@ class MPState(object):
                     if t.is_alive():
                         print("unload on module %s did not complete" % m.name)
                         mpstate.modules.remove((m, pm))
+                        mpstate.modules_changed()
                         return False
                 mpstate.modules.remove((m, pm))
+                mpstate.modules_changed()
                 if modname in mpstate.public_modules:
                     del mpstate.public_modules[modname]
                 print("Unloaded module %s" % modname)
@@ -458,6 +499,23 @@ class MPState(object):
                 return m
         return self.mav_master[self.settings.link-1]
 
+    def register_fd(self, fd, fn, args=None):
+        '''register a file descriptor with the main loop. fn(args) is
+        called when fd is readable. The fd is removed on an exception'''
+        self.event_loop.register(fd, fn, args)
+
+    def unregister_fd(self, fd):
+        '''remove a file descriptor from the main loop'''
+        self.event_loop.unregister(fd)
+
+    def modules_changed(self):
+        '''notify the mavlink dispatch table that modules have changed'''
+        self.modules_generation += 1
+
+    def links_changed(self):
+        '''notify the main loop that the master or output links have changed'''
+        self.event_loop.links_dirty = True
+
     def foreach_mav(self, sysid, compid, closure):
         # Send mavlink message only on all links that contain vehicle (sysid, compid)
         # More efficient than just blasting all links, when sending targetted messages
@@ -534,11 +592,13 @@ def cmd_status(args):
 def cmd_setup(args):
     mpstate.status.setup_mode = True
     mpstate.rl.set_prompt("")
+    mpstate.links_changed()
 
 
 def cmd_reset(args):
     print("Resetting master")
     mpstate.master().reset()
+    mpstate.links_changed()
 
 
 def cmd_click(args):
@@ -615,6 +675,8 @@ def cmd_module(args):
         mods = sorted(mods, key=lambda m : m.name)
         for m in mods:
             print("%s: %s" % (m.name, m.description))
+        for name in sorted(mpstate.registry.deferred.keys()):
+            print("%s: (deferred until first used)" % name)
     elif args[0] == "load":
         if len(args) < 2:
             print("usage: module load <name>")
@@ -849,7 +911,7 @@ def process_master(m):
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -864,7 +926,16 @@ def process_master(m):
 
     if m.first_byte and mavversion is None:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+    if mpstate.settings.router and m.mav.signing.secret_key is None:
+        # signed links are fully decoded so signatures are checked
+        msgs = mpstate.module('link').route_buffer(m, s)
+    else:
+        msgs = m.mav.parse_buffer(s)
+    process_master_msgs(m, msgs)
+
+
+def process_master_msgs(m, msgs):
+    '''process decoded packets from the MAVLink master'''
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -880,6 +951,43 @@ def process_master(m):
                 mpstate.status.mav_error += 1
 
 
+def process_master_worker(m):
+    '''process batches of packets read and decoded by a link worker'''
+    worker = mpstate.link_workers[m]
+    for (s, msgs, errors, state) in worker.receive():
+        if m.first_byte and mavversion is None:
+            m.auto_mavlink_version(s)
+        worker.apply_state(state)
+        if len(s) == 0:
+            continue
+
+        mpstate.status.bytecounters['MasterIn'][m.linknum].update(len(s))
+
+        if (mpstate.settings.compdebug & 1) != 0:
+            continue
+
+        if mpstate.logqueue_raw:
+            mpstate.logqueue_raw.put(s)
+
+        if m.mav.signing.secret_key is not None:
+            # signing was enabled after the worker was started, so the
+            # child has not checked signatures. Decode here until the
+            # worker is stopped
+            msgs = m.mav.parse_buffer(s)
+            errors = []
+
+        for e in errors:
+            if opts.show_errors:
+                mpstate.console.writeln("MAV error: %s" % e)
+            mpstate.status.mav_error += 1
+
+        # the callbacks the parser would have made in the main process
+        if m.mav.callback is not None:
+            for msg in msgs:
+                m.mav.callback(msg, *m.mav.callback_args, **m.mav.callback_kwargs)
+        process_master_msgs(m, msgs)
+
+
 def process_mavlink(slave):
     '''process packets from MAVLink slaves, forwarding to the master'''
     try:
@@ -917,7 +1025,7 @@ def process_mavlink(slave):
             output.write(m.get_msgbuf())
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -939,18 +1047,13 @@ def mkdir_p(dir):
     os.mkdir(dir)
 
 
-def log_writer():
-    '''log writing thread'''
-    while not mpstate.status.exit:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
+def update_log_settings():
+    '''pass log settings to the log writer'''
+    if mpstate.logwriter is None:
+        return
+    mpstate.logwriter.set_immediate(mpstate.settings.flushlogs)
+    mpstate.logwriter.flush_interval = mpstate.settings.log_flush_interval
+    mpstate.logwriter.fsync_interval = mpstate.settings.log_fsync_interval
 
 
 # If state_basedir is NOT set then paths for logs and aircraft
@@ -1003,8 +1106,9 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        # unbuffered, the log writer batches writes itself
+        mpstate.logfile = open(logpath_telem, mode=mode, buffering=0)
+        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode, buffering=0)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
@@ -1020,9 +1124,9 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         # use a separate thread for writing to the logfile to prevent
         # delays during disk writes (important as delays can be long if camera
         # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
+        mpstate.logwriter.files = [mpstate.logfile, mpstate.logfile_raw]
+        update_log_settings()
+        mpstate.logwriter.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -1090,12 +1194,13 @@ def periodic_tasks():
 
     if heartbeat_check_period.trigger():
         check_link_status()
+        update_log_settings()
 
     set_stream_rates()
 
     mpstate.status.update_bytecounters()
 
-    # call optional module idle tasks. These are called at several hundred Hz
+    # call optional module idle tasks. These are called every select_timeout seconds
     for (m, pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
             try:
@@ -1111,11 +1216,132 @@ def periodic_tasks():
             mpstate.unload_module(m.name)
 
 
-def main_loop():
-    '''main processing loop'''
+def update_link_workers():
+    '''start or stop link worker processes to match the link_workers setting'''
+    use_workers = mpstate.settings.link_workers and not mpstate.status.setup_mode
+    for master in list(mpstate.link_workers.keys()):
+        worker = mpstate.link_workers[master]
+        if (not use_workers or
+                master not in mpstate.mav_master or
+                master.mav.signing.secret_key is not None or
+                (master.fd != worker.link_fd and not master.portdead)):
+            # stopped, removed, signing enabled or reopened with a new fd
+            worker.close()
+            mpstate.link_workers.pop(master)
+    if not use_workers:
+        return
+    for master in mpstate.mav_master:
+        if master in mpstate.link_workers or master.portdead:
+            continue
+        if not mp_linkworker.worker_supported(master):
+            continue
+        worker = mp_linkworker.LinkWorker(master, auto_version=(mavversion is None))
+        worker.start()
+        mpstate.link_workers[master] = worker
+
 
+def register_links():
+    '''register the fds of all master and output links with the event loop'''
+    update_link_workers()
+    wanted = {}
+    for master in mpstate.mav_master:
+        if master.portdead:
+            continue
+        if master in mpstate.link_workers:
+            wanted[mpstate.link_workers[master].fileno()] = (process_master_worker, master)
+        elif master.fd is not None:
+            wanted[master.fd] = (process_master, master)
+    for m in mpstate.mav_outputs:
+        wanted[m.fd] = (process_mavlink, m)
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        wanted[m.fd] = (process_mavlink, m)
+    mpstate.event_loop.set_links(wanted)
+
+
+# fds registered from mpstate.select_extra, fd -> (fn, args)
+select_extra_registered = {}
+
+
+def select_extra_read(fd):
+    '''call the read function of a select_extra fd, removing it from
+    select_extra on an exception as the old main loop did'''
+    (fn, args) = mpstate.select_extra[fd]
+    try:
+        fn(args)
+    except Exception:
+        mpstate.select_extra.pop(fd, None)
+        raise
+
+
+def register_select_extra():
+    '''register fds added to the deprecated select_extra dict with the
+    event loop, and unregister those removed from it'''
+    extra = mpstate.select_extra
+    if not extra and not select_extra_registered:
+        return
+    for fd in list(select_extra_registered.keys()):
+        if extra.get(fd, None) is not select_extra_registered[fd]:
+            mpstate.event_loop.unregister(fd)
+            select_extra_registered.pop(fd)
+    for (fd, entry) in extra.items():
+        if fd not in select_extra_registered:
+            mpstate.event_loop.register(fd, select_extra_read, fd)
+            select_extra_registered[fd] = entry
+
+
+def main_tick():
+    '''timer driven processing of input and idle tasks'''
     global screensaver_cookie
 
+    # enable or disable screensaver:
+    if (mpstate.settings.inhibit_screensaver_when_armed and
+            screensaver_interface is not None):
+        if mpstate.status.armed and screensaver_cookie is None:
+            # now we can inhibit the screensaver
+            screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
+                                                               "Vehicle is armed")
+        elif not mpstate.status.armed and screensaver_cookie is not None:
+            # we can also restore it
+            screensaver_interface.UnInhibit(screensaver_cookie)
+            screensaver_cookie = None
+
+    while not mpstate.input_queue.empty():
+        line = mpstate.input_queue.get()
+        mpstate.input_count += 1
+        cmds = line.split(';')
+        if len(cmds) == 1 and cmds[0] == "":
+            mpstate.empty_input_count += 1
+        for c in cmds:
+            process_stdin(c)
+
+    # serial ports without a usable fd (eg. on Windows) are polled
+    for master in mpstate.mav_master:
+        if master.fd is None:
+            try:
+                if master.port.inWaiting() > 0:
+                    process_master(master)
+            except serial.SerialException:
+                pass
+
+    periodic_tasks()
+
+    # pick up changes to the tick rate
+    main_tick_timer.period = mpstate.settings.select_timeout
+
+
+def event_loop_error(ex):
+    '''report an exception from a module registered fd'''
+    if mpstate.settings.moddebug == 1:
+        print(ex)
+    elif mpstate.settings.moddebug > 1:
+        print(get_exception_stacktrace(ex))
+
+
+def main_loop():
+    '''main processing loop'''
+    global main_tick_timer
+
     if not mpstate.status.setup_mode and not opts.nowait:
         for master in mpstate.mav_master:
             if master.linknum != 0:
@@ -1125,100 +1351,20 @@ def main_loop():
             master.wait_heartbeat(timeout=0.1)
         set_stream_rates()
 
+    event_loop = mpstate.event_loop
+    main_tick_timer = event_loop.add_timer(mpstate.settings.select_timeout, main_tick)
+    # catch link fd changes made without calling links_changed()
+    event_loop.add_timer(1.0, mpstate.links_changed)
+
     while True:
         if mpstate is None or mpstate.status.exit:
             return
 
-        # enable or disable screensaver:
-        if (mpstate.settings.inhibit_screensaver_when_armed and
-                screensaver_interface is not None):
-            if mpstate.status.armed and screensaver_cookie is None:
-                # now we can inhibit the screensaver
-                screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
-                                                                   "Vehicle is armed")
-            elif not mpstate.status.armed and screensaver_cookie is not None:
-                # we can also restore it
-                screensaver_interface.UnInhibit(screensaver_cookie)
-                screensaver_cookie = None
-
-        while not mpstate.input_queue.empty():
-            line = mpstate.input_queue.get()
-            mpstate.input_count += 1
-            cmds = line.split(';')
-            if len(cmds) == 1 and cmds[0] == "":
-                mpstate.empty_input_count += 1
-            for c in cmds:
-                process_stdin(c)
+        if event_loop.links_dirty:
+            register_links()
+        register_select_extra()
 
-        for master in mpstate.mav_master:
-            if master.fd is None:
-                try:
-                    if master.port.inWaiting() > 0:
-                        process_master(master)
-                except serial.SerialException:
-                    pass
-
-        periodic_tasks()
-
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
-            time.sleep(0.0001)
-            continue
-
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
-
-        if mpstate is None:
-            return
-
-        for fd in rin:
-            if mpstate is None:
-                return
-            for master in mpstate.mav_master:
-                if fd == master.fd:
-                    process_master(master)
-                    if mpstate is None:
-                        return
-                    continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                        return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                        return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+        event_loop.poll(mpstate.settings.select_timeout, on_error=event_loop_error)
 
 
 def input_loop():
@@ -1337,6 +1483,8 @@ if __name__ == '__main__':
                       default='mav.tlog')
     parser.add_option("-a", "--append-log", dest="append_log", help="Append to log files",
                       action='store_true', default=False)
+    parser.add_option("--log-buffer-size", dest="log_buffer_size", type='float', default=4,
+                      help="telemetry log buffer size in MByte for each of the tlog and raw streams")
     parser.add_option("--quadcopter", dest="quadcopter", help="use quadcopter controls",
                       action='store_true', default=False)
     parser.add_option("--setup", dest="setup", help="start in setup mode",
@@ -1373,7 +1521,15 @@ if __name__ == '__main__':
     parser.add_option("--daemon", action='store_true', help="run in daemon mode, do not start interactive shell")
     parser.add_option("--non-interactive", action='store_true', help="do not start interactive shell")
     parser.add_option("--profile", action='store_true', help="run the Yappi python profiler")
+    parser.add_option("--profile-startup", action='store_true', default=False,
+                      help="report the time taken to load each module at startup")
+    parser.add_option("--no-defer-modules", action='store_true', default=False,
+                      help="load all default modules at startup, rather than some on first use")
     parser.add_option("--state-basedir", default=None, help="base directory for logs and aircraft directories")
+    parser.add_option("--link-workers", action='store_true', default=False,
+                      help="read and decode master links in worker processes")
+    parser.add_option("--router", action='store_true', default=False,
+                      help="router mode, forward raw frames and only decode message types modules need")
     parser.add_option("--no-state", action='store_true', default=False, help="Don't save logs and other state to disk. Useful for read-only filesystems or long-running systems.")  # noqa:E501
     parser.add_option("--version", action='store_true', help="version information")
     parser.add_option("--default-modules", default="log,signing,wp,rally,fence,ftp,param,relay,tuneopt,arm,mode,calibration,rc,auxopt,misc,cmdlong,battery,terrain,output,adsb,layout", help='default module list')  # noqa:E501
@@ -1414,12 +1570,16 @@ if __name__ == '__main__':
     mpstate = MPState()
     mpstate.status.exit = False
     mpstate.command_map = command_map
+    mpstate.registry.start_time = startup_time
+    mpstate.registry.profile = opts.profile_startup
     mpstate.continue_mode = opts.continue_mode
     # queues for logging
 
     if not opts.no_state:
-        mpstate.logqueue = multiproc.Queue()
-        mpstate.logqueue_raw = multiproc.Queue()
+        # log data is buffered in memory until the log files are opened
+        mpstate.logwriter = mp_logwriter.LogWriter(None, None, int(opts.log_buffer_size * 1024 * 1024))
+        mpstate.logqueue = mpstate.logwriter.logqueue
+        mpstate.logqueue_raw = mpstate.logwriter.logqueue_raw
     else:
         mpstate.logqueue = None
         mpstate.logqueue_raw = None
@@ -1524,6 +1684,8 @@ if __name__ == '__main__':
     mpstate.settings.streamrate2 = opts.streamrate
 
     mpstate.settings.heartbeat = opts.heartbeat
+    mpstate.settings.link_workers = opts.link_workers
+    mpstate.settings.router = opts.router
 
     if opts.state_basedir is not None:
         mpstate.settings.state_basedir = opts.state_basedir
@@ -1550,8 +1712,11 @@ if __name__ == '__main__':
     if not opts.setup:
         # some core functionality is in modules
         for m in standard_modules:
-            if m:
-                mpstate.load_module(m, quiet=True)
+            if not m:
+                continue
+            if not opts.no_defer_modules and mpstate.registry.defer(m):
+                continue
+            mpstate.load_module(m, quiet=True)
 
     if platform.system() != 'Windows':
         if opts.console:
@@ -1578,6 +1743,9 @@ if __name__ == '__main__':
             for c in cmds:
                 process_stdin(c)
 
+    if opts.profile_startup:
+        print(mpstate.registry.report())
+
     if opts.profile:
         import yappi    # We do the import here so that we won't barf if run normally and yappi not available
         yappi.start()
@@ -1630,4 +1798,7 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    if mpstate.logwriter is not None and mpstate.logwriter.thread is not None:
+        mpstate.logwriter.stop()
+
     sys.exit(1)
@@ -19,7 +19,11 @@ from pymavlink.mavextra import *
 import matplotlib.pyplot as plt
 from pymavlink import mavutil
 import threading
+import multiprocessing
 import numpy as np
+from MAVProxy.modules.lib import mp_expression
+from MAVProxy.modules.lib import mp_logindex
+from MAVProxy.modules.lib import multiproc
 
 MAVGRAPH_DEBUG = 'MAVGRAPH_DEBUG' in os.environ
 
@@ -67,6 +71,16 @@ def timestamp_to_days(timestamp, timeshift=0):
     sec_to_days = 1.0 / (60*60*24)
     return tday_base + (timestamp - tday_basetime) * sec_to_days
 
+def timestamps_to_days(timestamps, timeshift=0):
+    '''convert a numpy array of log timestamps to days'''
+    if len(timestamps) == 0:
+        return timestamps
+    timestamp_to_days(timestamps[0], timeshift)
+    if tday_base is None:
+        return np.array([timestamp_to_days(t, timeshift) for t in timestamps])
+    sec_to_days = 1.0 / (60*60*24)
+    return tday_base + (timestamps - tday_basetime) * sec_to_days
+
 class MilliFormatter(matplotlib.dates.AutoDateFormatter):
     '''tick formatter that shows millisecond resolution'''
     def __init__(self, locator):
@@ -125,12 +139,20 @@ class MavGraph(object):
         else:
             self.text_types = frozenset([unicode, str])
         self.max_message_rate = 0
+        # fields which need evaluating one message at a time
+        self.scalar_fields = None
+        # number of processes used to process multiple logs
+        self.workers = 1
 
     def set_max_message_rate(self, rate_hz):
         '''set maximum rate we will graph any message'''
         self.max_message_rate = rate_hz
         self.last_message_t = {}
 
+    def set_workers(self, workers):
+        '''set number of worker processes used to process multiple logs'''
+        self.workers = workers
+
     def add_field(self, field):
         '''add another field to plot'''
         self.fields.append(field)
@@ -438,6 +460,8 @@ class MavGraph(object):
         for i in range(0, len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
+            if self.scalar_fields is not None and i not in self.scalar_fields:
+                continue
             f = self.fields[i]
             has_instance = False
             ins_value = None
@@ -479,7 +503,7 @@ class MavGraph(object):
                         print(ex)
             if v is None:
                 try:
-                    v = mavutil.evaluate_expression(f, vars)
+                    v = mp_expression.evaluate_expression(f, vars)
                 except Exception as ex:
                     if MAVGRAPH_DEBUG:
                         print(ex)
@@ -488,21 +512,138 @@ class MavGraph(object):
             if self.xaxis is None:
                 xv = t
             else:
-                xv = mavutil.evaluate_expression(self.xaxis, vars)
+                xv = mp_expression.evaluate_expression(self.xaxis, vars)
                 if xv is None:
                     continue
             self.y[i].append(v)
             self.x[i].append(xv)
 
-    def process_mav(self, mlog, flightmode_selections):
-        '''process one file'''
-        self.vars = {}
-        idx = 0
-        all_false = True
-        for s in flightmode_selections:
-            if s:
-                all_false = False
-
+    def flightmode_columns(self, types, flightmode_selections):
+        '''work out which messages are kept by the flightmode selections,
+        returning (positions, keep) arrays over all messages graphed.
+        This follows the per-message path, which moves to the next
+        flightmode on the first message at or after the end of the
+        current one, and drops that message'''
+        pos = []
+        timestamps = []
+        for cols in types.values():
+            pos.append(cols.pos)
+            timestamps.append(cols.timestamp)
+        pos = np.concatenate(pos)
+        timestamps = np.concatenate(timestamps)
+        order = np.argsort(pos, kind='stable')
+        pos = pos[order]
+        timestamps = timestamps[order]
+
+        # the flightmode only moves on for messages passing the condition
+        join = mp_logindex.ColumnJoin(pos)
+        if self.condition is not None:
+            c = mp_logindex.evaluate_columns(self.condition, join, types)
+            join.valid &= c.astype(bool)
+        active = np.flatnonzero(join.valid)
+
+        mode = np.full(len(pos), -1)
+        start = 0
+        for (idx, fm) in enumerate(self.flightmode_list):
+            after = np.flatnonzero(timestamps[active[start:]] >= fm[2])
+            if len(after) == 0:
+                break
+            end = start + after[0]
+            mode[active[start:end]] = idx
+            start = end + 1
+        else:
+            idx = len(self.flightmode_list)
+        mode[active[start:]] = idx
+
+        selected = np.zeros(max(len(self.flightmode_list), len(flightmode_selections))+1, dtype=bool)
+        selected[:len(flightmode_selections)] = flightmode_selections
+        keep = (mode >= 0) & selected[mode]
+        return (pos, keep)
+
+    def field_columns(self, i, types, flightmode_selections, all_false):
+        '''evaluate one field over the column index, returning (x, y)
+        lists. Raises VectorError if it needs the per-message path'''
+        expression = mp_expression.compile_expression(self.fields[i])
+
+        # the messages which trigger a point, in log order
+        pos = []
+        timestamps = []
+        for t in self.field_types[i]:
+            cols = types.get(t, None)
+            if cols is None or len(cols) == 0:
+                continue
+            if t in self.instance_types[i] and cols.instance_field is not None:
+                ins = cols.fields.get(cols.instance_field, None)
+                if ins is None:
+                    raise mp_logindex.VectorError("no instance column")
+                cols = cols.select(np.isin(ins.astype(str), list(self.instance_types[i][t])))
+            pos.append(cols.pos)
+            timestamps.append(cols.timestamp)
+        if len(pos) == 0:
+            return ([], [])
+        pos = np.concatenate(pos)
+        timestamps = np.concatenate(timestamps)
+        order = np.argsort(pos, kind='stable')
+        pos = pos[order]
+        timestamps = timestamps[order]
+
+        join = mp_logindex.ColumnJoin(pos)
+        if self.condition is not None:
+            c = mp_logindex.evaluate_columns(self.condition, join, types)
+            join.valid &= c.astype(bool)
+        y = expression.evaluate_columns(join, types)
+        if self.xaxis is None:
+            x = timestamps_to_days(timestamps, self.timeshift)
+        else:
+            x = mp_logindex.evaluate_columns(self.xaxis, join, types)
+
+        keep = join.valid
+        if self.flightmode_keep is not None:
+            (all_pos, all_keep) = self.flightmode_keep
+            keep &= all_keep[np.searchsorted(all_pos, pos)]
+        return (x[keep].tolist(), y[keep].tolist())
+
+    def process_mav_columns(self, mlog, flightmode_selections, all_false):
+        '''evaluate fields over a columnar index of the log where
+        possible, returning the set of fields which still need the
+        per-message path'''
+        scalar_fields = set(range(self.num_fields))
+        if self.max_message_rate > 0:
+            return scalar_fields
+        for expression in [self.condition, self.xaxis]:
+            if expression is not None and not mp_logindex.vectorisable(expression, self.msg_types):
+                return scalar_fields
+        candidates = []
+        for i in range(self.num_fields):
+            if mp_expression.compile_expression(self.fields[i]).vectorisable(self.msg_types):
+                candidates.append(i)
+        if len(candidates) == 0:
+            return scalar_fields
+        index = mp_logindex.get_index(mlog)
+        if index is None:
+            return scalar_fields
+        types = index.columns(mlog, sorted(self.msg_types))
+        self.flightmode_keep = None
+        if not all_false and len(flightmode_selections) > 0:
+            try:
+                self.flightmode_keep = self.flightmode_columns(types, flightmode_selections)
+            except mp_logindex.VectorError:
+                return scalar_fields
+        for i in candidates:
+            try:
+                (x, y) = self.field_columns(i, types, flightmode_selections, all_false)
+            except mp_logindex.VectorError as ex:
+                if MAVGRAPH_DEBUG:
+                    print("%s: %s" % (self.fields[i], ex))
+                continue
+            self.x[i].extend(x)
+            self.y[i].extend(y)
+            scalar_fields.discard(i)
+        return scalar_fields
+
+    def prepare_fields(self):
+        '''strip labels and axis options from the fields. Called once
+        per graph, before any log is processed'''
         self.num_fields = len(self.fields)
 
         self.custom_labels = [None] * self.num_fields
@@ -534,6 +675,15 @@ class MavGraph(object):
             else:
                 self.simple_field.append((m.group(1),m.group(2)))
 
+    def process_mav(self, mlog, flightmode_selections):
+        '''process one file'''
+        self.vars = {}
+        idx = 0
+        all_false = True
+        for s in flightmode_selections:
+            if s:
+                all_false = False
+
         if len(self.flightmode_list) > 0:
             # prime the timestamp conversion
             timestamp_to_days(self.flightmode_list[0][1], self.timeshift)
@@ -543,6 +693,10 @@ class MavGraph(object):
         except Exception:
             pass
 
+        self.scalar_fields = self.process_mav_columns(mlog, flightmode_selections, all_false)
+        if len(self.scalar_fields) == 0:
+            return
+
         all_messages = {}
 
         while True:
@@ -555,7 +709,7 @@ class MavGraph(object):
             if mtype not in self.msg_types:
                 continue
             if self.condition:
-                if not mavutil.evaluate_condition(self.condition, all_messages):
+                if not mp_expression.evaluate_condition(self.condition, all_messages):
                     continue
             tdays = timestamp_to_days(msg._timestamp, self.timeshift)
 
@@ -622,13 +776,92 @@ class MavGraph(object):
             self.x.append([])
             self.axes.append(1)
             self.first_only.append(False)
+        self.prepare_fields()
 
         timeshift = self.timeshift
 
+        if self.parallel_supported():
+            self.process_parallel(flightmode_selections)
+            return
+
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
             self.process_mav(mlog, flightmode_selections)
 
+    def parallel_supported(self):
+        '''return True if the logs can be processed in worker processes.
+        The workers are forked so they inherit the open logs. The
+        message rate limit carries over from one log to the next, so
+        that needs the logs processed in order'''
+        if self.workers <= 1 or len(self.mav_list) <= 1:
+            return False
+        if os.name == 'nt' or multiprocessing.get_start_method() != 'fork':
+            return False
+        return self.max_message_rate <= 0
+
+    def process_mav_worker(self, mlog, flightmode_selections, pipe):
+        '''process one log in a worker, sending back the x/y series'''
+        try:
+            self.process_mav(mlog, flightmode_selections)
+            pipe.send((self.x, self.y))
+        except Exception as ex:
+            print("graph worker failed: %s" % ex)
+        pipe.close()
+
+    def process_parallel(self, flightmode_selections):
+        '''process each log in a worker process, merging the series in
+        log order so the result is the same as processing in turn'''
+        # the workers must share the time base the first log would set
+        if tday_base is None:
+            if len(self.flightmode_list) > 0:
+                timestamp_to_days(self.flightmode_list[0][1], self.timeshift)
+            else:
+                mlog = self.mav_list[0]
+                msg = mlog.recv_match(type=self.msg_types)
+                mlog.rewind()
+                if msg is not None:
+                    timestamp_to_days(msg._timestamp, self.timeshift)
+
+        nlogs = len(self.mav_list)
+        results = [None] * nlogs
+        running = {}
+        next_log = 0
+        while next_log < nlogs or running:
+            while next_log < nlogs and len(running) < self.workers:
+                (pipe_recv, pipe_send) = multiproc.Pipe(duplex=False)
+                child = multiproc.Process(target=self.process_mav_worker,
+                                          args=(self.mav_list[next_log], flightmode_selections, pipe_send))
+                child.daemon = True
+                child.start()
+                pipe_send.close()
+                running[next_log] = (child, pipe_recv)
+                next_log += 1
+            for fi in list(running.keys()):
+                (child, pipe_recv) = running[fi]
+                try:
+                    if not pipe_recv.poll(0.05):
+                        continue
+                    results[fi] = pipe_recv.recv()
+                except (EOFError, OSError):
+                    pass
+                pipe_recv.close()
+                child.join()
+                running.pop(fi)
+
+        for fi in range(nlogs):
+            if results[fi] is None:
+                # the worker failed, process this log here instead
+                (x, y) = (self.x, self.y)
+                self.x = [[] for i in range(self.num_fields)]
+                self.y = [[] for i in range(self.num_fields)]
+                self.mav_list[fi].rewind()
+                self.process_mav(self.mav_list[fi], flightmode_selections)
+                results[fi] = (self.x, self.y)
+                (self.x, self.y) = (x, y)
+            for i in range(self.num_fields):
+                self.x[i].extend(results[fi][0][i])
+                self.y[i].extend(results[fi][1][i])
+
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
         '''show graph'''
@@ -712,6 +945,7 @@ if __name__ == "__main__":
     parser.add_argument("--output", default=None, help="provide an output format")
     parser.add_argument("--timeshift", type=float, default=0, help="shift time on first graph in seconds")
     parser.add_argument("--grid", action='store_true', help="show a grid")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes used for multiple logs")
     parser.add_argument("logs_fields", metavar="<LOG or FIELD>", nargs="+")
     args = parser.parse_args()
 
@@ -735,5 +969,6 @@ if __name__ == "__main__":
     mg.set_title(args.title)
     mg.set_grid(args.grid)
     mg.set_show_flightmode(args.show_flightmode)
+    mg.set_workers(args.workers)
     mg.process([],[],0)
     mg.show(len(mg.mav_list), output=args.output)
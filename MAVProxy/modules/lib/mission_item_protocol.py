@@ -51,6 +51,7 @@ class MissionItemProtocolModule(mp_module.MPModule):
         self.upload_start = None
         self.last_get_home = time.time()
         self.ftp_count = None
+        self.subscribe_mavlink(types=self.mavlink_types())
 
         if self.continue_mode and self.logdir is not None:
             waytxt = os.path.join(mpstate.status.logdir, self.save_filename())
@@ -245,6 +246,10 @@ on'''
         except Exception:
             print("Have %u %s" % (self.wploader.count()+len(self.wp_received), self.itemstype()))
 
+    def mavlink_types(self):
+        '''message types handled by mavlink_packet'''
+        return ['MISSION_COUNT', 'MISSION_ITEM', 'MISSION_ITEM_INT', 'MISSION_REQUEST', 'MISSION_REQUEST_INT']
+
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
         mtype = m.get_type()
@@ -33,7 +33,6 @@ class ElevationModel():
         if self.database in ['SRTM1', 'SRTM3']:
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug, directory=self.database, cachedir=cachedir)
             self.downloader.loadFileList()
-            self.tileDict = dict()
         elif self.database == 'geoscience':
             '''Use the Geoscience Australia database instead - watch for the correct database path'''
             from MAVProxy.modules.mavproxy_map import GAreader
@@ -48,28 +47,78 @@ class ElevationModel():
         if latitude is None or longitude is None:
             return None
         if self.database in ['SRTM1', 'SRTM3']:
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            # loaded tiles are kept in the shared srtm.tile_cache
+            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
+            if tile == 0:
+                if timeout > 0:
+                    t0 = time.time()
+                    while time.time() < t0+timeout and tile == 0:
+                        tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
+                        if tile == 0:
+                            time.sleep(0.1)
+            if tile == 0:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         elif self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         else:
             return None
         return alt
 
+    def GetElevationArray(self, lats, lons, timeout=0):
+        '''Returns a numpy array of altitudes (m ASL) for arrays of lat/long
+        pairs. Points in tiles which are not available are NaN'''
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        ret = numpy.full(lats.shape, numpy.nan)
+        if self.database in ['SRTM1', 'SRTM3']:
+            flat_lats = lats.ravel()
+            flat_lons = lons.ravel()
+            flat_ret = ret.reshape(-1)
+            tile_lat = numpy.floor(flat_lats).astype(numpy.int64)
+            tile_lon = numpy.floor(flat_lons).astype(numpy.int64)
+            # group the points by tile so each tile is interpolated in one pass
+            keys = (tile_lat + 90) * 360 + (tile_lon + 180)
+            order = numpy.argsort(keys, kind='stable')
+            (ukeys, starts) = numpy.unique(keys[order], return_index=True)
+            ends = numpy.append(starts[1:], len(order))
+            for (key, start, end) in zip(ukeys, starts, ends):
+                idx = order[start:end]
+                lat = tile_lat[idx[0]]
+                lon = tile_lon[idx[0]]
+                tile = self.downloader.getTile(lat, lon)
+                if tile == 0 and timeout > 0:
+                    t0 = time.time()
+                    while time.time() < t0+timeout and tile == 0:
+                        time.sleep(0.1)
+                        tile = self.downloader.getTile(lat, lon)
+                if tile == 0:
+                    continue
+                flat_ret[idx] = tile.getAltitudeArray(flat_lats[idx], flat_lons[idx])
+        elif self.database == 'geoscience':
+            for i in numpy.ndindex(lats.shape):
+                ret[i] = self.mappy.getAltitudeAtPoint(lats[i], lons[i])
+        return ret
+
+    def benchmark(self, lat, lon, count=100000, spread=0.5):
+        '''compare GetElevation and GetElevationArray on random points
+        around lat/lon, returning (scalar_time, array_time, max_difference)'''
+        if self.GetElevation(lat, lon, timeout=10) is None:
+            return None
+        rng = numpy.random.default_rng(1)
+        lats = lat + rng.uniform(-spread, spread, count)
+        lons = lon + rng.uniform(-spread, spread, count)
+        # make sure all the tiles are loaded before timing
+        self.GetElevationArray(lats, lons, timeout=30)
+        t0 = time.time()
+        scalar = [self.GetElevation(lats[i], lons[i]) for i in range(count)]
+        t1 = time.time()
+        alts = self.GetElevationArray(lats, lons)
+        t2 = time.time()
+        scalar = numpy.array([numpy.nan if a is None else a for a in scalar])
+        diff = numpy.nanmax(numpy.abs(scalar - alts)) if count else 0
+        return (t1-t0, t2-t1, diff)
+
 
 if __name__ == "__main__":
 
@@ -79,11 +128,22 @@ if __name__ == "__main__":
     parser.add_argument("--lon", type=float, default=149.509165, help="start longitude")
     parser.add_argument("--database", type=str, default='SRTM3', help="elevation database", choices=["SRTM1", "SRTM3"])
     parser.add_argument("--debug", action='store_true', help="enabled debugging")
+    parser.add_argument("--benchmark", type=int, default=0, help="compare scalar and array lookups on this many points")
 
     args = parser.parse_args()
 
     EleModel = ElevationModel(args.database, debug=args.debug)
 
+    if args.benchmark > 0:
+        ret = EleModel.benchmark(args.lat, args.lon, count=args.benchmark)
+        if ret is None:
+            print("Tile not available")
+            sys.exit(1)
+        (tscalar, tarray, diff) = ret
+        print("%u points: GetElevation %.3fs GetElevationArray %.3fs (%.1fx) max difference %.6f m" % (
+            args.benchmark, tscalar, tarray, tscalar/max(tarray, 1.0e-6), diff))
+        sys.exit(0)
+
     lat = args.lat
     lon = args.lon
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+'''
+persistent event loop for the MAVProxy main loop
+
+file descriptors are registered once with a callback, and only the
+ready descriptors are dispatched on each wakeup. Periodic work is
+driven by timers rather than being run on every wakeup.
+'''
+
+import heapq
+import selectors
+import time
+
+
+class MPTimer(object):
+    '''a periodic timer registered with the event loop'''
+    def __init__(self, period, fn, args=()):
+        self.period = period
+        self.fn = fn
+        self.args = args
+        self.next_run = time.time()
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.next_run < other.next_run
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class MPEventLoop(object):
+    '''registration based event loop built on selectors'''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        # fds owned by links, these are managed with set_links()
+        self.links = {}
+        self.links_dirty = True
+        self.wakeups = 0
+        self.dispatched = 0
+
+    def register(self, fd, fn, args=None, remove_on_error=True):
+        '''register a file descriptor. fn(args) is called when fd is readable'''
+        self.unregister(fd)
+        self.selector.register(fd, selectors.EVENT_READ, (fn, args, remove_on_error))
+
+    def unregister(self, fd):
+        '''unregister a file descriptor, ignoring unknown fds'''
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def registered(self, fd):
+        '''return True if fd is registered'''
+        try:
+            self.selector.get_key(fd)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def set_links(self, wanted):
+        '''set the link fds, wanted is a dict of fd -> (fn, link)'''
+        for fd in list(self.links.keys()):
+            if wanted.get(fd, None) != self.links[fd][:2]:
+                self.unregister(fd)
+                self.links.pop(fd)
+        for (fd, (fn, link)) in wanted.items():
+            if fd not in self.links:
+                # links are never removed on an exception
+                self.register(fd, fn, link, remove_on_error=False)
+                self.links[fd] = (fn, link, getattr(link, 'fd', None))
+        self.links_dirty = False
+
+    def add_timer(self, period, fn, args=()):
+        '''add a periodic timer, returning the timer object'''
+        t = MPTimer(period, fn, args)
+        heapq.heappush(self.timers, t)
+        return t
+
+    def next_timeout(self, max_timeout):
+        '''return time until the next timer is due'''
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return max_timeout
+        return max(0, min(max_timeout, self.timers[0].next_run - time.time()))
+
+    def run_timers(self):
+        '''run any timers which are due'''
+        tnow = time.time()
+        while self.timers and self.timers[0].next_run <= tnow:
+            t = heapq.heappop(self.timers)
+            if t.cancelled:
+                continue
+            t.fn(*t.args)
+            # don't try to catch up on missed ticks
+            t.next_run = max(t.next_run + t.period, tnow)
+            heapq.heappush(self.timers, t)
+
+    def poll(self, max_timeout, on_error=None):
+        '''wait for ready fds or the next timer, and dispatch them'''
+        timeout = self.next_timeout(max_timeout)
+        if not self.selector.get_map():
+            # select() on no fds is an error on some platforms
+            time.sleep(timeout)
+            events = []
+        else:
+            try:
+                events = self.selector.select(timeout)
+            except (OSError, ValueError):
+                # most likely a closed fd, resync links on next pass
+                self.links_dirty = True
+                events = []
+        self.wakeups += 1
+        for (key, mask) in events:
+            (fn, args, remove_on_error) = key.data
+            self.dispatched += 1
+            try:
+                fn(args)
+            except Exception as ex:
+                if not remove_on_error:
+                    raise
+                if on_error is not None:
+                    on_error(ex)
+                self.unregister(key.fd)
+                continue
+            link = self.links.get(key.fd, None)
+            if link is not None:
+                # links can change fd on reconnect
+                if getattr(args, 'fd', None) != link[2] or getattr(args, 'portdead', False):
+                    self.links_dirty = True
+        self.run_timers()
+
+    def close(self):
+        self.selector.close()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+'''
+compiled mavlink field expressions
+
+mavutil.evaluate_expression parses its expression string on every
+call. An Expression is parsed once: the condition of an
+EXPRESSION{CONDITION} is split off, both parts are compiled to code
+objects, and an expression which is a single TYPE.field becomes a
+dictionary lookup and a getattr. Evaluation otherwise behaves exactly
+as evaluate_expression, with the same maths and mavextra functions.
+
+Expressions made only of fields, arithmetic and simple maths can also
+be evaluated over whole columns of a log index, see mp_logindex.
+'''
+
+import ast
+import time
+
+from pymavlink import mavexpression
+
+# names available to expressions, as for mavutil.evaluate_expression
+EXPRESSION_GLOBALS = mavexpression.__dict__
+
+# maximum number of expressions held by compile_expression
+CACHE_SIZE = 1000
+
+
+class Expression(object):
+    '''a field expression, compiled once'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.body = expression.strip()
+        self.condition_text = None
+        self.code = None
+        self.condition = None
+        self.simple = None
+        self.error = None
+        if expression.endswith('}'):
+            startidx = expression.rfind('{')
+            if startidx == -1:
+                # evaluates to None, as for evaluate_expression
+                return
+            # eval() of a string ignores leading spaces but compile() doesn't
+            self.body = expression[:startidx].strip()
+            self.condition_text = expression[startidx+1:-1].strip()
+            try:
+                self.condition = compile(self.condition_text, '<condition>', 'eval')
+            except SyntaxError:
+                # a bad condition is never true
+                return
+        try:
+            tree = ast.parse(self.body, mode='eval')
+            self.code = compile(tree, '<expression>', 'eval')
+        except SyntaxError as ex:
+            # raised when evaluated, as for evaluate_expression
+            self.error = ex
+            return
+        node = tree.body
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            self.simple = (node.value.id, node.attr)
+
+    def evaluate(self, vars, nocondition=False):
+        '''evaluate against a dict of messages, returning None if the
+        condition is false or a message is not available'''
+        if self.code is None:
+            if self.error is not None:
+                raise self.error
+            return None
+        if self.condition is not None:
+            try:
+                v = eval(self.condition, EXPRESSION_GLOBALS, vars)
+            except Exception:
+                return None
+            if not nocondition and not v:
+                return None
+        if self.simple is not None:
+            m = vars.get(self.simple[0], None)
+            if m is not None:
+                return getattr(m, self.simple[1])
+        try:
+            return eval(self.code, EXPRESSION_GLOBALS, vars)
+        except NameError:
+            return None
+        except ZeroDivisionError:
+            return None
+        except IndexError:
+            return None
+
+    def vectorisable(self, names):
+        '''return True if the expression can be evaluated over columns,
+        names is the set of message types which may be referenced'''
+        from MAVProxy.modules.lib import mp_logindex
+        if self.code is None:
+            return False
+        if self.condition_text is not None and not mp_logindex.vectorisable(self.condition_text, names):
+            return False
+        return mp_logindex.vectorisable(self.body, names)
+
+    def evaluate_columns(self, join, types):
+        '''evaluate over the columns of a log index at the trigger
+        positions of join, returning an array. Rows failing the
+        condition are marked invalid in join'''
+        from MAVProxy.modules.lib import mp_logindex
+        if self.condition is not None:
+            c = mp_logindex.evaluate_columns(self.condition_text, join, types)
+            join.valid &= c.astype(bool)
+        return mp_logindex.evaluate_columns(self.body, join, types)
+
+
+expression_cache = {}
+
+
+def compile_expression(expression):
+    '''return the Expression for a string, compiling it on first use'''
+    ret = expression_cache.get(expression, None)
+    if ret is None:
+        if len(expression_cache) >= CACHE_SIZE:
+            expression_cache.clear()
+        ret = Expression(expression)
+        expression_cache[expression] = ret
+    return ret
+
+
+def evaluate_expression(expression, vars, nocondition=False):
+    '''drop in replacement for mavutil.evaluate_expression'''
+    return compile_expression(expression).evaluate(vars, nocondition)
+
+
+def evaluate_condition(condition, vars):
+    '''drop in replacement for mavutil.evaluate_condition'''
+    if condition is None:
+        return True
+    v = evaluate_expression(condition, vars)
+    if v is None:
+        return False
+    return v
+
+
+def benchmark(count=100000):
+    '''compare mavutil.evaluate_expression with compiled expressions,
+    returning a list of (expression, eval_time, compiled_time, column_time)
+    with times per evaluation in seconds. column_time is None if the
+    expression can't be evaluated over columns'''
+    import numpy as np
+    from pymavlink import mavutil
+    from MAVProxy.modules.lib import mp_logindex
+
+    mav = mavutil.mavlink
+    msgs = {
+        'VFR_HUD': mav.MAVLink_vfr_hud_message(12.5, 13.1, 90, 45, 102.3, 0.5),
+        'ATTITUDE': mav.MAVLink_attitude_message(1000, 0.1, -0.05, 1.2, 0.01, 0.02, 0.03),
+        'GPS_RAW_INT': mav.MAVLink_gps_raw_int_message(1000, 3, -353632610, 1491652300, 584000,
+                                                       120, 150, 1250, 9000, 10),
+    }
+    expressions = ['VFR_HUD.airspeed',
+                   'VFR_HUD.groundspeed-VFR_HUD.airspeed',
+                   'degrees(ATTITUDE.roll)',
+                   'sqrt(ATTITUDE.rollspeed**2+ATTITUDE.pitchspeed**2)',
+                   'GPS_RAW_INT.alt*0.001{GPS_RAW_INT.fix_type>=3}',
+                   'wrap_180(degrees(ATTITUDE.yaw))']
+
+    # column versions of the messages, for the vectorised mode
+    types = {}
+    for (t, m) in msgs.items():
+        fields = {}
+        for f in m.get_fieldnames():
+            fields[f] = np.full(count, float(getattr(m, f)))
+        types[t] = mp_logindex.MessageColumns(np.arange(count) * len(msgs), np.zeros(count), fields)
+
+    ret = []
+    for e in expressions:
+        t0 = time.time()
+        for i in range(count):
+            mavutil.evaluate_expression(e, msgs)
+        t1 = time.time()
+        c = Expression(e)
+        for i in range(count):
+            c.evaluate(msgs)
+        t2 = time.time()
+        tcols = None
+        if c.vectorisable(set(msgs.keys())):
+            join = mp_logindex.ColumnJoin(np.arange(count) * len(msgs) + len(msgs) - 1)
+            c.evaluate_columns(join, types)
+            tcols = (time.time() - t2) / count
+        ret.append((e, (t1 - t0) / count, (t2 - t1) / count, tcols))
+    return ret
+
+
+def check():
+    '''compare compiled expressions with mavutil.evaluate_expression,
+    returning a list of (expression, expected, result) which differ'''
+    from pymavlink import mavutil
+
+    class Msg(object):
+        def __init__(self, x):
+            self.x = x
+
+    msgs = {'A': Msg(2.0), 'B': Msg(0.0)}
+    expressions = ['A.x', ' A.x', 'A.x ', 'A.x{ A.x>1}', ' A.x { A.x>1 } ', 'A.x{B.x>1}',
+                   'A.x/B.x', 'C.x', 'A.x{C.x}', 'A.x}', 'A.x*2{A.x>1}']
+    ret = []
+    for e in expressions:
+        for nocondition in [False, True]:
+            try:
+                expected = mavutil.evaluate_expression(e, msgs, nocondition)
+            except Exception as ex:
+                expected = type(ex)
+            try:
+                result = Expression(e).evaluate(msgs, nocondition)
+            except Exception as ex:
+                result = type(ex)
+            if expected != result:
+                ret.append((e, expected, result))
+    return ret
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("mp_expression.py [options]")
+    parser.add_argument("--benchmark", type=int, default=0, help="time this many evaluations of some typical expressions")
+    parser.add_argument("--check", action='store_true', help="check compiled expressions against mavutil.evaluate_expression")
+    parser.add_argument("expression", nargs='*', help="expressions to show the compiled form of")
+    args = parser.parse_args()
+
+    if args.benchmark > 0:
+        print("%-55s %9s %9s %9s" % ("expression", "eval", "compiled", "columns"))
+        for (e, teval, tcompiled, tcols) in benchmark(args.benchmark):
+            cols = "-" if tcols is None else "%.3fus" % (tcols * 1.0e6)
+            print("%-55s %7.2fus %7.2fus %9s" % (e, teval * 1.0e6, tcompiled * 1.0e6, cols))
+    if args.check:
+        differ = check()
+        for (e, expected, result) in differ:
+            print("%s: expected %s got %s" % (e, expected, result))
+        print("%u expressions differ" % len(differ))
+    for e in args.expression:
+        c = Expression(e)
+        print("%s: body=%s condition=%s simple=%s" % (e, c.body, c.condition_text, c.simple))
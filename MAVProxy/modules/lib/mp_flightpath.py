@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''
+flight path extraction for mavflightview
+
+Positions are gathered into numpy arrays as the log is read, one
+array per field, with the colour of each point held as an index into
+a small table of colours. Paths are then decimated with
+Douglas-Peucker, giving each point an importance: the distance in
+metres by which the path would be wrong if that point were left out.
+Drawing only the points with an importance above the size of a pixel
+gives a path simplified to suit the zoom level.
+
+Extracted paths are cached in the index directory next to the log,
+keyed by the options used, so opening the same log again is instant.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+
+FLIGHTPATH_VERSION = 1
+
+
+class PathBuilder(object):
+    '''positions of one path as they are read from a log. colour_fn
+    maps the colour key of a point to an (r,g,b) colour, and is only
+    called the first time a key is seen'''
+    def __init__(self, colour_fn):
+        self.colour_fn = colour_fn
+        self.lat = []
+        self.lon = []
+        self.timestamp = []
+        self.colour_idx = []
+        self.colour_keys = {}
+        self.colours = []
+
+    def __len__(self):
+        return len(self.lat)
+
+    def append(self, lat, lon, timestamp, key):
+        '''add a point, with a hashable colour key'''
+        idx = self.colour_keys.get(key, None)
+        if idx is None:
+            idx = len(self.colours)
+            self.colour_keys[key] = idx
+            self.colours.append(self.colour_fn(key))
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.timestamp.append(timestamp)
+        self.colour_idx.append(idx)
+
+    def arrays(self, start=0):
+        '''return (lat, lon, timestamp, colour_idx) arrays of the points
+        from start onwards'''
+        return (np.array(self.lat[start:], dtype=np.float64),
+                np.array(self.lon[start:], dtype=np.float64),
+                np.array(self.timestamp[start:], dtype=np.float64),
+                np.array(self.colour_idx[start:], dtype=np.int32))
+
+
+def rate_limit(timestamp, rate):
+    '''return the indexes of the points kept when showing at most rate
+    points per second. A point is kept when it is more than 1/rate
+    seconds after the last kept point'''
+    n = len(timestamp)
+    if rate <= 0 or n == 0:
+        return np.arange(n)
+    period = 1.0 / rate
+    ret = [0]
+    i = 0
+    while True:
+        i = int(np.searchsorted(timestamp, timestamp[i] + period, side='right'))
+        if i >= n:
+            break
+        ret.append(i)
+    return np.array(ret)
+
+
+def local_xy(lat, lon):
+    '''return (x, y) arrays in metres of positions relative to the first,
+    using an equirectangular projection, which is fine over the size of
+    a flight'''
+    if len(lat) == 0:
+        return (np.zeros(0), np.zeros(0))
+    scale = np.radians(1.0) * mp_util.radius_of_earth
+    coslat = np.cos(np.radians(lat[0]))
+    # wrap longitude differences so paths crossing 180 degrees work
+    dlon = (lon - lon[0] + 180.0) % 360.0 - 180.0
+    return (dlon * scale * coslat, (lat - lat[0]) * scale)
+
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    '''return the distances of points from the line segment (x1,y1) (x2,y2)'''
+    dx = x2 - x1
+    dy = y2 - y1
+    len2 = dx*dx + dy*dy
+    if len2 <= 0:
+        return np.hypot(x - x1, y - y1)
+    t = np.clip(((x - x1) * dx + (y - y1) * dy) / len2, 0, 1)
+    return np.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def douglas_peucker(x, y, tolerance, importance, start, end):
+    '''fill in importance for the points between start and end. The end
+    points are always kept. Points within tolerance metres of the
+    simplified path are left with an importance of zero'''
+    stack = [(start, end, np.inf)]
+    while stack:
+        (s, e, limit) = stack.pop()
+        if e - s < 2:
+            continue
+        d = segment_distance(x[s+1:e], y[s+1:e], x[s], y[s], x[e], y[e])
+        i = int(np.argmax(d))
+        dmax = d[i]
+        if dmax <= tolerance:
+            continue
+        i += s + 1
+        # a point never matters more than the point which split the
+        # range it is in, so thresholding importance gives the same
+        # path as running Douglas-Peucker with that tolerance
+        limit = min(dmax, limit)
+        importance[i] = limit
+        stack.append((s, i, limit))
+        stack.append((i, e, limit))
+
+
+def path_importance(lat, lon, colour_idx, tolerance):
+    '''return the importance of each point of a path. Each run of points
+    of one colour is simplified separately, so colour changes are kept
+    exactly. A tolerance of zero or less keeps every point'''
+    n = len(lat)
+    importance = np.zeros(n)
+    if tolerance <= 0 or n < 3:
+        importance[:] = np.inf
+        return importance
+    (x, y) = local_xy(lat, lon)
+    # each run ends at the first point of the next run, as the line to
+    # that point is drawn in the colour of the run
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(colour_idx)) + 1))
+    ends = np.concatenate((starts[1:], [n-1]))
+    importance[starts] = np.inf
+    importance[n-1] = np.inf
+    for (s, e) in zip(starts, ends):
+        douglas_peucker(x, y, tolerance, importance, int(s), int(e))
+    return importance
+
+
+def cache_key(params):
+    '''return a key for a dict of the parameters of a path extraction'''
+    s = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_filename(logname, key):
+    '''return the cache filename for a log and key'''
+    return os.path.join(logname + '.index', 'flightpath-%s.npz' % key)
+
+
+def log_stamp(logname):
+    st = os.stat(logname)
+    return [st.st_size, st.st_mtime]
+
+
+def load_cache(logname, key):
+    '''load cached paths for a log, returning (meta, paths) where paths
+    is a list of dicts of arrays, or None if there is no current cache'''
+    try:
+        stamp = log_stamp(logname)
+        with np.load(cache_filename(logname, key), allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version', None) != FLIGHTPATH_VERSION or meta.get('stamp', None) != stamp:
+                return None
+            paths = []
+            for i in range(meta['npaths']):
+                path = {}
+                for name in ['lat', 'lon', 'tdays', 'colour_idx', 'importance', 'colours']:
+                    path[name] = data['p%u_%s' % (i, name)]
+                paths.append(path)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return (meta, paths)
+
+
+def save_cache(logname, key, meta, paths):
+    '''save paths for a log. meta is a json-able dict, paths a list of
+    dicts of arrays. Errors are ignored'''
+    fname = cache_filename(logname, key)
+    tmpname = '%s.%u.tmp.npz' % (fname[:-4], os.getpid())
+    try:
+        meta = dict(meta)
+        meta['version'] = FLIGHTPATH_VERSION
+        meta['stamp'] = log_stamp(logname)
+        meta['npaths'] = len(paths)
+        arrays = {'meta': np.array(json.dumps(meta))}
+        for i in range(len(paths)):
+            for (name, a) in paths[i].items():
+                arrays['p%u_%s' % (i, name)] = a
+        mp_util.mkdir_p(os.path.dirname(fname))
+        np.savez(tmpname, **arrays)
+        os.replace(tmpname, fname)
+    except (IOError, OSError, TypeError, ValueError):
+        try:
+            os.unlink(tmpname)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+'''
+read and decode a MAVLink master link in a child process
+
+The child process inherits the open link, reads it and runs the
+MAVLink parser, then passes the raw data and decoded messages back to
+the main process in batches over a pipe. The main process keeps
+writing to the link directly. Messages from one link always arrive in
+the order they were received.
+'''
+
+import multiprocessing
+import os
+import select
+import signal
+import time
+
+from pymavlink import mavutil
+
+from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import multiproc_util
+
+
+def worker_supported(conn):
+    '''return True if conn can be read by a link worker. The link must
+    be inherited by the child process, and must not need to reconnect
+    as that would change the fd under the main process. Signed links
+    are decoded in the main process, as the child would check
+    signatures against the signing state it was forked with'''
+    if os.name == 'nt':
+        return False
+    if multiprocessing.get_start_method() != 'fork':
+        return False
+    if conn.fd is None:
+        return False
+    if conn.mav.signing.secret_key is not None:
+        return False
+    return isinstance(conn, (mavutil.mavserial, mavutil.mavudp, mavutil.mavmcast))
+
+
+class ForkedChild(object):
+    '''a child process made with a plain fork. multiprocessing closes
+    stdin in a new child, which deadlocks if the input thread of the
+    main process is blocked reading a piped stdin when we fork'''
+    def __init__(self, target):
+        self.target = target
+        self.pid = None
+        self.exitcode = None
+
+    def start(self):
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = 0
+            try:
+                self.target()
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+
+    def is_alive(self):
+        if self.pid is None or self.exitcode is not None:
+            return False
+        try:
+            (pid, status) = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            self.exitcode = -1
+            return False
+        if pid == 0:
+            return True
+        self.exitcode = status
+        return False
+
+    def join(self, timeout=None):
+        t0 = time.time()
+        while self.is_alive():
+            if timeout is not None and time.time() - t0 > timeout:
+                return
+            time.sleep(0.01)
+
+
+class LinkWorker(multiproc_util.MPChildTask):
+    '''read and parse a master link in a child process'''
+    def __init__(self, conn, auto_version=True, max_batch=16*1024*16):
+        super(LinkWorker, self).__init__()
+        self.conn = conn
+        self.auto_version = auto_version
+        # the fd the worker reads, the main process restarts the
+        # worker if the link is reopened with a new fd
+        self.link_fd = conn.fd
+        self.max_batch = max_batch
+        (self.result_recv, self.result_send) = multiproc.Pipe(duplex=False)
+        self.parent_pid = os.getpid()
+        self.batches = 0
+        self.errors = 0
+
+    def fileno(self):
+        '''fd for the main loop to wait on'''
+        return self.result_recv.fileno()
+
+    def start(self):
+        '''start the child process. The child must be forked so it
+        inherits the open link, and exits when the main process does'''
+        with multiproc_util.mutex:
+            self._child = ForkedChild(self._child_task)
+            self._child.start()
+        # the parent only receives results
+        self.child_pipe_recv.close()
+        self.result_send.close()
+
+    def link_state(self):
+        '''state of the child copy of the link needed by the main process'''
+        conn = self.conn
+        mav = conn.mav
+        ret = {
+            'total_bytes_received': mav.total_bytes_received,
+            'total_packets_received': mav.total_packets_received,
+            'total_receive_errors': mav.total_receive_errors,
+            'portdead': conn.portdead,
+        }
+        if isinstance(conn, mavutil.mavudp):
+            ret['last_address'] = conn.last_address
+            if conn.udp_server:
+                ret['clients_last_alive'] = dict(conn.clients_last_alive)
+        return ret
+
+    def child_task(self):
+        '''read the link, parse and send batches back to the main process'''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.result_recv.close()
+        conn = self.conn
+        # callbacks run in the main process
+        conn.mav.set_callback(None)
+        conn.mav.set_send_callback(None)
+        while not self.close_event.is_set():
+            if os.getppid() != self.parent_pid:
+                # main process has gone
+                break
+            try:
+                (rin, win, xin) = select.select([conn.fd], [], [], 0.1)
+            except (OSError, ValueError):
+                time.sleep(0.1)
+                continue
+            if not rin:
+                continue
+            raw = []
+            msgs = []
+            errors = []
+            nbytes = 0
+            # drain whatever is ready into one batch
+            while rin and nbytes < self.max_batch:
+                try:
+                    s = conn.recv(16*1024)
+                except Exception:
+                    conn.portdead = True
+                    break
+                if len(s) == 0:
+                    break
+                raw.append(s)
+                nbytes += len(s)
+                if conn.first_byte and self.auto_version:
+                    conn.auto_mavlink_version(s)
+                try:
+                    m = conn.mav.parse_buffer(s)
+                    if m:
+                        msgs.extend(m)
+                except mavutil.mavlink.MAVError as ex:
+                    errors.append(ex.message)
+                (rin, win, xin) = select.select([conn.fd], [], [], 0)
+            if not raw and not conn.portdead:
+                # prevent a dead port from causing the CPU to spin
+                time.sleep(0.1)
+                continue
+            try:
+                self.result_send.send((b''.join(raw), msgs, errors, self.link_state()))
+            except (OSError, EOFError):
+                break
+            if conn.portdead:
+                break
+
+    def receive(self):
+        '''return list of pending (raw, msgs, errors, state) batches'''
+        ret = []
+        try:
+            while self.result_recv.poll():
+                ret.append(self.result_recv.recv())
+        except (OSError, EOFError):
+            self.errors += 1
+            self.conn.portdead = True
+        self.batches += len(ret)
+        return ret
+
+    def apply_state(self, state):
+        '''update the main process copy of the link from the child state'''
+        conn = self.conn
+        mav = conn.mav
+        mav.total_bytes_received = state['total_bytes_received']
+        mav.total_packets_received = state['total_packets_received']
+        mav.total_receive_errors = state['total_receive_errors']
+        if state['portdead']:
+            conn.portdead = True
+        if 'last_address' in state:
+            conn.last_address = state['last_address']
+        if 'clients_last_alive' in state:
+            conn.clients_last_alive.update(state['clients_last_alive'])
+            conn.clients.update(state['clients_last_alive'].keys())
+
+    def close(self):
+        super(LinkWorker, self).close()
+        self.result_recv.close()
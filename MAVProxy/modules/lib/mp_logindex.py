@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+'''
+columnar index of a log for fast graphing
+
+The first time a message type is needed the log is scanned once and
+the messages of that type are stored as numpy arrays, one per field,
+along with their timestamps and position in the log. The index is
+cached in a directory next to the log and is thrown away if the log
+size or modification time changes.
+
+Graph expressions made only of message fields, arithmetic and simple
+maths functions are then evaluated over whole columns at once. Each
+message which triggers a graph point sees the most recent message of
+every other type, as it would when stepping through the log.
+'''
+
+import ast
+import json
+import math
+import operator
+import os
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+# functions which can be used in vectorised expressions
+VECTOR_FUNCS = {
+    'abs': np.abs,
+    'fabs': np.fabs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'degrees': np.degrees,
+    'radians': np.radians,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'asin': np.arcsin,
+    'acos': np.arccos,
+    'atan': np.arctan,
+    'atan2': np.arctan2,
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'hypot': np.hypot,
+}
+
+VECTOR_CONSTANTS = {
+    'pi': math.pi,
+}
+
+# AST nodes allowed in vectorised expressions
+VECTOR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name,
+                ast.Load, ast.Attribute, ast.Subscript, ast.Constant,
+                ast.operator, ast.UAdd, ast.USub, ast.Compare, ast.cmpop)
+if hasattr(ast, 'Index'):
+    # python < 3.9
+    VECTOR_NODES += (ast.Index,)
+
+
+# divisions are evaluated by functions which mark rows where the divisor
+# is zero invalid, as the per-message path drops those points. numpy
+# gives inf or nan for floats, which later maths can hide, and 0 for
+# integer // and %
+DIVISION_OPS = {
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+
+class VectorError(Exception):
+    '''raised when an expression can't be evaluated over columns'''
+    pass
+
+
+def log_filename(mlog):
+    '''return the filename of a log, or None'''
+    for attr in ['filename', 'address']:
+        fname = getattr(mlog, attr, None)
+        if isinstance(fname, str) and os.path.isfile(fname):
+            return fname
+    return None
+
+
+def log_position(mlog, m):
+    '''return a value which orders messages the same way in every scan'''
+    ofs = getattr(mlog, 'offset', None)
+    if ofs is not None:
+        return ofs
+    f = getattr(mlog, 'f', None)
+    if f is not None:
+        try:
+            return f.tell()
+        except Exception:
+            pass
+    return m._timestamp
+
+
+class MessageColumns(object):
+    '''the messages of one type as columns'''
+    def __init__(self, pos, timestamp, fields, instance_field=None):
+        self.pos = pos
+        self.timestamp = timestamp
+        self.fields = fields
+        self.instance_field = instance_field
+
+    def __len__(self):
+        return len(self.pos)
+
+    def select(self, rows):
+        '''return a MessageColumns holding only the given rows'''
+        fields = {}
+        for (name, col) in self.fields.items():
+            fields[name] = col[rows]
+        return MessageColumns(self.pos[rows], self.timestamp[rows], fields, self.instance_field)
+
+    def instance_rows(self, instance):
+        '''return a bool array of the rows for an instance'''
+        if self.instance_field is None or self.instance_field not in self.fields:
+            raise VectorError("no instance field")
+        col = self.fields[self.instance_field]
+        if col.dtype.kind in 'USO':
+            # string instances are quoted differently in the scalar path
+            raise VectorError("string instance")
+        return col == instance
+
+
+class LogIndex(object):
+    '''columnar index of the message types of one log'''
+    def __init__(self, filename):
+        self.filename = filename
+        st = os.stat(filename)
+        self.stamp = [st.st_size, st.st_mtime]
+        self.types = {}
+        self.cachedir = filename + '.index'
+        self.meta = {'version': INDEX_VERSION, 'stamp': self.stamp, 'types': {}}
+        self.load_meta()
+
+    def is_current(self):
+        '''return True if the log is unchanged since the index was made'''
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return [st.st_size, st.st_mtime] == self.stamp
+
+    def load_meta(self):
+        '''load the list of cached types, discarding a stale cache'''
+        try:
+            with open(os.path.join(self.cachedir, 'index.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if meta.get('version', None) != INDEX_VERSION or meta.get('stamp', None) != self.stamp:
+            return
+        self.meta = meta
+
+    def save_meta(self):
+        tmpname = os.path.join(self.cachedir, 'index.json.%u.tmp' % os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmpname, os.path.join(self.cachedir, 'index.json'))
+
+    def load_type(self, mtype):
+        '''load one type from the disk cache'''
+        info = self.meta['types'].get(mtype, None)
+        if info is None:
+            return None
+        if info['count'] == 0:
+            return MessageColumns(np.zeros(0, dtype=np.int64), np.zeros(0), {})
+        try:
+            with np.load(os.path.join(self.cachedir, mtype + '.npz'), allow_pickle=False) as data:
+                fields = {}
+                for name in info['fields']:
+                    fields[name] = data['f_' + name]
+                return MessageColumns(data['_pos'], data['_timestamp'], fields, info['instance_field'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save_type(self, mtype, cols):
+        '''save one type to the disk cache. Errors are ignored, the
+        index is then only kept in memory'''
+        info = {'count': len(cols), 'fields': sorted(cols.fields.keys()),
+                'instance_field': cols.instance_field}
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.mkdir(self.cachedir)
+            if len(cols) > 0:
+                arrays = {'_pos': cols.pos, '_timestamp': cols.timestamp}
+                for (name, col) in cols.fields.items():
+                    arrays['f_' + name] = col
+                tmpname = os.path.join(self.cachedir, '%s.%u.tmp.npz' % (mtype, os.getpid()))
+                np.savez(tmpname, **arrays)
+                os.replace(tmpname, os.path.join(self.cachedir, mtype + '.npz'))
+            self.meta['types'][mtype] = info
+            self.save_meta()
+        except (IOError, OSError):
+            pass
+
+    def scan(self, mlog, types):
+        '''scan the log once for a list of types, adding them to the index'''
+        pos = {}
+        timestamp = {}
+        fieldnames = {}
+        values = {}
+        instance_field = {}
+        for t in types:
+            pos[t] = []
+            timestamp[t] = []
+            values[t] = {}
+        mlog.rewind()
+        while True:
+            m = mlog.recv_match(type=types)
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype not in pos:
+                continue
+            if mtype not in fieldnames:
+                fieldnames[mtype] = list(m.get_fieldnames())
+                for name in fieldnames[mtype]:
+                    values[mtype][name] = []
+                ifield = getattr(m, 'instance_field', None)
+                if ifield is None and hasattr(m, 'fmt'):
+                    ifield = getattr(m.fmt, 'instance_field', None)
+                instance_field[mtype] = ifield
+            pos[mtype].append(log_position(mlog, m))
+            timestamp[mtype].append(m._timestamp)
+            v = values[mtype]
+            for name in fieldnames[mtype]:
+                v[name].append(getattr(m, name, None))
+        mlog.rewind()
+        for t in types:
+            fields = {}
+            for (name, vals) in values[t].items():
+                col = np.array(vals)
+                if col.dtype.kind not in 'biufU' or col.ndim != 1:
+                    # arrays, missing values and bytes can't be indexed
+                    continue
+                if col.dtype.kind in 'bu':
+                    col = col.astype(np.int64)
+                fields[name] = col
+            cols = MessageColumns(np.array(pos[t], dtype=np.int64), np.array(timestamp[t], dtype=np.float64),
+                                  fields, instance_field.get(t, None))
+            self.types[t] = cols
+            self.save_type(t, cols)
+
+    def columns(self, mlog, types):
+        '''return a dict of type -> MessageColumns, scanning the log for
+        any types not yet in the index. Types not in the log are empty'''
+        missing = []
+        for t in types:
+            if t in self.types:
+                continue
+            cols = self.load_type(t)
+            if cols is None:
+                missing.append(t)
+            else:
+                self.types[t] = cols
+        if missing:
+            self.scan(mlog, missing)
+        ret = {}
+        for t in types:
+            ret[t] = self.types[t]
+        return ret
+
+
+# indexes of logs opened in this process, by filename
+indexes = {}
+
+
+def get_index(mlog):
+    '''return the LogIndex for a log, or None if it can't be indexed'''
+    filename = log_filename(mlog)
+    if filename is None:
+        return None
+    idx = indexes.get(filename, None)
+    if idx is None or not idx.is_current():
+        try:
+            idx = LogIndex(filename)
+        except OSError:
+            return None
+        indexes[filename] = idx
+    return idx
+
+
+def vectorisable(expression, names):
+    '''return True if an expression can be evaluated over columns, names
+    is the set of message types which may be referenced'''
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if not isinstance(node, VECTOR_NODES):
+            return False
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in VECTOR_FUNCS or node.keywords:
+                return False
+        elif isinstance(node, ast.Name):
+            if node.id not in VECTOR_FUNCS and node.id not in VECTOR_CONSTANTS and node.id not in names:
+                return False
+        elif isinstance(node, ast.Subscript):
+            if not isinstance(node.value, ast.Name) or node.value.id not in names:
+                return False
+        elif isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                return False
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                return False
+    return True
+
+
+class ColumnJoin(object):
+    '''values of message fields as seen at a set of trigger positions in
+    the log. Rows where a referenced type has not been seen yet are
+    marked invalid'''
+    def __init__(self, pos):
+        self.pos = pos
+        self.valid = np.ones(len(pos), dtype=bool)
+
+    def lookup(self, cols):
+        '''return indexes into cols of the latest message at each trigger'''
+        if len(cols) == 0:
+            self.valid[:] = False
+            return None
+        idx = np.searchsorted(cols.pos, self.pos, side='right') - 1
+        self.valid &= idx >= 0
+        return np.maximum(idx, 0)
+
+
+class MessageView(object):
+    '''stands in for a message in a vectorised expression'''
+    def __init__(self, join, cols):
+        self._join = join
+        self._cols = cols
+        self._idx = None
+        self._looked_up = False
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        cols = self._cols
+        if name not in cols.fields:
+            raise VectorError("no field %s" % name)
+        if not self._looked_up:
+            self._idx = self._join.lookup(cols)
+            self._looked_up = True
+        if self._idx is None:
+            return np.zeros(len(self._join.pos))
+        return cols.fields[name][self._idx]
+
+    def __getitem__(self, instance):
+        cols = self._cols
+        return MessageView(self._join, cols.select(cols.instance_rows(instance)))
+
+
+class DivisionGuard(ast.NodeTransformer):
+    '''rewrites divisions as calls to the functions for DIVISION_OPS'''
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if type(node.op) not in DIVISION_OPS:
+            return node
+        func = ast.Name(id='_' + type(node.op).__name__, ctx=ast.Load())
+        return ast.copy_location(ast.Call(func=func, args=[node.left, node.right], keywords=[]), node)
+
+
+column_code = {}
+
+
+def compile_columns(expression):
+    '''return the code object for evaluating an expression over columns'''
+    ret = column_code.get(expression, None)
+    if ret is None:
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as ex:
+            raise VectorError(str(ex))
+        tree = ast.fix_missing_locations(DivisionGuard().visit(tree))
+        ret = compile(tree, '<columns>', 'eval')
+        if len(column_code) >= 1000:
+            column_code.clear()
+        column_code[expression] = ret
+    return ret
+
+
+def division(join, op):
+    '''return a function applying op, marking rows of join where the
+    divisor is zero invalid'''
+    def divide(a, b):
+        join.valid &= np.asarray(b) != 0
+        return op(a, b)
+    return divide
+
+
+def evaluate_columns(expression, join, types):
+    '''evaluate an expression string at the trigger positions of join.
+    Returns an array, updating join.valid. Raises VectorError if the
+    expression can't be evaluated over columns'''
+    code = compile_columns(expression)
+    ns = dict(VECTOR_FUNCS)
+    ns.update(VECTOR_CONSTANTS)
+    for (node, op) in DIVISION_OPS.items():
+        ns['_' + node.__name__] = division(join, op)
+    for (t, cols) in types.items():
+        ns[t] = MessageView(join, cols)
+    try:
+        with np.errstate(all='ignore'):
+            v = eval(code, {'__builtins__': {}}, ns)
+    except VectorError:
+        raise
+    except Exception as ex:
+        raise VectorError(str(ex))
+    v = np.asarray(v)
+    if v.ndim == 0:
+        v = np.full(len(join.pos), v.item())
+    if v.shape != join.pos.shape:
+        raise VectorError("bad result shape")
+    if v.dtype.kind in 'fc':
+        # the scalar path drops points where the maths fails
+        join.valid &= np.isfinite(v)
+    return v
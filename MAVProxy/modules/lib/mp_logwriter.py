@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''
+telemetry log writer
+
+packets are appended to preallocated ring buffers by the main thread
+and written out in batches by a writer thread using writev() where
+available. When the disk can't keep up the ring fills and new packets
+are dropped and counted, so memory use is bounded.
+'''
+
+import os
+import struct
+import threading
+import time
+
+
+class LogRingBuffer(object):
+    '''a preallocated ring buffer holding log data waiting to be written'''
+    def __init__(self, size, wakeup=None):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # head and tail are total byte counts, positions are taken modulo size
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+        self.wakeup = wakeup
+        self.wakeup_level = size // 2
+        self.immediate = False
+        self.packets = 0
+        self.dropped_packets = 0
+        self.dropped_bytes = 0
+        self.written_bytes = 0
+        self.high_water = 0
+
+    def _copy_in(self, pos, data):
+        '''copy data into the ring at pos, wrapping if needed'''
+        n = len(data)
+        first = min(n, self.size - pos)
+        self.view[pos:pos+first] = data[:first]
+        if first < n:
+            self.view[0:n-first] = data[first:]
+
+    def put(self, data, usec=None):
+        '''add data to the ring, optionally prefixed with a tlog timestamp.
+        Returns False if the data was dropped'''
+        n = len(data)
+        if usec is not None:
+            n += 8
+        with self.lock:
+            used = self.head - self.tail
+            if used + n > self.size:
+                self.dropped_packets += 1
+                self.dropped_bytes += n
+                return False
+            pos = self.head % self.size
+            if usec is not None:
+                if pos + 8 <= self.size:
+                    struct.pack_into('>Q', self.buf, pos, usec)
+                else:
+                    self._copy_in(pos, struct.pack('>Q', usec))
+                pos = (pos + 8) % self.size
+            self._copy_in(pos, data)
+            self.head += n
+            self.packets += 1
+            used += n
+            if used > self.high_water:
+                self.high_water = used
+        if self.wakeup is not None and (self.immediate or used >= self.wakeup_level):
+            self.wakeup.set()
+        return True
+
+    def put_timestamped(self, usec, data):
+        '''add a tlog record with a 64 bit microsecond timestamp'''
+        return self.put(data, usec=usec)
+
+    def pending(self):
+        '''return number of bytes waiting to be written'''
+        return self.head - self.tail
+
+    def segments(self):
+        '''return (memoryviews, length) of the data waiting to be
+        written. The data stays valid until release() is called'''
+        with self.lock:
+            head = self.head
+            tail = self.tail
+        n = head - tail
+        if n == 0:
+            return ([], 0)
+        pos = tail % self.size
+        first = min(n, self.size - pos)
+        ret = [self.view[pos:pos+first]]
+        if first < n:
+            ret.append(self.view[0:n-first])
+        return (ret, n)
+
+    def release(self, n):
+        '''mark n bytes as written'''
+        with self.lock:
+            self.tail += n
+            self.written_bytes += n
+
+
+def write_segments(f, segments):
+    '''write a list of buffers to a file with as few system calls as possible'''
+    fd = f.fileno()
+    if hasattr(os, 'writev'):
+        while segments:
+            n = os.writev(fd, segments)
+            # cope with partial writes
+            while segments and n >= len(segments[0]):
+                n -= len(segments[0])
+                segments = segments[1:]
+            if segments and n > 0:
+                segments[0] = segments[0][n:]
+    else:
+        for s in segments:
+            f.write(s)
+
+
+class LogWriter(object):
+    '''write .tlog and .tlog.raw streams from ring buffers in a thread'''
+    def __init__(self, logfile, logfile_raw, bufsize, flush_interval=0.5, fsync_interval=0):
+        self.files = [logfile, logfile_raw]
+        self.wakeup = threading.Event()
+        self.logqueue = LogRingBuffer(bufsize, self.wakeup)
+        self.logqueue_raw = LogRingBuffer(bufsize, self.wakeup)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.time()
+        self.fsync_count = 0
+        self.write_count = 0
+        self.write_errors = 0
+        self.exit = False
+        self.thread = None
+
+    def set_immediate(self, immediate):
+        '''if immediate is set the writer is woken on every packet'''
+        self.logqueue.immediate = immediate
+        self.logqueue_raw.immediate = immediate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_pending(self):
+        '''write out everything currently in the rings'''
+        for (f, ring) in zip(self.files, [self.logqueue, self.logqueue_raw]):
+            (segments, n) = ring.segments()
+            if n == 0:
+                continue
+            try:
+                write_segments(f, segments)
+            except (IOError, OSError):
+                self.write_errors += 1
+            ring.release(n)
+            self.write_count += 1
+        if self.fsync_interval > 0 and time.time() - self.last_fsync >= self.fsync_interval:
+            self.last_fsync = time.time()
+            for f in self.files:
+                try:
+                    os.fsync(f.fileno())
+                except (IOError, OSError):
+                    self.write_errors += 1
+            self.fsync_count += 1
+
+    def run(self):
+        '''log writing thread'''
+        while not self.exit:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write_pending()
+
+    def stop(self):
+        '''stop the thread and write out any remaining data'''
+        self.exit = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.write_pending()
+
+    def status(self):
+        '''return a status string'''
+        ret = []
+        for (name, ring) in [('tlog', self.logqueue), ('raw', self.logqueue_raw)]:
+            ret.append('%s: pkts:%u written:%u pending:%u highwater:%u/%u dropped:%u/%uB' % (
+                name, ring.packets, ring.written_bytes, ring.pending(),
+                ring.high_water, ring.size, ring.dropped_packets, ring.dropped_bytes))
+        ret.append('writes:%u fsyncs:%u errors:%u' % (self.write_count, self.fsync_count, self.write_errors))
+        return ' '.join(ret)
@@ -20,6 +20,9 @@ class MPModule(object):
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
         self.named_float_seq = 0
+        # optional mavlink_packet() subscription, None means all
+        self.subscribed_types = None
+        self.subscribed_sysids = None
 
         if description is None:
             self.description = name + " handling"
@@ -67,6 +70,9 @@ class MPModule(object):
     def module_matching(self, name):
         '''Find a list of modules matching a wildcard pattern'''
         import fnmatch
+        registry = getattr(self.mpstate, 'registry', None)
+        if registry is not None and registry.deferred:
+            registry.load_matching(name)
         ret = []
         for mname in self.mpstate.public_modules.keys():
             if fnmatch.fnmatch(mname, name):
@@ -154,6 +160,18 @@ class MPModule(object):
         if name in self.mpstate.completions:
             del self.mpstate.completions[name]
 
+    def subscribe_mavlink(self, types=None, sysids=None):
+        '''only pass messages of the given types and/or from the given
+        source system IDs to mavlink_packet(). The multi_vehicle rules
+        still apply. None means no restriction'''
+        if types is not None:
+            types = frozenset(types)
+        if sysids is not None:
+            sysids = frozenset(sysids)
+        self.subscribed_types = types
+        self.subscribed_sysids = sysids
+        self.mpstate.modules_changed()
+
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
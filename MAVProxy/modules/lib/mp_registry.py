@@ -0,0 +1,185 @@
+'''
+registry of MAVProxy modules which are loaded on demand
+
+Some default modules are only needed once their command is used or
+once a particular message arrives, and some import heavy libraries.
+For those modules a ModuleInfo describes their commands, completions
+and the message types which wake them, so the module itself need not
+be imported at startup. Until it is loaded a deferred module has stub
+commands which load the module and then run the real command.
+
+Module load times are recorded for the --profile-startup report.
+'''
+
+import fnmatch
+import time
+
+
+class ModuleInfo(object):
+    '''lightweight description of a module which can be deferred.
+    commands is a list of (name, description, completions) and types
+    the message types which cause the module to be loaded'''
+    def __init__(self, name, commands=None, types=None, public=False):
+        self.name = name
+        self.commands = commands or []
+        self.types = frozenset(types or [])
+        self.public = public
+
+
+# default modules which can be loaded on demand. Commands and
+# completions here should match those the modules add themselves
+DEFERRABLE_MODULES = {m.name: m for m in [
+    ModuleInfo('relay', commands=[('relay', 'relay commands', None),
+                                  ('servo', 'servo commands', None),
+                                  ('motortest', 'motortest commands', None)]),
+    ModuleInfo('tuneopt', commands=[('tuneopt', 'Select option for Tune Pot on Channel 6 (quadcopter only)', None)]),
+    ModuleInfo('auxopt', commands=[('auxopt', 'select option for aux switches on CH7 and CH8 (ArduCopter only)',
+                                    ['set <7|8> <Nothing|Flip|SimpleMode|RTL|SaveTrim|SaveWP|MultiMode|CameraTrigger|Sonar|Fence|ResetYaw|SuperSimpleMode|AcroTrainer|Acro|Auto|AutoTune|Land>',  # noqa:E501
+                                     'reset <7|8|all>',
+                                     '<show|list>'])]),
+    ModuleInfo('layout', commands=[('layout', 'window layout management', ["<save|load>"])]),
+    ModuleInfo('adsb', commands=[('adsb', 'adsb control', ["<status>", "set (ADSBSETTING)"])],
+               types=['ADSB_VEHICLE'], public=True),
+    ModuleInfo('terrain', commands=[('terrain', 'terrain control', ["<status|check>", 'set (TERRAINSETTING)'])],
+               types=['TERRAIN_REQUEST'], public=True),
+]}
+
+
+class ModuleTiming(object):
+    '''time taken to load one module'''
+    def __init__(self, name, import_time, init_time, reason):
+        self.name = name
+        self.import_time = import_time
+        self.init_time = init_time
+        self.reason = reason
+
+
+class ModuleRegistry(object):
+    '''deferred modules, and load times of all modules'''
+    def __init__(self, mpstate):
+        self.mpstate = mpstate
+        self.deferred = {}
+        # map from message type to names of deferred modules it wakes
+        self.wake_types = {}
+        self.timings = []
+        self.start_time = time.time()
+        self.profile = False
+
+    def defer(self, name):
+        '''register a module to be loaded on demand, returning False if
+        it can't be deferred'''
+        info = DEFERRABLE_MODULES.get(name, None)
+        if info is None or name in self.deferred:
+            return False
+        for (m, pm) in self.mpstate.modules:
+            if m.name == name:
+                return False
+        self.deferred[name] = info
+        for (cmd, description, completions) in info.commands:
+            if cmd in self.mpstate.command_map:
+                continue
+            self.mpstate.command_map[cmd] = (self.command_stub(name, cmd), description)
+            if completions is not None:
+                self.mpstate.completions[cmd] = completions
+        for t in info.types:
+            self.wake_types.setdefault(t, set()).add(name)
+        self.mpstate.modules_changed()
+        return True
+
+    def undefer(self, name):
+        '''remove the stubs of a deferred module'''
+        info = self.deferred.pop(name, None)
+        if info is None:
+            return False
+        for (cmd, description, completions) in info.commands:
+            c = self.mpstate.command_map.get(cmd, None)
+            if c is not None and getattr(c[0], 'deferred_module', None) == name:
+                self.mpstate.command_map.pop(cmd)
+                self.mpstate.completions.pop(cmd, None)
+        for t in info.types:
+            names = self.wake_types.get(t, None)
+            if names is not None:
+                names.discard(name)
+                if len(names) == 0:
+                    self.wake_types.pop(t)
+        self.mpstate.modules_changed()
+        return True
+
+    def is_deferred(self, name):
+        return name in self.deferred
+
+    def load(self, name, reason):
+        '''load a deferred module'''
+        if name not in self.deferred:
+            return False
+        return self.mpstate.load_module(name, quiet=True, load_reason=reason)
+
+    def command_stub(self, name, cmd):
+        '''return a command function which loads a module then runs its command'''
+        def stub(args):
+            if not self.load(name, "command %s" % cmd):
+                return
+            c = self.mpstate.command_map.get(cmd, None)
+            if c is None or c[0] is stub:
+                print("Module %s did not add command %s" % (name, cmd))
+                return
+            c[0](args)
+        stub.deferred_module = name
+        return stub
+
+    def wake(self, mtype):
+        '''load any deferred modules woken by a message type. Returns
+        True if a module was loaded'''
+        names = self.wake_types.get(mtype, None)
+        if names is None:
+            return False
+        ret = False
+        for name in sorted(names):
+            if self.load(name, "message %s" % mtype):
+                ret = True
+        return ret
+
+    def wake_type_names(self):
+        '''return the set of message types which wake deferred modules'''
+        return set(self.wake_types.keys())
+
+    def public_module(self, name):
+        '''load a deferred public module which another module is asking for'''
+        info = self.deferred.get(name, None)
+        if info is None or not info.public:
+            return None
+        self.load(name, "module %s requested" % name)
+        return self.mpstate.public_modules.get(name, None)
+
+    def load_matching(self, pattern):
+        '''load deferred public modules matching a wildcard pattern'''
+        for info in list(self.deferred.values()):
+            if info.public and fnmatch.fnmatch(info.name, pattern):
+                self.load(info.name, "module %s requested" % pattern)
+
+    def add_timing(self, name, import_time, init_time, reason):
+        '''record the time taken to load a module'''
+        t = ModuleTiming(name, import_time, init_time, reason)
+        self.timings.append(t)
+        if self.profile and reason is not None:
+            print("Loaded module %s on demand (%s): import %.1fms init %.1fms" % (
+                name, reason, import_time * 1000, init_time * 1000))
+
+    def report(self):
+        '''return a report of module load times'''
+        lines = []
+        lines.append("%-16s %10s %10s  %s" % ("module", "import ms", "init ms", ""))
+        total_import = 0
+        total_init = 0
+        for t in self.timings:
+            total_import += t.import_time
+            total_init += t.init_time
+            lines.append("%-16s %10.1f %10.1f  %s" % (t.name, t.import_time * 1000, t.init_time * 1000,
+                                                      t.reason or ""))
+        lines.append("%-16s %10.1f %10.1f" % ("total", total_import * 1000, total_init * 1000))
+        for name in sorted(self.deferred.keys()):
+            info = self.deferred[name]
+            wakes = [c[0] for c in info.commands] + sorted(info.types)
+            lines.append("%-16s %10s %10s  on %s" % (name, "deferred", "", ', '.join(wakes)))
+        lines.append("startup took %.2fs" % (time.time() - self.start_time))
+        return '\n'.join(lines)
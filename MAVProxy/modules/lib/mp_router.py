@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+'''
+split a MAVLink byte stream into frames without decoding them
+
+This is used by router mode, where most frames are forwarded as raw
+bytes and only the message types MAVProxy needs are decoded.
+'''
+
+from pymavlink import mavutil
+
+try:
+    from fastcrc.crc16 import mcrf4xx
+except ImportError:
+    mcrf4xx = None
+
+MARKER_V1 = 0xFE
+MARKER_V2 = 0xFD
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+SIGNATURE_LEN = 13
+IFLAG_SIGNED = 0x01
+
+
+def msgid_map():
+    '''return dict of message name -> message ID for the current dialect'''
+    ret = {}
+    for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+        ret[cls.msgname] = msgid
+    return ret
+
+
+def msgids_for_types(types):
+    '''convert a set of message names to a frozenset of message IDs,
+    ignoring names which are not in the dialect'''
+    ids = msgid_map()
+    return frozenset([ids[t] for t in types if t in ids])
+
+
+class FrameScanner(object):
+    '''find complete, CRC checked MAVLink frames in a byte stream'''
+    def __init__(self):
+        self.buf = bytearray()
+        self.crc_extra = {}
+        for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+            self.crc_extra[msgid] = bytes([cls.crc_extra])
+        self.frames = 0
+        self.bad_bytes = 0
+        self.crc_errors = 0
+
+    def next_marker(self, i):
+        '''return index of the next start of frame marker at or after i, or -1'''
+        buf = self.buf
+        j1 = buf.find(MARKER_V1, i)
+        j2 = buf.find(MARKER_V2, i)
+        if j1 == -1:
+            return j2
+        if j2 == -1:
+            return j1
+        return min(j1, j2)
+
+    def crc(self, buf, crc_extra):
+        '''return the MAVLink CRC of buf with crc_extra appended'''
+        if mcrf4xx is not None:
+            return mcrf4xx(crc_extra, mcrf4xx(bytes(buf), 0xFFFF))
+        crc = mavutil.mavlink.x25crc(buf)
+        crc.accumulate(crc_extra)
+        return crc.crc
+
+    def scan(self, data):
+        '''add data, returning a list of (msgid, srcSystem, frame) tuples'''
+        buf = self.buf
+        buf.extend(data)
+        n = len(buf)
+        ret = []
+        i = 0
+        while i < n:
+            if buf[i] != MARKER_V2 and buf[i] != MARKER_V1:
+                j = self.next_marker(i)
+                if j == -1:
+                    self.bad_bytes += n - i
+                    i = n
+                    break
+                self.bad_bytes += j - i
+                i = j
+            if n - i < 3:
+                break
+            plen = buf[i+1]
+            if buf[i] == MARKER_V2:
+                hlen = HEADER_LEN_V2
+                incompat_flags = buf[i+2]
+                if incompat_flags & ~IFLAG_SIGNED:
+                    # not a valid frame start
+                    self.bad_bytes += 1
+                    i += 1
+                    continue
+                flen = hlen + plen + 2
+                if incompat_flags & IFLAG_SIGNED:
+                    flen += SIGNATURE_LEN
+                if n - i < flen:
+                    break
+                srcSystem = buf[i+5]
+                msgid = buf[i+7] | (buf[i+8] << 8) | (buf[i+9] << 16)
+            else:
+                hlen = HEADER_LEN_V1
+                flen = hlen + plen + 2
+                if n - i < flen:
+                    break
+                srcSystem = buf[i+3]
+                msgid = buf[i+5]
+            crc_extra = self.crc_extra.get(msgid, None)
+            if crc_extra is not None:
+                crcpos = i + hlen + plen
+                if self.crc(buf[i+1:crcpos], crc_extra) != buf[crcpos] | (buf[crcpos+1] << 8):
+                    self.crc_errors += 1
+                    self.bad_bytes += 1
+                    i += 1
+                    continue
+            # unknown message IDs can't be checked, they are passed on
+            # as the full parser would
+            ret.append((msgid, srcSystem, bytes(buf[i:i+flen])))
+            self.frames += 1
+            i += flen
+        if i > 0:
+            del buf[:i]
+        return ret
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+'''
+terrain grid computation and pacing for the terrain server
+
+A TERRAIN_REQUEST covers 56 blocks of 4x4 points. The whole grid is
+computed in one vectorised pass, and complete grids are cached in
+memory and on disk keyed by (lat, lon, spacing) so repeated requests
+for the same area cost nothing. Sending is paced against the capacity
+of the link rather than a fixed rate.
+'''
+
+import os
+import time
+from collections import OrderedDict
+
+import numpy
+
+from MAVProxy.modules.lib import mp_util
+
+GRID_BLOCKS = 56
+BLOCK_POINTS = 16
+
+
+def gps_newpos_array(lat, lon, bearing, distance):
+    '''numpy version of mp_util.gps_newpos, all arguments may be arrays'''
+    eps = 1.0e-15
+    lat1 = numpy.clip(numpy.radians(lat), -numpy.pi/2+eps, numpy.pi/2-eps)
+    lon1 = numpy.radians(lon)
+    tc = numpy.radians(-bearing)
+    d = distance/mp_util.radius_of_earth
+
+    lat2 = numpy.clip(lat1 + d * numpy.cos(tc), -numpy.pi/2+eps, numpy.pi/2-eps)
+    same = numpy.abs(lat2-lat1) < eps
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        dphi = numpy.log(numpy.tan(lat2/2+numpy.pi/4)/numpy.tan(lat1/2+numpy.pi/4))
+        q = numpy.where(same, numpy.cos(lat1), (lat2-lat1)/numpy.where(same, 1.0, dphi))
+    dlon = -d*numpy.sin(tc)/q
+    lon2 = numpy.fmod(lon1+dlon+numpy.pi, 2*numpy.pi)-numpy.pi
+    return (numpy.degrees(lat2), numpy.degrees(lon2))
+
+
+def gps_offset_array(lat, lon, east, north):
+    '''numpy version of mp_util.gps_offset, all arguments may be arrays'''
+    bearing = numpy.degrees(numpy.arctan2(east, north))
+    distance = numpy.sqrt(east**2 + north**2)
+    return gps_newpos_array(lat, lon, bearing, distance)
+
+
+def request_points(lat, lon, spacing):
+    '''return (lats, lons) arrays of shape (56,16) for the points of a
+    terrain request, in the same order as the TERRAIN_DATA blocks'''
+    bits = numpy.arange(GRID_BLOCKS)
+    bit_spacing = spacing * 4
+    (blat, blon) = gps_offset_array(lat, lon,
+                                    east=bit_spacing * (bits % 8).astype(float),
+                                    north=bit_spacing * (bits // 8).astype(float))
+    i = numpy.arange(BLOCK_POINTS)
+    east = spacing * (i % 4).astype(float)
+    north = spacing * (i // 4).astype(float)
+    return gps_offset_array(blat[:, None], blon[:, None], east[None, :], north[None, :])
+
+
+class TerrainGridCache(object):
+    '''cache of computed terrain request grids'''
+    def __init__(self, elevation_model, cachedir=None, max_grids=512):
+        self.elevation_model = elevation_model
+        self.cachedir = cachedir
+        self.max_grids = max_grids
+        self.grids = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.computed = 0
+        if cachedir is not None:
+            mp_util.mkdir_p(cachedir)
+
+    def filename(self, key):
+        '''return the disk cache filename for a key'''
+        if self.cachedir is None:
+            return None
+        return os.path.join(self.cachedir, "%d_%d_%u.npy" % key)
+
+    def compute(self, lat, lon, spacing):
+        '''compute a grid, returning (data, valid) where data is an
+        int16 array of shape (56,16) and valid is a bool array
+        saying which blocks have complete data'''
+        (lats, lons) = request_points(lat*1.0e-7, lon*1.0e-7, spacing)
+        alts = self.elevation_model.GetElevationArray(lats, lons)
+        valid = ~numpy.isnan(alts).any(axis=1)
+        # truncate towards zero as int() does
+        data = numpy.where(numpy.isnan(alts), 0, alts).astype(numpy.int16)
+        self.computed += 1
+        return (data, valid)
+
+    def load(self, key):
+        '''load a complete grid from disk'''
+        fname = self.filename(key)
+        if fname is None:
+            return None
+        try:
+            data = numpy.load(fname)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.shape != (GRID_BLOCKS, BLOCK_POINTS):
+            return None
+        return data.astype(numpy.int16)
+
+    def save(self, key, data):
+        '''save a complete grid to disk'''
+        fname = self.filename(key)
+        if fname is None:
+            return
+        tmpname = "%s.%u.tmp" % (fname, os.getpid())
+        try:
+            with open(tmpname, 'wb') as f:
+                numpy.save(f, data)
+            os.replace(tmpname, fname)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmpname)
+            except (IOError, OSError):
+                pass
+
+    def get(self, lat, lon, spacing):
+        '''get the grid for a request, lat/lon in 1e-7 degrees.
+        Returns (data, valid), only complete grids are cached'''
+        key = (lat, lon, spacing)
+        data = self.grids.get(key, None)
+        if data is not None:
+            self.grids.move_to_end(key)
+            self.hits += 1
+            return (data, numpy.ones(GRID_BLOCKS, dtype=bool))
+        data = self.load(key)
+        if data is not None:
+            self.disk_hits += 1
+            valid = numpy.ones(GRID_BLOCKS, dtype=bool)
+        else:
+            (data, valid) = self.compute(lat, lon, spacing)
+            if not valid.all():
+                return (data, valid)
+            self.save(key, data)
+        self.grids[key] = data
+        while len(self.grids) > self.max_grids:
+            self.grids.popitem(last=False)
+        return (data, valid)
+
+    def status(self):
+        return "grids:%u hits:%u disk_hits:%u computed:%u" % (
+            len(self.grids), self.hits, self.disk_hits, self.computed)
+
+
+class TerrainPacer(object):
+    '''pace terrain data against the capacity of a link.
+
+    The capacity comes from the baud rate for serial links. A share of
+    the capacity left after other outgoing traffic is used, and
+    RADIO_STATUS txbuf reports scale the rate down when the radio
+    buffer fills. Links with no known capacity are limited to max_rate
+    blocks per second'''
+    def __init__(self, link_share=0.5, max_rate=50.0, block_bytes=55):
+        self.link_share = link_share
+        self.max_rate = max_rate
+        self.block_bytes = block_bytes
+        self.capacity = None
+        self.scale = 1.0
+        self.tokens = 0.0
+        self.last_update = time.time()
+        # outgoing traffic measurement
+        self.sample_time = self.last_update
+        self.sample_bytes = None
+        self.sample_own = 0
+        self.own_bytes = 0
+        self.other_rate = 0.0
+        self.rate = 0.0
+
+    def set_link(self, master):
+        '''set the link capacity in bytes/s from the master link'''
+        baud = getattr(master, 'baud', None)
+        if baud:
+            self.capacity = baud / 10.0
+        else:
+            self.capacity = None
+
+    def radio_status(self, txbuf):
+        '''adjust the rate from a RADIO_STATUS txbuf (percent free)'''
+        if txbuf < 20:
+            self.scale = max(0.05, self.scale * 0.5)
+        elif txbuf < 50:
+            self.scale = max(0.05, self.scale * 0.8)
+        elif txbuf > 90:
+            self.scale = min(1.0, self.scale * 1.1)
+
+    def measure(self, total_bytes_sent):
+        '''update the measured rate of other outgoing traffic'''
+        tnow = time.time()
+        if self.sample_bytes is None or total_bytes_sent < self.sample_bytes:
+            self.sample_bytes = total_bytes_sent
+            self.sample_own = self.own_bytes
+            self.sample_time = tnow
+            return
+        dt = tnow - self.sample_time
+        if dt < 1.0:
+            return
+        other = (total_bytes_sent - self.sample_bytes) - (self.own_bytes - self.sample_own)
+        self.other_rate = max(0, other) / dt
+        self.sample_bytes = total_bytes_sent
+        self.sample_own = self.own_bytes
+        self.sample_time = tnow
+
+    def bytes_per_second(self):
+        '''return the current allowed rate in bytes/s'''
+        if self.capacity is None:
+            return self.max_rate * self.block_bytes * self.scale
+        available = max(self.capacity * self.link_share - self.other_rate,
+                        self.capacity * 0.05)
+        return available * self.scale
+
+    def update(self):
+        '''add tokens for elapsed time'''
+        tnow = time.time()
+        dt = max(0, tnow - self.last_update)
+        self.last_update = tnow
+        self.rate = self.bytes_per_second()
+        # allow a short burst of up to 0.2s worth of data
+        self.tokens = min(self.tokens + dt * self.rate, max(self.rate * 0.2, self.block_bytes))
+
+    def ready(self):
+        '''return True if a block may be sent now'''
+        return self.tokens >= self.block_bytes
+
+    def sent(self, nbytes):
+        '''record bytes sent'''
+        self.tokens -= nbytes
+        self.own_bytes += nbytes
+
+    def status(self):
+        if self.capacity is None:
+            cap = "unknown"
+        else:
+            cap = "%.0fB/s" % self.capacity
+        return "capacity:%s other:%.0fB/s rate:%.0fB/s scale:%.2f" % (
+            cap, self.other_rate, self.rate, self.scale)
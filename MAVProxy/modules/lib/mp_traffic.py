@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+'''
+store of traffic positions for the ADS-B and AIS modules
+
+Positions are held in numpy arrays, one slot per target, so distances
+and closest approach to our vehicle are computed for all targets in
+one pass and expired targets are found in one pass. A grid of lat/lon
+cells gives the targets near a point without looking at the rest.
+'''
+
+import math
+
+import numpy
+
+RADIUS_OF_EARTH = 6371 * 1000
+
+
+class TrafficStore(object):
+    '''positions of a set of targets, keyed by id'''
+    def __init__(self, cell_size=0.1, capacity=64):
+        self.cell_size = cell_size
+        self.slots = {}
+        self.slot_ids = [None] * capacity
+        self.free = list(range(capacity-1, -1, -1))
+        self.cells = {}
+        self.slot_cell = [None] * capacity
+        self.lat = numpy.zeros(capacity)
+        self.lon = numpy.zeros(capacity)
+        self.alt = numpy.zeros(capacity)
+        self.heading = numpy.zeros(capacity)
+        self.speed = numpy.zeros(capacity)
+        self.vspeed = numpy.zeros(capacity)
+        self.update_time = numpy.zeros(capacity)
+        self.active = numpy.zeros(capacity, dtype=bool)
+        self.threat = numpy.zeros(capacity, dtype=bool)
+        self.h_distance = numpy.full(capacity, numpy.nan)
+        self.v_distance = numpy.full(capacity, numpy.nan)
+        self.distance = numpy.full(capacity, numpy.nan)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, id):
+        return id in self.slots
+
+    def ids(self, slots):
+        '''return the ids of an array of slots'''
+        return [self.slot_ids[s] for s in slots]
+
+    def slot(self, id):
+        '''return the slot of an id, or None'''
+        return self.slots.get(id, None)
+
+    def grow(self):
+        '''double the capacity of the arrays'''
+        n = len(self.slot_ids)
+        for name in ['lat', 'lon', 'alt', 'heading', 'speed', 'vspeed', 'update_time', 'active', 'threat']:
+            a = getattr(self, name)
+            setattr(self, name, numpy.concatenate((a, numpy.zeros(n, dtype=a.dtype))))
+        for name in ['h_distance', 'v_distance', 'distance']:
+            a = getattr(self, name)
+            setattr(self, name, numpy.concatenate((a, numpy.full(n, numpy.nan))))
+        self.slot_ids.extend([None] * n)
+        self.slot_cell.extend([None] * n)
+        self.free.extend(range(2*n-1, n-1, -1))
+
+    def cell(self, lat, lon):
+        '''return the grid cell of a position'''
+        return (int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size)))
+
+    def update(self, id, lat, lon, alt, heading, speed, vspeed, tnow):
+        '''add or update a target, position in degrees and metres,
+        heading in degrees, speeds in m/s. Returns True for a new target'''
+        s = self.slots.get(id, None)
+        new = s is None
+        if new:
+            if not self.free:
+                self.grow()
+            s = self.free.pop()
+            self.slots[id] = s
+            self.slot_ids[s] = id
+            self.active[s] = True
+            self.threat[s] = False
+            self.h_distance[s] = numpy.nan
+            self.v_distance[s] = numpy.nan
+            self.distance[s] = numpy.nan
+        self.lat[s] = lat
+        self.lon[s] = lon
+        self.alt[s] = alt
+        self.heading[s] = heading
+        self.speed[s] = speed
+        self.vspeed[s] = vspeed
+        self.update_time[s] = tnow
+        cell = self.cell(lat, lon)
+        old_cell = self.slot_cell[s]
+        if cell != old_cell:
+            if old_cell is not None:
+                self.cells[old_cell].discard(s)
+                if not self.cells[old_cell]:
+                    del self.cells[old_cell]
+            self.cells.setdefault(cell, set()).add(s)
+            self.slot_cell[s] = cell
+        return new
+
+    def remove(self, id):
+        '''remove a target'''
+        s = self.slots.pop(id, None)
+        if s is None:
+            return
+        cell = self.slot_cell[s]
+        if cell is not None:
+            self.cells[cell].discard(s)
+            if not self.cells[cell]:
+                del self.cells[cell]
+        self.slot_cell[s] = None
+        self.slot_ids[s] = None
+        self.active[s] = False
+        self.threat[s] = False
+        self.free.append(s)
+
+    def expire(self, tnow, timeout):
+        '''remove all targets not updated for timeout seconds, returning
+        their ids'''
+        slots = numpy.flatnonzero(self.active & (tnow - self.update_time > timeout))
+        ret = self.ids(slots)
+        for id in ret:
+            self.remove(id)
+        return ret
+
+    def all_slots(self):
+        '''return an array of all slots in use'''
+        return numpy.flatnonzero(self.active)
+
+    def lon_cells(self, lon, dlon):
+        '''return a list of (first, last) longitude cells within dlon
+        degrees of lon, split in two where they cross the antimeridian'''
+        if dlon >= 180:
+            ranges = [(-180, 180)]
+        elif lon - dlon < -180:
+            ranges = [(-180, lon + dlon), (lon - dlon + 360, 180)]
+        elif lon + dlon > 180:
+            ranges = [(lon - dlon, 180), (-180, lon + dlon - 360)]
+        else:
+            ranges = [(lon - dlon, lon + dlon)]
+        return [(self.cell(0, lon1)[1], self.cell(0, lon2)[1]) for (lon1, lon2) in ranges]
+
+    def nearby(self, lat, lon, radius):
+        '''return an array of the slots in grid cells within radius
+        metres of a position. This may include targets a little further
+        away, but never misses a closer one'''
+        dlat = math.degrees(radius / RADIUS_OF_EARTH)
+        coslat = math.cos(math.radians(min(abs(lat) + dlat, 89.9)))
+        dlon = min(dlat / coslat, 180)
+        c1lat = self.cell(lat - dlat, lon)[0]
+        c2lat = self.cell(lat + dlat, lon)[0]
+        lon_cells = self.lon_cells(lon, dlon)
+        ncells = (c2lat - c1lat + 1) * sum([c2lon - c1lon + 1 for (c1lon, c2lon) in lon_cells])
+        if ncells > len(self.cells):
+            # cheaper to look at every occupied cell
+            ret = [s for (c, slots) in self.cells.items()
+                   if c1lat <= c[0] <= c2lat and any([c1lon <= c[1] <= c2lon for (c1lon, c2lon) in lon_cells])
+                   for s in slots]
+        else:
+            ret = []
+            for clat in range(c1lat, c2lat+1):
+                for (c1lon, c2lon) in lon_cells:
+                    for clon in range(c1lon, c2lon+1):
+                        slots = self.cells.get((clat, clon), None)
+                        if slots:
+                            ret.extend(slots)
+        return numpy.array(sorted(ret), dtype=int)
+
+    def update_distances(self, lat, lon, alt, slots=None):
+        '''update the distances of targets from a position, for all
+        targets or an array of slots'''
+        if slots is None:
+            slots = self.all_slots()
+        lat1 = math.radians(lat)
+        lon1 = math.radians(lon)
+        lat2 = numpy.radians(self.lat[slots])
+        lon2 = numpy.radians(self.lon[slots])
+        dLat = lat2 - lat1
+        dLon = lon2 - lon1
+        # math as per mavextra.distance_two()
+        a = numpy.sin(0.5 * dLat)**2 + numpy.sin(0.5 * dLon)**2 * math.cos(lat1) * numpy.cos(lat2)
+        c = 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.0 - a))
+        h = RADIUS_OF_EARTH * c
+        v = self.alt[slots] - alt
+        self.h_distance[slots] = h
+        self.v_distance[slots] = v
+        self.distance[slots] = numpy.sqrt(h**2 + v**2)
+
+    def closest_approach(self, lat, lon, alt, vn, ve, vd, slots, horizon=60):
+        '''return (time, distance) arrays of the closest approach of
+        targets in slots to a vehicle at a position moving at vn,ve,vd
+        m/s, assuming both keep a constant velocity. The time is limited
+        to between 0 and horizon seconds'''
+        coslat = math.cos(math.radians(lat))
+        pn = numpy.radians(self.lat[slots] - lat) * RADIUS_OF_EARTH
+        pe = numpy.radians(self.lon[slots] - lon) * RADIUS_OF_EARTH * coslat
+        pu = self.alt[slots] - alt
+        hdg = numpy.radians(self.heading[slots])
+        rn = self.speed[slots] * numpy.cos(hdg) - vn
+        re = self.speed[slots] * numpy.sin(hdg) - ve
+        ru = self.vspeed[slots] + vd
+        v2 = rn**2 + re**2 + ru**2
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = numpy.where(v2 > 1.0e-6, -(pn*rn + pe*re + pu*ru) / v2, 0)
+        t = numpy.clip(t, 0, horizon)
+        d = numpy.sqrt((pn + rn*t)**2 + (pe + re*t)**2 + (pu + ru*t)**2)
+        return (t, d)
+
+
+def check():
+    '''compare nearby() with the distances to all targets for positions
+    around the antimeridian, returning a list of (lat, lon, id) for
+    targets within the radius which nearby() missed'''
+    import random
+    random.seed(1)
+    store = TrafficStore()
+    # a target just across the antimeridian
+    store.update('across', 0, 179.99, 0, 0, 0, 0, 0)
+    for i in range(500):
+        store.update(i, random.uniform(-1, 1), random.choice([-1, 1]) * random.uniform(178, 180), 0, 0, 0, 0, 0)
+    ret = []
+    radius = 20000
+    for (lat, lon) in [(0, -179.99), (0, 179.99), (0.5, -180), (-0.5, 180), (0.3, 179.5), (-0.3, -179.9)]:
+        found = set(store.nearby(lat, lon, radius))
+        store.update_distances(lat, lon, 0)
+        for s in store.all_slots():
+            if store.h_distance[s] <= radius and s not in found:
+                ret.append((lat, lon, store.slot_ids[s]))
+    return ret
+
+
+if __name__ == "__main__":
+    missed = check()
+    for (lat, lon, id) in missed:
+        print("from %.2f %.2f missed %s" % (lat, lon, id))
+    print("%u targets missed" % len(missed))
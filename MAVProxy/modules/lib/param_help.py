@@ -1,8 +1,172 @@
 import time, os
+import hashlib
+import pickle
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
+# bump when the cached form of the parameter documentation changes
+PARAM_DOCS_VERSION = 2
+
+class ParamDoc(object):
+    '''documentation of one parameter. fields is a list of (name, text),
+    values a list of (code, text) and bitmask a dict from bit number
+    to text, or None if the parameter is not a bitmask. full_name is
+    the name in the XML, which has a Vehicle: prefix for vehicle
+    parameters'''
+    __slots__ = ('name', 'human_name', 'documentation', 'user', 'fields', 'values', 'bitmask', 'full_name')
+
+    def __init__(self, name, human_name, documentation, user, fields, values, bitmask, full_name):
+        self.name = name
+        self.full_name = full_name
+        self.human_name = human_name
+        self.documentation = documentation
+        self.user = user
+        self.fields = fields
+        self.values = values
+        self.bitmask = bitmask
+
+    def field(self, name, default=None):
+        '''return the text of a field, such as Units or Range'''
+        for (n, v) in self.fields:
+            if n == name:
+                return v
+        return default
+
+    def search_text(self):
+        '''return lower case text to search for keywords. This has
+        everything in the XML for the parameter, as apropos searched
+        the text of the XML tree'''
+        ret = [self.full_name, self.human_name, self.documentation, self.user]
+        for (n, v) in self.fields:
+            ret.extend([n, v])
+        for (c, v) in self.values:
+            ret.extend([c, v])
+        if self.bitmask is not None:
+            for (b, v) in self.bitmask.items():
+                ret.extend([str(b), v])
+        return '\n'.join(ret).lower()
+
+class ParamDocs(object):
+    '''parameter documentation indexed by name. Entries are kept in
+    the compact form they are cached in until they are looked up'''
+    def __init__(self, entries):
+        self.entries = entries
+        self.docs = {}
+        self.search = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __getitem__(self, name):
+        doc = self.docs.get(name, None)
+        if doc is None:
+            (human_name, documentation, user, fields, values, bitmask, full_name) = self.entries[name]
+            if bitmask is not None:
+                bitmask = dict(bitmask)
+            doc = ParamDoc(name, human_name, documentation, user, fields, values, bitmask, full_name)
+            self.docs[name] = doc
+        return doc
+
+    def get(self, name, default=None):
+        if name not in self.entries:
+            return default
+        return self[name]
+
+    def apropos(self, keyword):
+        '''return names of parameters whose documentation contains keyword'''
+        if self.search is None:
+            self.search = [(name, self[name].search_text()) for name in self.entries.keys()]
+        keyword = keyword.lower()
+        return [name for (name, text) in self.search if text.find(keyword) != -1]
+
+def parse_param_xml(xml):
+    '''parse apm.pdef.xml contents into a dict of cache entries'''
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(xml)
+    entries = {}
+
+    def add(p, name):
+        fields = []
+        values = []
+        bitmask = None
+        for c in p:
+            if c.tag == 'field':
+                fields.append((c.get('name'), c.text or ''))
+            elif c.tag == 'values':
+                values = [(v.get('code'), v.text or '') for v in c]
+            elif c.tag == 'bitmask':
+                bitmask = [(int(b.get('code')), b.text or '') for b in c]
+        if bitmask is None:
+            # no bitmask subtree, split the traditional Bitmask field
+            for (n, v) in fields:
+                if n != 'Bitmask':
+                    continue
+                bitmask = []
+                for b in v.split(','):
+                    a = b.split(':')
+                    if len(a) == 2:
+                        try:
+                            bitmask.append((int(a[0]), a[1]))
+                        except ValueError:
+                            pass
+        entries[name] = (p.get('humanName') or '', p.get('documentation') or '', p.get('user') or '',
+                         fields, values, bitmask, p.get('name'))
+
+    vehicles = root.find('vehicles')
+    if vehicles is not None:
+        params = vehicles.find('parameters')
+        if params is not None:
+            for p in params.findall('param'):
+                add(p, p.get('name').split(':')[1])
+    libraries = root.find('libraries')
+    if libraries is not None:
+        for lib in libraries.findall('parameters'):
+            for p in lib.findall('param'):
+                add(p, p.get('name'))
+    return entries
+
+def param_docs_cache_path(path):
+    '''return the cache filename for a parameter XML file'''
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(mp_util.dot_mavproxy('paramdocs'), '%s-%s.pickle' % (os.path.basename(path), key))
+
+def load_param_docs(path):
+    '''load parameter documentation from an XML file. The parsed form is
+    cached under ~/.mavproxy and reused while the hash of the XML is
+    unchanged'''
+    with open(path, 'rb') as f:
+        xml = f.read()
+    xml_hash = hashlib.sha1(xml).hexdigest()
+    cache = param_docs_cache_path(path)
+    try:
+        with open(cache, 'rb') as f:
+            c = pickle.load(f)
+        if c['version'] == PARAM_DOCS_VERSION and c['hash'] == xml_hash:
+            return ParamDocs(c['params'])
+    except Exception:
+        pass
+    entries = parse_param_xml(xml)
+    tmpname = '%s.%u.tmp' % (cache, os.getpid())
+    try:
+        mp_util.mkdir_p(os.path.dirname(cache))
+        with open(tmpname, 'wb') as f:
+            pickle.dump({'version': PARAM_DOCS_VERSION, 'hash': xml_hash, 'params': entries}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, cache)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmpname)
+        except (IOError, OSError):
+            pass
+    return ParamDocs(entries)
+
 class ParamHelp:
     def __init__(self):
         self.xml_filepath = None
@@ -42,7 +206,8 @@ class ParamHelp:
             return self.vehicle_name
 
     def param_help_tree(self, verbose=False):
-        '''return a "help tree", a map between a parameter and its metadata.  May return None if help is not available'''
+        '''return a "help tree", a ParamDocs mapping parameter names to
+        their documentation.  May return None if help is not available'''
         if self.last_pair == (self.xml_filepath, self.vehicle_name):
             return self.last_htree
         if self.xml_filepath is not None:
@@ -67,18 +232,7 @@ class ParamHelp:
             if verbose:
                 print("Param XML (%s) does not exist" % path)
             return None
-        xml = open(path,'rb').read()
-        from lxml import objectify
-        objectify.enable_recursive_str()
-        tree = objectify.fromstring(xml)
-        htree = {}
-        for p in tree.vehicles.parameters.param:
-            n = p.get('name').split(':')[1]
-            htree[n] = p
-        for lib in tree.libraries.parameters:
-            for p in lib.param:
-                n = p.get('name')
-                htree[n] = p
+        htree = load_param_docs(path)
         self.last_htree = htree
         self.last_pair = (self.xml_filepath, self.vehicle_name)
         return htree
@@ -98,46 +252,18 @@ class ParamHelp:
 
         contains = {}
         for keyword in args:
-            keyword = keyword.lower()
-            for param in htree.keys():
-                if str(htree[param]).lower().find(keyword) != -1:
-                    contains[param] = True
+            for param in htree.apropos(keyword):
+                contains[param] = True
         for param in contains.keys():
             print("%s" % (param,))
 
     def get_Values_from_help(self, help):
-        children = help.getchildren()
-        for c in children:
-            if str(c).startswith("values"):
-                return c.getchildren()
-        return []
+        '''return a list of (code, text) for a parameter'''
+        return help.values
 
     def get_bitmask_from_help(self, help):
-        # check for presence of "bitmask" subtree, use it by preference:
-        children = help.getchildren()
-        for c in children:
-            if str(c).startswith("bitmask"):
-                ret = {}
-                for entry in c.getchildren():
-                    ret[int(entry.get('code'))] = str(entry)
-                return ret
-
-        # "bitmask" subtree not present, split the traditional
-        # "Bitmask" field ourselves:
-        if not hasattr(help, 'field'):
-            return None
-        field = help.field
-        if not hasattr(field, 'attrib'):
-            return None
-        if field.attrib.get('name',None) != 'Bitmask':
-            return None
-        a = str(field).split(',')
-        ret = {}
-        for v in a:
-            a2 = v.split(':')
-            if len(a2) == 2:
-                ret[a2[0]] = a2[1]
-        return ret
+        '''return a dict from bit number to text, or None'''
+        return help.bitmask
 
     def param_info(self, param, value):
         '''return info string for a param value'''
@@ -166,9 +292,9 @@ class ParamHelp:
             pass
         try:
             values = self.get_Values_from_help(help)
-            for v in values:
-                if int(v.get('code')) == int(value):
-                    return v
+            for (code, text) in values:
+                if int(code) == int(value):
+                    return text
         except Exception as e:
             pass
         return None
@@ -187,23 +313,20 @@ class ParamHelp:
             h = h.upper()
             if h in htree:
                 help = htree[h]
-                print("%s: %s\n" % (h, help.get('humanName')))
-                print(help.get('documentation'))
-                try:
-                    print("\n")
-                    for f in help.field:
-                        if f.get('name') == 'Bitmask':
-                            # handled specially below
-                            continue
-                        print("%s : %s" % (f.get('name'), str(f)))
-                except Exception as e:
-                    pass
+                print("%s: %s\n" % (h, help.human_name))
+                print(help.documentation)
+                print("\n")
+                for (name, text) in help.fields:
+                    if name == 'Bitmask':
+                        # handled specially below
+                        continue
+                    print("%s : %s" % (name, text))
                 try:
                     values = self.get_Values_from_help(help)
                     if len(values):
                         print("\nValues: ")
-                        for v in values:
-                            print("\t%3u : %s" % (int(v.get('code')), str(v)))
+                        for (code, text) in values:
+                            print("\t%3u : %s" % (int(code), text))
                 except Exception as e:
                     print("Caught exception %s" % repr(e))
                     pass
@@ -241,17 +364,13 @@ class ParamHelp:
 
             # we'll ignore the Values field if there's a bitmask field
             # involved as they're usually just examples.
-            has_bitmask = False
-            for f in getattr(help, "field", []):
-                if f.get('name') == "Bitmask":
-                    has_bitmask = True
-                    break
+            has_bitmask = help.field('Bitmask') is not None
             if not has_bitmask:
                 values = self.get_Values_from_help(help)
                 if len(values) == 0:
                     # no prescribed values list
                     continue
-                value_values = [float(x.get("code")) for x in values]
+                value_values = [float(code) for (code, text) in values]
                 if value not in value_values:
                     print("%s: value %f not in Values (%s)" %
                           (param, value, str(value_values)))
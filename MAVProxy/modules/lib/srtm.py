@@ -21,6 +21,12 @@ import os
 import zipfile
 import array
 import math
+import mmap
+import threading
+from collections import OrderedDict
+
+import numpy
+
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -62,6 +68,70 @@ class InvalidTileError(Exception):
     def __str__(self):
         return "SRTM tile for %d, %d is invalid!" % (self.lat, self.lon)
 
+class SRTMTileCache(object):
+    """LRU cache of loaded tiles, shared by all downloaders in a process.
+        Tiles are evicted least recently used first once the total size
+        of the cached tiles goes over max_bytes."""
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """return the tile for key, or None if not cached"""
+        with self.lock:
+            tile = self.tiles.get(key, None)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        """add a tile to the cache, evicting old tiles if needed"""
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.tiles[key] = tile
+            self.nbytes += tile.nbytes
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        """change the memory budget"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        # always keep the most recent tile, even if it is over budget
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            (key, tile) = self.tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.nbytes = 0
+
+    def status(self):
+        """return a status string"""
+        return "tiles:%u mem:%.1f/%.1fMB hits:%u misses:%u evictions:%u" % (
+            len(self.tiles), self.nbytes/(1024.0*1024), self.max_bytes/(1024.0*1024),
+            self.hits, self.misses, self.evictions)
+
+tile_cache = SRTMTileCache()
+
+def set_cache_size(mbytes):
+    """set the memory budget of the shared tile cache in megabytes"""
+    tile_cache.set_max_bytes(int(mbytes * 1024 * 1024))
+
 class SRTMDownloader():
     """Automatically download SRTM tiles."""
     def __init__(self, server="terrain.ardupilot.org",
@@ -258,6 +328,10 @@ class SRTMDownloader():
         """Get a SRTM tile object. This function can return either an SRTM1 or
             SRTM3 object depending on what is available, however currently it
             only returns SRTM3 objects."""
+        cache_key = (self.cachedir, int(lat), int(lon))
+        tile = tile_cache.get(cache_key)
+        if tile is not None:
+            return tile
         global childFileListDownload
         global filelistDownloadActive
         mypid = os.getpid()
@@ -280,7 +354,9 @@ class SRTMDownloader():
         except KeyError:
             if len(self.filelist) > self.min_filelist_len:
                 # we appear to have a full filelist - this must be ocean
-                return SRTMOceanTile(int(lat), int(lon))
+                tile = SRTMOceanTile(int(lat), int(lon))
+                tile_cache.put(cache_key, tile)
+                return tile
             return 0
 
         global childTileDownload
@@ -299,12 +375,12 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
         try:
-            return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
+            tile = SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
             return 0
+        tile_cache.put(cache_key, tile)
+        return tile
 
     def downloadTile(self, continent, filename):
         #Use HTTP
@@ -334,26 +410,90 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The zipped big-endian HGT file is converted once into a native
+        endian sidecar file next to it, which is mmap'd on later loads so
+        tiles load quickly and the pages are shared between processes.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.data = None
+        self.grid = None
+        self.mapped = False
+        sidecar = self.sidecarName(f)
+        try:
+            if os.path.getmtime(sidecar) >= os.path.getmtime(f):
+                self.mapSidecar(sidecar)
+        except (IOError, OSError, ValueError, InvalidTileError):
+            self.data = None
+        if self.data is None:
+            self.data = self.loadZip(f)
+            self.writeSidecar(sidecar)
+        self.nbytes = self.size * self.size * 2
+
+    @staticmethod
+    def sidecarName(f):
+        """return the filename of the native endian copy of a tile"""
+        if f.endswith('.zip'):
+            f = f[:-4]
+        return f + '.' + sys.byteorder
+
+    @staticmethod
+    def checkSize(nbytes, lat, lon):
+        """return the tile size for a given number of bytes of data"""
+        size = int(math.sqrt(nbytes/2)) # 2 bytes per sample
+        # Currently only SRTM1/3 is supported
+        if size not in (1201, 3601) or size * size * 2 != nbytes:
+            raise InvalidTileError(lat, lon)
+        return size
+
+    def loadZip(self, f):
+        """load tile data from a zipped HGT file"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        zipf.close()
+        self.size = self.checkSize(len(data), self.lat, self.lon)
+        data = array.array('h', data)
+        # HGT files are big endian
+        if sys.byteorder == 'little':
+            data.byteswap()
+        return data
+
+    def mapSidecar(self, sidecar):
+        """mmap the native endian copy of a tile"""
+        with open(sidecar, 'rb') as fh:
+            size = self.checkSize(os.fstat(fh.fileno()).st_size, self.lat, self.lon)
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+        self.data = memoryview(mm).cast('h')
+        self.mapped = True
+
+    def writeSidecar(self, sidecar):
+        """write the native endian copy of a tile, then map it. Failing
+            to write it is not an error, we keep using the loaded data"""
+        tmpname = "%s.%u.tmp" % (sidecar, os.getpid())
+        try:
+            with open(tmpname, 'wb') as fh:
+                self.data.tofile(fh)
+            os.replace(tmpname, sidecar)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmpname)
+            except (IOError, OSError):
+                pass
+            return
+        data = self.data
+        try:
+            self.mapSidecar(sidecar)
+        except (IOError, OSError, ValueError, InvalidTileError):
+            self.data = data
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -430,15 +570,56 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getGrid(self):
+        """Return a read only size x size numpy view of the tile data,
+            so it adds nothing to the memory the tile cache counts.
+            Row 0 is the north edge, and voids are -32768."""
+        if self.grid is None:
+            grid = numpy.frombuffer(self.data, dtype=numpy.int16).reshape(self.size, self.size)
+            grid.flags.writeable = False
+            self.grid = grid
+        return self.grid
+
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of numpy arrays of lat lon pairs, using the
+            same bilinear interpolation as getAltitudeFromLatLon.
+        """
+        lat = numpy.asarray(lats, dtype=numpy.float64) - self.lat
+        lon = numpy.asarray(lons, dtype=numpy.float64) - self.lon
+        if lat.size and (lat.min() < 0.0 or lat.max() >= 1.0 or lon.min() < 0.0 or lon.max() >= 1.0):
+            bad = numpy.flatnonzero((lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0))[0]
+            raise WrongTileError(self.lat, self.lon, self.lat+lat.flat[bad], self.lon+lon.flat[bad])
+        grid = self.getGrid()
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(numpy.intp)
+        y_int = y.astype(numpy.intp)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        # rows are stored north first
+        row0 = self.size - 1 - y_int
+        row1 = row0 - 1
+        # voids are -1, as in getPixelValue
+        (value00, value10, value01, value11) = [
+            numpy.where(v == -32768, numpy.int16(-1), v) for v in
+            (grid[row0, x_int], grid[row0, x_int+1], grid[row1, x_int], grid[row1, x_int+1])]
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
         self.lat = lat
         self.lon = lon
+        self.nbytes = 0
 
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
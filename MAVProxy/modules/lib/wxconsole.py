@@ -2,11 +2,17 @@
 
 """
   MAVProxy message console, implemented in a child process
+
+  Status values are only sent to the child when they change, and
+  changes are sent together as one batch at most max_rate times a
+  second
 """
 import threading
+import pickle
 import sys, time
+from collections import OrderedDict
 
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, ValueBatch, Text
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -16,10 +22,16 @@ class MessageConsole(textconsole.SimpleConsole):
     a message console for MAVProxy
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console',
+                 max_rate=10):
         textconsole.SimpleConsole.__init__(self)
         self.title = title
         self.menu_callback = None
+        self.max_rate = max_rate
+        # last value sent for each status key, and changes not yet sent
+        self.status_sent = {}
+        self.status_pending = OrderedDict()
+        self.stats = ConsoleStats()
         self.parent_pipe_recv,self.child_pipe_send = multiproc.Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = multiproc.Pipe(duplex=False)
         self.close_event = multiproc.Event()
@@ -28,9 +40,14 @@ class MessageConsole(textconsole.SimpleConsole):
         self.child.start()
         self.child_pipe_send.close()
         self.child_pipe_recv.close()
+        # created after the child is started as locks can't be pickled
+        self.lock = threading.Lock()
         t = threading.Thread(target=self.watch_thread)
         t.daemon = True
         t.start()
+        t = threading.Thread(target=self.flush_thread)
+        t.daemon = True
+        t.start()
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -60,27 +77,72 @@ class MessageConsole(textconsole.SimpleConsole):
         except EOFError:
             pass
 
+    def flush_thread(self):
+        '''send pending status changes at most max_rate times a second'''
+        while not self.close_event.is_set():
+            time.sleep(1.0 / max(self.max_rate, 1))
+            if not self.is_alive():
+                break
+            try:
+                self.flush_status()
+            except Exception:
+                break
+
+    def send(self, obj):
+        '''send an object to the child, counting the bytes sent'''
+        buf = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.parent_pipe_send.send_bytes(buf)
+        self.stats.add_bytes(len(buf))
+
     def set_layout(self, layout):
         '''set window layout'''
-        self.parent_pipe_send.send(layout)
-        
+        self.send(layout)
+
     def write(self, text, fg='black', bg='white'):
         '''write to the console'''
         try:
-            self.parent_pipe_send.send(Text(text, fg, bg))
+            self.send(Text(text, fg, bg))
         except Exception:
             pass
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
-        '''set a status value'''
-        if self.is_alive():
-            self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+        '''set a status value. Only changed values are sent, by flush_status'''
+        t0 = time.thread_time()
+        key = (text, row, fg, bg)
+        with self.lock:
+            self.stats.status_calls += 1
+            if self.status_sent.get(name, None) == key:
+                # back to what is displayed, drop any pending change
+                self.status_pending.pop(name, None)
+            else:
+                self.status_pending[name] = Value(name, text, row, fg, bg)
+        self.stats.add_cpu(time.thread_time() - t0)
+
+    def flush_status(self):
+        '''send pending status changes as one batch'''
+        t0 = time.thread_time()
+        with self.lock:
+            if len(self.status_pending) == 0:
+                return
+            values = list(self.status_pending.values())
+            self.status_pending.clear()
+            for v in values:
+                self.status_sent[v.name] = (v.text, v.row, v.fg, v.bg)
+        self.stats.status_sent += len(values)
+        self.stats.batches += 1
+        self.send(ValueBatch(values))
+        self.stats.add_cpu(time.thread_time() - t0)
 
     def set_menu(self, menu, callback):
         if self.is_alive():
-            self.parent_pipe_send.send(menu)
+            self.send(menu)
             self.menu_callback = callback
 
+    def status_report(self):
+        '''return a string describing status traffic to the child'''
+        return self.stats.report(len(self.status_sent))
+
     def close(self):
         '''close the console'''
         self.close_event.set()
@@ -91,6 +153,41 @@ class MessageConsole(textconsole.SimpleConsole):
         '''check if child is still going'''
         return self.child.is_alive()
 
+class ConsoleStats(object):
+    '''counts of status updates and pipe traffic to the console child'''
+    def __init__(self):
+        self.status_calls = 0
+        self.status_sent = 0
+        self.batches = 0
+        self.bytes = 0
+        self.cpu = 0.0
+        self.last = (time.time(), 0, 0, 0.0)
+
+    def add_bytes(self, n):
+        self.bytes += n
+
+    def add_cpu(self, t):
+        self.cpu += t
+
+    def report(self, nkeys):
+        '''return a description of the totals, with per second rates
+        since the last report'''
+        now = time.time()
+        (t, calls, nbytes, cpu) = self.last
+        dt = max(now - t, 1.0e-3)
+        self.last = (now, self.status_calls, self.bytes, self.cpu)
+        suppressed = self.status_calls - self.status_sent
+        pct = 0
+        if self.status_calls > 0:
+            pct = 100.0 * suppressed / self.status_calls
+        return ("keys=%u set_status=%.1f/s pipe=%.0f bytes/s cpu=%.2fms/s "
+                "batches=%u sent=%u suppressed=%u (%.0f%%)" % (
+                    nkeys,
+                    (self.status_calls - calls) / dt,
+                    (self.bytes - nbytes) / dt,
+                    (self.cpu - cpu) * 1000 / dt,
+                    self.batches, self.status_sent, suppressed, pct))
+
 if __name__ == "__main__":
     # test the console
     multiproc.freeze_support()
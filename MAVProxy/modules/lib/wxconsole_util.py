@@ -12,4 +12,8 @@ class Value():
         self.text = text
         self.row = row
         self.fg = fg
-        self.bg = bg
\ No newline at end of file
+        self.bg = bg
+class ValueBatch():
+    '''a set of changed status bar values, sent together'''
+    def __init__(self, values):
+        self.values = values
@@ -6,9 +6,12 @@ Dec 2015
 
 from math import *
 
+import numpy
+
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_traffic
 from pymavlink import mavutil
 from PIL import ImageColor
 
@@ -55,23 +58,21 @@ class ADSBVehicle(object):
         self.vehicle_colour = 'green'  # use plane icon for now
         self.vehicle_type = 'plane'
         self.icon = self.vehicle_colour + self.vehicle_type + '.png'
-        self.update_time = 0
         self.is_evading_threat = False
-        self.v_distance = None
-        self.h_distance = None
-        self.distance = None
 
     def update(self, state, tnow):
         '''update the threat state'''
         self.state = state
-        self.update_time = tnow
 
 
 class ADSBModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support", public = True)
+        self.subscribe_mavlink(types=['ADSB_VEHICLE', 'GLOBAL_POSITION_INT'])
         self.threat_vehicles = {}
+        # positions of the threat vehicles
+        self.traffic = mp_traffic.TrafficStore()
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
         self.add_command('adsb', self.cmd_ADSB, "adsb control",
@@ -88,7 +89,10 @@ class ADSBModule(mp_module.MPModule):
                                                      ("alt_color1", str, "blue"),
                                                      ("alt_color2", str, "red"),
                                                      ("alt_color_alt_thresh", int, 300),
-                                                     ("alt_color_dist_thresh", int, 3000)])
+                                                     ("alt_color_dist_thresh", int, 3000),
+                                                     # seconds ahead to look for a closest approach
+                                                     # inside threat_radius, 0 to disable
+                                                     ("threat_cpa_time", int, 0)])
         self.add_completion_function('(ADSBSETTING)',
                                      self.ADSB_settings.completion)
         
@@ -107,52 +111,81 @@ class ADSBModule(mp_module.MPModule):
             print("total threat count: %u  active threat count: %u" %
                   (len(self.threat_vehicles), len(self.active_threat_ids)))
 
+            latlonalt = self.get_latlonalt()
+            if latlonalt is not None:
+                self.update_threat_distances(latlonalt)
             for id in self.threat_vehicles.keys():
-                print("id: %s  distance: %.2f m callsign: %s  alt: %.2f" % (id,
-                                                                            self.threat_vehicles[id].distance,
-                                                                            self.threat_vehicles[id].state['callsign'],
-                                                                            self.threat_vehicles[id].state['altitude']))
+                distance = self.traffic.distance[self.traffic.slot(id)]
+                if numpy.isnan(distance):
+                    # no position for our vehicle yet
+                    distance = "unknown"
+                else:
+                    distance = "%.2f m" % distance
+                print("id: %s  distance: %s callsign: %s  alt: %.2f" % (id,
+                                                                        distance,
+                                                                        self.threat_vehicles[id].state['callsign'],
+                                                                        self.threat_vehicles[id].state['altitude']))
         elif args[0] == "set":
             self.ADSB_settings.command(args[1:])
         else:
             print(usage)
 
+    def get_latlonalt(self):
+        '''return our (lat, lon, alt) or None'''
+        GPI = self.master.messages.get("GLOBAL_POSITION_INT", None)
+        if GPI is None:
+            return None
+        return (GPI.lat * 1.0e-7, GPI.lon * 1.0e-7, GPI.alt * 0.001)
+
+    def threat_candidates(self, latlonalt):
+        '''return the slots of the vehicles which may be threats: those
+        near us and those already being evaded'''
+        radius = self.ADSB_settings.threat_radius * \
+            self.ADSB_settings.threat_radius_clear_multiplier
+        if self.ADSB_settings.threat_cpa_time > 0:
+            # allow for vehicles closing at up to 300m/s
+            radius += self.ADSB_settings.threat_cpa_time * 300
+        near = self.traffic.nearby(latlonalt[0], latlonalt[1], radius)
+        return numpy.union1d(near, numpy.flatnonzero(self.traffic.threat))
+
     def perform_threat_detection(self):
         '''determine threats'''
+        latlonalt = self.get_latlonalt()
+        if latlonalt is None:
+            return
+        slots = self.threat_candidates(latlonalt)
+        self.update_threat_distances(latlonalt, slots)
+
         # TODO: perform more advanced threat detection
         threat_radius_clear = self.ADSB_settings.threat_radius * \
             self.ADSB_settings.threat_radius_clear_multiplier
 
-        for id in self.threat_vehicles.keys():
-            if self.threat_vehicles[id].distance is not None:
-                if self.threat_vehicles[id].distance <= self.ADSB_settings.threat_radius and not self.threat_vehicles[id].is_evading_threat:
-                    # if the threat is in the threat radius and not currently
-                    # known to the module...
-                    # set flag to action threat
-                    self.threat_vehicles[id].is_evading_threat = True
-
-                if self.threat_vehicles[id].distance > threat_radius_clear and self.threat_vehicles[id].is_evading_threat:
-                    # if the threat is known to the module and outside the
-                    # threat clear radius...
-                    # clear flag to action threat
-                    self.threat_vehicles[id].is_evading_threat = False
-
-        self.active_threat_ids = [id for id in self.threat_vehicles.keys(
-        ) if self.threat_vehicles[id].is_evading_threat]
-
-    def update_threat_distances(self, latlonalt):
-        '''update the distance between threats and vehicle'''
-        for id in self.threat_vehicles.keys():
-            threat_latlonalt = (self.threat_vehicles[id].state['lat'] * 1e-7,
-                                self.threat_vehicles[id].state['lon'] * 1e-7,
-                                self.threat_vehicles[id].state['altitude'])
-
-            self.threat_vehicles[id].h_distance = self.get_h_distance(latlonalt, threat_latlonalt)
-            self.threat_vehicles[id].v_distance = self.get_v_distance(latlonalt, threat_latlonalt)
-
-            # calculate and set the total distance between threat and vehicle
-            self.threat_vehicles[id].distance = sqrt(
-                self.threat_vehicles[id].h_distance**2 + (self.threat_vehicles[id].v_distance)**2)
+        traffic = self.traffic
+        distance = traffic.distance[slots]
+        threat = traffic.threat[slots]
+        # a threat in the threat radius is actioned, and is cleared
+        # once it is outside the threat clear radius
+        inside = distance <= self.ADSB_settings.threat_radius
+        if self.ADSB_settings.threat_cpa_time > 0:
+            GPI = self.master.messages["GLOBAL_POSITION_INT"]
+            (t, d) = traffic.closest_approach(latlonalt[0], latlonalt[1], latlonalt[2],
+                                              GPI.vx*0.01, GPI.vy*0.01, GPI.vz*0.01, slots,
+                                              horizon=self.ADSB_settings.threat_cpa_time)
+            inside |= d <= self.ADSB_settings.threat_radius
+        new_threat = inside | (threat & ~(distance > threat_radius_clear))
+        traffic.threat[slots] = new_threat
+
+        for s in slots[new_threat != threat]:
+            id = traffic.slot_ids[s]
+            self.threat_vehicles[id].is_evading_threat = bool(traffic.threat[s])
+
+        self.active_threat_ids = traffic.ids(numpy.flatnonzero(traffic.threat))
+
+    def update_threat_distances(self, latlonalt, slots=None):
+        '''update the distance between threats and vehicle, for all
+        threats or an array of traffic slots'''
+        (lat, lon, alt) = latlonalt
+        self.traffic.update_distances(lat, lon, alt, slots)
 
     def get_h_distance(self, latlonalt1, latlonalt2):
         '''get the horizontal distance between threat and vehicle'''
@@ -180,21 +213,18 @@ class ADSBModule(mp_module.MPModule):
 
     def check_threat_timeout(self):
         '''check and handle threat time out'''
-        for id in self.threat_vehicles.keys():
-            if self.threat_vehicles[id].update_time == 0:
-                self.threat_vehicles[id].update_time = self.get_time()
-            dt = self.get_time() - self.threat_vehicles[id].update_time
-            if dt > self.ADSB_settings.timeout:
-                # if the threat has timed out...
-                del self.threat_vehicles[id]  # remove the threat from the dict
-                for mp in self.module_matching('map*'):
-                    # remove the threat from the map
-                    mp.map.remove_object(id)
-                    mp.map.remove_object(id+":circle")
-                # we've modified the dict we're iterating over, so
-                # we'll get any more timed-out threats next time we're
-                # called:
-                return
+        expired = self.traffic.expire(self.get_time(), self.ADSB_settings.timeout)
+        if not expired:
+            return
+        for id in expired:
+            # remove the threat from the dict
+            del self.threat_vehicles[id]
+        self.active_threat_ids = [id for id in self.active_threat_ids if id in self.threat_vehicles]
+        for mp in self.module_matching('map*'):
+            # remove the threats from the map
+            for id in expired:
+                mp.map.remove_object(id)
+                mp.map.remove_object(id+":circle")
 
     def add_vehicle(self, state):
         '''handle an incoming vehicle packet'''
@@ -207,6 +237,10 @@ class ADSBModule(mp_module.MPModule):
         emitter_type = state['emitter_type']
         squawk = state['squawk']
 
+        self.traffic.update(id, lat * 1.0e-7, lon * 1.0e-7, altitude_km * 0.001, heading * 0.01,
+                            state.get('hor_velocity', 0) * 0.01, state.get('ver_velocity', 0) * 0.01,
+                            self.get_time())
+
         if id not in self.threat_vehicles.keys():  # check to see if the vehicle is in the dict
             #print("NEW: ", state)
             # if not then add it
@@ -9,6 +9,7 @@ from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_traffic
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib import mp_menu
@@ -23,12 +24,13 @@ class AISVehicle():
         self.vehicle_colour = 'blue'  # use boat icon for now
         self.vehicle_type = 'boat'
         self.icon = self.vehicle_colour + self.vehicle_type + '.png'
-        self.update_time = 0
         self.onMap = False
+        # set when the state changes and the map needs updating
+        self.changed = True
 
     def update(self, state, tnow):
         self.state = state
-        self.update_time = tnow
+        self.changed = True
 
     def getThreatRadius(self, default_radius):
         ''' get threat radius, based on ship type'''
@@ -49,6 +51,8 @@ class AISModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(AISModule, self).__init__(mpstate, "ais", "AIS data support", public=True)
         self.threat_vehicles = {}
+        # positions of the threat vehicles
+        self.traffic = mp_traffic.TrafficStore()
 
         self.add_command('ais', self.cmd_AIS, "ais control",
                          ["<status>", "set (AISSETTING)"])
@@ -69,6 +73,8 @@ class AISModule(mp_module.MPModule):
         usage = "usage: ais <set>"
         if len(args) == 0:
             print(usage)
+        elif args[0] == "status":
+            print("total threat count: %u" % len(self.threat_vehicles))
         elif args[0] == "set":
             self.AIS_settings.command(args[1:])
         else:
@@ -76,26 +82,27 @@ class AISModule(mp_module.MPModule):
 
     def check_threat_timeout(self):
         '''check and handle threat time out'''
-        for id in self.threat_vehicles:
-            if self.threat_vehicles[id].update_time == 0:
-                self.threat_vehicles[id].update_time = self.get_time()
-            dt = self.get_time() - self.threat_vehicles[id].update_time
-            if dt > self.AIS_settings.timeout:
-                # if the threat has timed out...
-                del self.threat_vehicles[id]  # remove the threat from the dict
-                for mp in self.module_matching('map*'):
-                    # remove the threat from the map
-                    mp.map.remove_object(id)
-                    mp.map.remove_object(id+":circle")
-                # we've modified the dict we're iterating over, so
-                # we'll get any more timed-out threats next time we're
-                # called:
-                return
+        expired = self.traffic.expire(self.get_time(), self.AIS_settings.timeout)
+        if not expired:
+            return
+        for id in expired:
+            # remove the threat from the dict
+            del self.threat_vehicles[id]
+        for mp in self.module_matching('map*'):
+            # remove the threats from the map
+            for id in expired:
+                mp.map.remove_object(id)
+                mp.map.remove_object(id+":circle")
 
     def update_map(self):
         '''update the map graphics'''
-        for mp in self.module_matching('map*'):
-            for id in self.threat_vehicles.keys():
+        maps = self.module_matching('map*')
+        if not maps:
+            return
+        # only vehicles which have changed need redrawing
+        changed = [id for id in self.threat_vehicles.keys() if self.threat_vehicles[id].changed]
+        for mp in maps:
+            for id in changed:
                 mstate = self.threat_vehicles[id].state
                 threat_radius = self.threat_vehicles[id].getThreatRadius(self.AIS_settings.threat_radius)
                 # update if existing object on map, else create
@@ -126,11 +133,15 @@ class AISModule(mp_module.MPModule):
                                                             (mstate.lat * 1e-7, mstate.lon * 1e-7),
                                                             threat_radius, (0, 255, 255), linewidth=1))
                     self.threat_vehicles[id].onMap = True
+        for id in changed:
+            self.threat_vehicles[id].changed = False
 
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
         if m.get_type() == "AIS_VESSEL":
             id = 'AIS-' + str(m.MMSI)
+            self.traffic.update(id, m.lat * 1.0e-7, m.lon * 1.0e-7, 0, m.COG * 0.01, m.velocity * 0.01, 0,
+                                self.get_time())
 
             if id not in self.threat_vehicles.keys():  # check to see if the vehicle is in the dict
                 # if not then add it
@@ -12,7 +12,45 @@ from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_util
 from pymavlink import mavutil
 
-import asterix, socket, time, os, struct
+import asterix, socket, time, os, struct, sys
+
+# kernel receive timestamps, used to measure how long datagrams wait
+# in the socket before they are processed
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29 if sys.platform.startswith('linux') else None)
+TIMEVAL_FORMAT = '@ll'
+
+class AsterixRecord(object):
+    '''the fields of an ADSB_VEHICLE message for one asterix record. The
+    message is only encoded once the record is known to be needed'''
+    def __init__(self, icao_address, lat, lon, alt_m, climb_rate_fps, emitter_type, squawk):
+        self.ICAO_address = icao_address
+        self.lat = int(lat*1e7)
+        self.lon = int(lon*1e7)
+        self.altitude = int(alt_m*1000) # mm
+        self.heading = 0
+        self.hor_velocity = 0
+        self.ver_velocity = int(climb_rate_fps * 0.3048 * 100) # cm/s
+        self.emitter_type = emitter_type
+        self.squawk = squawk
+
+    def encode(self, mav):
+        '''return an ADSB_VEHICLE message for the record'''
+        return mav.adsb_vehicle_encode(self.ICAO_address,
+                                       self.lat,
+                                       self.lon,
+                                       mavutil.mavlink.ADSB_ALTITUDE_TYPE_GEOMETRIC,
+                                       self.altitude,
+                                       self.heading,
+                                       self.hor_velocity,
+                                       self.ver_velocity,
+                                       ("%08x" % self.ICAO_address).encode("ascii"),
+                                       self.emitter_type,
+                                       1,
+                                       (mavutil.mavlink.ADSB_FLAGS_VALID_COORDS |
+                                        mavutil.mavlink.ADSB_FLAGS_VALID_ALTITUDE |
+                                        mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY |
+                                        mavutil.mavlink.ADSB_FLAGS_VALID_HEADING),
+                                       self.squawk)
 
 class Track:
     def __init__(self, adsb_pkt):
@@ -67,11 +105,26 @@ class AsterixModule(mp_module.MPModule):
                                                         ('filter_time', int, 20),
                                                         ('wgs84_to_AMSL', float, -41.2),
                                                         ('filter_use_vehicle2', bool, True),
+                                                        ('max_batch', int, 200),
         ])
         self.add_completion_function('(ASTERIXSETTING)',
                                      self.asterix_settings.completion)
         self.sock = None
+        self.sock_timestamps = False
         self.tracks = {}
+
+        # ingest metrics
+        self.bad_packets = 0
+        self.records = 0
+        self.records_filtered = 0
+        self.batches = 0
+        self.batch_max = 0
+        self.batches_full = 0
+        self.batch_time = 0
+        self.batch_time_max = 0
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.latency_max = 0
         self.start_listener()
 
         # storage for vehicle positions, used for filtering
@@ -91,10 +144,25 @@ class AsterixModule(mp_module.MPModule):
         self.pkt_count = 0
         self.console.set_status('ASTX', 'ASTX --/--', row=6)
 
+    def unload(self):
+        '''close the socket when unloaded'''
+        self.stop_listener()
+
     def print_status(self):
         print("ADSB packets sent: %u" % self.adsb_packets_sent)
         print("ADSB packets not sent: %u" % self.adsb_packets_not_sent)
         print("ADSB bitrate: %u bytes/s" % int(self.adsb_byterate))
+        print("Asterix packets: %u bad: %u records: %u filtered before encoding: %u" % (
+            self.pkt_count, self.bad_packets, self.records, self.records_filtered))
+        if self.batches > 0:
+            print("Batches: %u mean size: %.1f max size: %u full: %u" % (
+                self.batches, (self.pkt_count + self.bad_packets) / float(self.batches),
+                self.batch_max, self.batches_full))
+            print("Batch time: mean %.2fms max %.2fms" % (
+                1000 * self.batch_time / self.batches, 1000 * self.batch_time_max))
+        if self.latency_count > 0:
+            print("Ingest latency: mean %.2fms max %.2fms" % (
+                1000 * self.latency_sum / self.latency_count, 1000 * self.latency_max))
 
     def cmd_asterix(self, args):
         '''asterix command parser'''
@@ -119,16 +187,28 @@ class AsterixModule(mp_module.MPModule):
     def start_listener(self):
         '''start listening for packets'''
         if self.sock is not None:
+            self.mpstate.unregister_fd(self.sock)
             self.sock.close()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock_timestamps = False
+        if SO_TIMESTAMP is not None:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+                self.sock_timestamps = True
+            except OSError:
+                pass
         self.sock.bind(('', self.asterix_settings.port))
         self.sock.setblocking(False)
+        # read packets as soon as they arrive, idle_task also reads
+        # in case the main loop is not waiting on the socket
+        self.mpstate.register_fd(self.sock, self.read_socket)
         print("Started on port %u" % self.asterix_settings.port)
 
     def stop_listener(self):
         '''stop listening for packets'''
         if self.sock is not None:
+            self.mpstate.unregister_fd(self.sock)
             self.sock.close()
             self.sock = None
         self.tracks = {}
@@ -190,14 +270,81 @@ class AsterixModule(mp_module.MPModule):
 
         return False
 
+    def recv_packet(self):
+        '''receive one datagram, returning (pkt, kernel receive time or None)'''
+        if not self.sock_timestamps:
+            return (self.sock.recv(10240), None)
+        (pkt, ancdata, flags, addr) = self.sock.recvmsg(10240, socket.CMSG_SPACE(struct.calcsize(TIMEVAL_FORMAT)))
+        for (level, ctype, data) in ancdata:
+            if level == socket.SOL_SOCKET and ctype == SO_TIMESTAMP and len(data) >= struct.calcsize(TIMEVAL_FORMAT):
+                (sec, usec) = struct.unpack_from(TIMEVAL_FORMAT, data)
+                return (pkt, sec + usec * 1.0e-6)
+        return (pkt, None)
+
+    def read_socket(self, args=None):
+        '''read all waiting packets, up to max_batch'''
+        if self.sock is None:
+            return
+        t0 = time.time()
+        count = 0
+        while count < self.asterix_settings.max_batch:
+            try:
+                (pkt, tstamp) = self.recv_packet()
+            except Exception:
+                break
+            count += 1
+            self.handle_packet(pkt)
+            if tstamp is not None:
+                latency = max(0, time.time() - tstamp)
+                self.latency_sum += latency
+                self.latency_count += 1
+                self.latency_max = max(self.latency_max, latency)
+        if count == 0:
+            return
+        dt = time.time() - t0
+        self.batches += 1
+        self.batch_max = max(self.batch_max, count)
+        if count >= self.asterix_settings.max_batch:
+            # more packets are waiting
+            self.batches_full += 1
+        self.batch_time += dt
+        self.batch_time_max = max(self.batch_time_max, dt)
+        self.console.set_status('ASTX', 'ASTX %u/%u' % (self.pkt_count, self.adsb_packets_sent), row=6)
+
     def idle_task(self):
         '''called on idle'''
         if self.sock is None:
             return
-        try:
-            pkt = self.sock.recv(10240)
-        except Exception:
-            return
+        self.read_socket()
+
+        now = time.time()
+        delta = now - self.adsb_byterate_update_timestamp
+        if delta > 5:
+            self.adsb_byterate_update_timestamp = now
+            bytes_per_adsb_packet = 38 # FIXME: find constant
+            self.adsb_byterate = (self.adsb_packets_sent - self.adsb_last_packets_sent)/delta * bytes_per_adsb_packet
+            self.adsb_last_packets_sent = self.adsb_packets_sent
+
+    def send_outputs(self, adsb_pkt):
+        '''forward a packet to the sysid outputs. Outputs with the same
+        source and sequence which are not signing get identical bytes,
+        so the packet is packed once for each of those profiles'''
+        packed = {}
+        for sysid in self.mpstate.sysid_outputs:
+            output = self.mpstate.sysid_outputs[sysid]
+            mav = output.mav
+            if mav.signing.sign_outgoing:
+                buf = adsb_pkt.pack(mav)
+            else:
+                profile = (mav.srcSystem, mav.srcComponent, mav.seq)
+                buf = packed.get(profile, None)
+                if buf is None:
+                    buf = adsb_pkt.pack(mav)
+                    packed[profile] = buf
+            output.write(buf)
+
+    def handle_packet(self, pkt):
+        '''handle one asterix datagram'''
         try:
             if pkt.startswith(b'PICKLED:'):
                 pkt = pkt[8:]
@@ -209,8 +356,8 @@ class AsterixModule(mp_module.MPModule):
             else:
                 amsg = asterix.parse(pkt)
             self.pkt_count += 1
-            self.console.set_status('ASTX', 'ASTX %u/%u' % (self.pkt_count, self.adsb_packets_sent), row=6)
         except Exception:
+            self.bad_packets += 1
             print("bad packet")
             return
         try:
@@ -218,7 +365,9 @@ class AsterixModule(mp_module.MPModule):
             self.logfile.write(logpkt)
         except Exception:
             pass
-        
+
+        adsb_mod = self.module('adsb')
+        tnow = self.get_time()
         for m in amsg:
             if self.asterix_settings.debug > 1:
                 print(m)
@@ -241,61 +390,46 @@ class AsterixModule(mp_module.MPModule):
             # asterix is WGS84, ArduPilot uses AMSL, which is EGM96
             alt_m += self.asterix_settings.wgs84_to_AMSL
 
-            # consider filtering this packet out; if it's not close to
-            # either home or the vehicle position don't send it
-            adsb_pkt = self.master.mav.adsb_vehicle_encode(icao_address,
-                                                           int(lat*1e7),
-                                                           int(lon*1e7),
-                                                           mavutil.mavlink.ADSB_ALTITUDE_TYPE_GEOMETRIC,
-                                                           int(alt_m*1000), # mm
-                                                           0, # heading
-                                                           0, # hor vel
-                                                           int(climb_rate_fps * 0.3048 * 100), # cm/s
-                                                           ("%08x" % icao_address).encode("ascii"),
-                                                           100 + (trkn // 10000),
-                                                           1,
-                                                           (mavutil.mavlink.ADSB_FLAGS_VALID_COORDS |
-                                                            mavutil.mavlink.ADSB_FLAGS_VALID_ALTITUDE |
-                                                            mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY |
-                                                            mavutil.mavlink.ADSB_FLAGS_VALID_HEADING),
-                                                           squawk)
+            record = AsterixRecord(icao_address, lat, lon, alt_m, climb_rate_fps,
+                                   100 + (trkn // 10000), squawk)
+            self.records += 1
             if icao_address in self.tracks:
-                self.tracks[icao_address].update(adsb_pkt, self.get_time())
+                self.tracks[icao_address].update(record, tnow)
             else:
-                self.tracks[icao_address] = Track(adsb_pkt)
+                self.tracks[icao_address] = Track(record)
+
+            # consider filtering this packet out; if it's not close to
+            # either home or the vehicle position don't send it
+            send = self.should_send_adsb_pkt(record)
+            if not send:
+                self.adsb_packets_not_sent += 1
+            if (not send and adsb_mod is None and not self.mpstate.sysid_outputs and
+                self.asterix_settings.debug == 0):
+                # nothing needs the packet, don't encode it
+                self.records_filtered += 1
+                continue
+
+            adsb_pkt = record.encode(self.master.mav)
             if self.asterix_settings.debug > 0:
                 print(adsb_pkt)
             # send on all links
-            if self.should_send_adsb_pkt(adsb_pkt):
+            if send:
                 self.adsb_packets_sent += 1
                 for i in range(len(self.mpstate.mav_master)):
                     conn = self.mpstate.mav_master[i]
                     #if adsb_pkt.hor_velocity < 1:
                     #    print(adsb_pkt)
                     conn.mav.send(adsb_pkt)
-            else:
-                self.adsb_packets_not_sent += 1
 
-            adsb_mod = self.module('adsb')
             if adsb_mod:
                 # the adsb module is loaded, display on the map
                 adsb_mod.mavlink_packet(adsb_pkt)
 
             try:
-                for sysid in self.mpstate.sysid_outputs:
-                    # fwd to sysid clients
-                    adsb_pkt.pack(self.mpstate.sysid_outputs[sysid].mav)
-                    self.mpstate.sysid_outputs[sysid].write(adsb_pkt.get_msgbuf())
+                # fwd to sysid clients
+                self.send_outputs(adsb_pkt)
             except Exception:
                 pass
-                
-        now = time.time()
-        delta = now - self.adsb_byterate_update_timestamp
-        if delta > 5:
-            self.adsb_byterate_update_timestamp = now
-            bytes_per_adsb_packet = 38 # FIXME: find constant
-            self.adsb_byterate = (self.adsb_packets_sent - self.adsb_last_packets_sent)/delta * bytes_per_adsb_packet
-            self.adsb_last_packets_sent = self.adsb_packets_sent
 
     def mavlink_packet(self, m):
         '''get time from mavlink ATTITUDE'''
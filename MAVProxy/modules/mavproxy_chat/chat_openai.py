@@ -640,29 +640,23 @@ class chat_openai():
         param_desc_dict['name'] = param_name
 
         # get description
-        param_desc_dict['description'] = param_info.get('documentation')
+        param_desc_dict['description'] = param_info.documentation
 
         # iterate over fields to get units and range
-        param_fields = param_info.find('field')
-        if param_fields is not None:
-            for field in param_info.field:
-                field_name = field.get('name')
-                if field_name == 'Units':
-                    param_desc_dict['units'] = str(field)
-                if field_name == 'Range':
-                    if ' ' in str(field):
-                        param_desc_dict['min'] = str(field).split(' ')[0]
-                        param_desc_dict['max'] = str(field).split(' ')[1]
+        for (field_name, field_value) in param_info.fields:
+            if field_name == 'Units':
+                param_desc_dict['units'] = field_value
+            if field_name == 'Range':
+                if ' ' in field_value:
+                    param_desc_dict['min'] = field_value.split(' ')[0]
+                    param_desc_dict['max'] = field_value.split(' ')[1]
 
         # iterate over values
-        param_values = param_info.find('values')
-        if param_values is not None:
-            param_value_dict = {}
-            for c in param_values.getchildren():
-                value_int = int(c.get('code'))
-                param_value_dict[value_int] = str(c)
-            if len(param_value_dict) > 0:
-                param_desc_dict['values'] = param_value_dict
+        param_value_dict = {}
+        for (code, text) in param_info.values:
+            param_value_dict[int(code)] = text
+        if len(param_value_dict) > 0:
+            param_desc_dict['values'] = param_value_dict
 
         # return dictionary
         return param_desc_dict
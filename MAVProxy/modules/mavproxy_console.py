@@ -11,6 +11,7 @@ from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import textconsole
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import wxsettings
@@ -25,6 +26,7 @@ class DisplayItem:
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         self.msg_types = set(re.findall(re_caps, expression))
         self.row = row
+        self.compiled = mp_expression.Expression(self.expression)
 
 class ConsoleModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -40,7 +42,7 @@ class ConsoleModule(mp_module.MPModule):
         self.safety_on = False
         self.unload_check_interval = 5 # seconds
         self.last_unload_check_time = time.time()
-        self.add_command('console', self.cmd_console, "console module", ['add','list','remove'])
+        self.add_command('console', self.cmd_console, "console module", ['add','list','remove','status'])
         mpstate.console = wxconsole.MessageConsole(title='Console')
 
         # setup some default status information
@@ -103,7 +105,7 @@ class ConsoleModule(mp_module.MPModule):
         self.shown_agl = False
 
     def cmd_console(self, args):
-        usage = 'usage: console <add|list|remove|menu|set>'
+        usage = 'usage: console <add|list|remove|menu|set|status>'
         if len(args) < 1:
             print(usage)
             return
@@ -133,6 +135,11 @@ class ConsoleModule(mp_module.MPModule):
             self.cmd_menu(args[1:])
         elif cmd == 'set':
             self.cmd_set(args[1:])
+        elif cmd == 'status':
+            if isinstance(self.console, wxconsole.MessageConsole):
+                print(self.console.status_report())
+            else:
+                print("No GUI console")
         else:
             print(usage)
 
@@ -397,8 +404,10 @@ class ConsoleModule(mp_module.MPModule):
             lng = master.field('GLOBAL_POSITION_INT', 'lon', 0) * 1.0e-7
             rel_alt = master.field('GLOBAL_POSITION_INT', 'relative_alt', 0) * 1.0e-3
             agl_alt = None
-            if self.module('terrain') is not None:
-                elevation_model = self.module('terrain').ElevationModel
+            # don't load a deferred terrain module just for this
+            terrain = self.mpstate.public_modules.get('terrain')
+            if terrain is not None:
+                elevation_model = terrain.ElevationModel
                 if self.settings.basealt != 0:
                     agl_alt = elevation_model.GetElevation(lat, lng)
                     if agl_alt is not None:
@@ -776,7 +785,7 @@ class ConsoleModule(mp_module.MPModule):
             if type in self.user_added[id].msg_types:
                 d = self.user_added[id]
                 try:
-                    val = mavutil.evaluate_expression(d.expression, self.master.messages)
+                    val = d.compiled.evaluate(self.master.messages)
                     console_string = d.format % val
                 except Exception as ex:
                     console_string = "????"
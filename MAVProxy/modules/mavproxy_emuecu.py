@@ -11,6 +11,7 @@ class EMUECUModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(EMUECUModule, self).__init__(mpstate, "emuecu", "emuecu", public=False)
+        self.subscribe_mavlink(types=['SERIAL_CONTROL'])
         self.emuecu_settings = mp_settings.MPSettings(
             [('port', int, 102)])
         self.add_command('emu', self.cmd_emu, 'EMUECU control',
@@ -222,6 +222,9 @@ class FenceModule(mission_item_protocol.MissionItemProtocolModule):
         elif self.enabled is True and self.healthy is False:
             self.console.set_status('Fence', 'FEN', row=0, fg='red')
 
+    def mavlink_types(self):
+        return super(FenceModule, self).mavlink_types() + ['SYS_STATUS']
+
     def mavlink_packet(self, m):
         if m.get_type() == 'SYS_STATUS' and self.message_is_from_primary_vehicle(m):
             self.handle_sys_status(m)
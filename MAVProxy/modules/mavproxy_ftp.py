@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 '''mavlink file transfer support'''
 
+import bisect
+import collections
 import io
+import mmap
 import time, os, sys
 import struct
 import random
@@ -52,6 +55,8 @@ ERR_FileNotFound = 10
 
 HDR_Len = 12
 MAX_Payload = 239
+# smallest packet size adaptive bursts go down to
+MIN_Burst = 32
 
 class FTP_OP:
     def __init__(self, seq, session, opcode, size, req_opcode, burst_complete, offset, payload):
@@ -94,9 +99,722 @@ class WriteQueue:
         self.size = size
         self.last_send = 0
 
+class GapTracker:
+    '''the byte ranges of a file received so far, kept as sorted
+    non-overlapping [start,end) intervals. Adding a payload and finding
+    the holes stay cheap however out of order the data arrives'''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.received = 0
+
+    def add(self, ofs, length):
+        '''add a range, returning the number of bytes not seen before'''
+        if length <= 0:
+            return 0
+        end = ofs + length
+        # intervals i..j-1 overlap or touch the new range
+        i = bisect.bisect_left(self.ends, ofs)
+        j = bisect.bisect_right(self.starts, end)
+        if i == j:
+            self.starts.insert(i, ofs)
+            self.ends.insert(i, end)
+            self.received += length
+            return length
+        covered = 0
+        for k in range(i, j):
+            covered += max(0, min(self.ends[k], end) - max(self.starts[k], ofs))
+        self.starts[i:j] = [min(ofs, self.starts[i])]
+        self.ends[i:j] = [max(end, self.ends[j-1])]
+        self.received += length - covered
+        return length - covered
+
+    def covered(self, ofs, length):
+        '''return True if a range has been received'''
+        i = bisect.bisect_right(self.starts, ofs) - 1
+        return i >= 0 and self.ends[i] >= ofs + length
+
+    def end(self):
+        '''return the end of the highest range received'''
+        if len(self.ends) == 0:
+            return 0
+        return self.ends[-1]
+
+    def gaps(self, limit, max_len):
+        '''yield (offset, length) holes below limit, split into pieces of
+        at most max_len bytes'''
+        pos = 0
+        for (start, end) in list(zip(self.starts, self.ends)) + [(limit, limit)]:
+            start = min(start, limit)
+            while pos < start:
+                n = min(max_len, start - pos)
+                yield (pos, n)
+                pos += n
+            pos = max(pos, end)
+            if pos >= limit:
+                break
+
+    def num_gaps(self, limit):
+        '''return the number of holes below limit'''
+        n = len([s for s in self.starts if 0 < s < limit])
+        if self.end() < limit:
+            n += 1
+        return n
+
+    def complete(self, size):
+        '''return True if everything below size has been received'''
+        if size == 0:
+            return True
+        return len(self.starts) > 0 and self.starts[0] == 0 and self.ends[0] >= size
+
+class TransferBuffer:
+    '''the data of a download. Payloads are stored at their offset in
+    memory, or in a memory mapped output file when the size is known,
+    so out of order data needs no seeking. Also acts as a read only
+    file object for progress callbacks'''
+    def __init__(self, size=None, filename=None):
+        self.pos = 0
+        self.length = 0
+        self.fh = None
+        self.mm = None
+        self.buf = bytearray()
+        if filename is not None and size:
+            self.fh = open(filename, 'w+b')
+            self.fh.truncate(size)
+            self.mm = mmap.mmap(self.fh.fileno(), size)
+            self.buf = self.mm
+
+    def unmap(self):
+        '''move the data from the memory map into memory'''
+        if self.mm is not None:
+            self.buf = bytearray(self.mm)
+            self.mm.close()
+            self.mm = None
+
+    def store(self, ofs, data):
+        '''store data at an offset'''
+        end = ofs + len(data)
+        if end > len(self.buf):
+            # the file has grown since it was opened
+            self.unmap()
+            self.buf.extend(bytes(end - len(self.buf)))
+        self.buf[ofs:end] = data
+        self.length = max(self.length, end)
+
+    def getvalue(self):
+        return bytes(self.buf[:self.length])
+
+    def save(self, filename):
+        '''write the data to a file'''
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+        elif self.fh is not None:
+            self.fh.seek(0)
+            self.fh.write(self.buf[:self.length])
+        else:
+            self.fh = open(filename, 'wb')
+            self.fh.write(self.buf[:self.length])
+        self.fh.truncate(self.length)
+        self.fh.close()
+        self.fh = None
+
+    def close(self):
+        '''discard the buffer'''
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, ofs, whence=0):
+        if whence == 1:
+            ofs += self.pos
+        elif whence == 2:
+            ofs += self.length
+        self.pos = max(0, ofs)
+        return self.pos
+
+    def read(self, n=-1):
+        end = self.length
+        if n is not None and n >= 0:
+            end = min(end, self.pos + n)
+        ret = bytes(self.buf[self.pos:end])
+        self.pos = max(self.pos, end)
+        return ret
+
+class RTTEstimator:
+    '''smoothed round trip time and retry timeout of the link, worked
+    out as TCP does. Only replies to requests sent once are used as
+    samples'''
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def sample(self, rtt):
+        '''add a round trip time sample'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
+
+    def timed_out(self):
+        '''back off after a request times out'''
+        self.backoff = min(self.backoff * 2, 8)
+
+    def timeout(self, initial):
+        '''return the retry timeout, initial is used until there are samples'''
+        if self.srtt is None:
+            return initial * self.backoff
+        return min(max(self.srtt + 4 * self.rttvar, 0.05), 2.0) * self.backoff
+
+class ReadTransfer:
+    '''a file download. The file is read with burst reads, and holes
+    left by lost packets are filled with a window of ReadFile requests'''
+    def __init__(self, ftp, remote, filename, callback=None, callback_progress=None):
+        self.ftp = ftp
+        self.remote = remote
+        self.filename = filename
+        self.callback = callback
+        self.callback_progress = callback_progress
+        self.session = None
+        self.opened = False
+        self.buf = None
+        self.gaps = GapTracker()
+        self.size = None
+        self.reached_eof = False
+        # offset -> [length, send time, tries, send number] of ReadFile requests
+        self.pending = {}
+        self.sends = 0
+        self.burst_size = min(max(ftp.ftp_settings.burst_read_size, 1), MAX_Payload)
+        self.burst_req = self.burst_size
+        self.burst_max = self.burst_size
+        self.burst_adapt = True
+        self.burst_recv = 0
+        self.burst_lost = 0
+        self.last_burst_read = None
+        self.open_time = None
+        self.open_retries = 0
+        self.start_time = None
+        self.retries = 0
+        self.duplicates = 0
+        self.gap_reads = 0
+
+    def name(self):
+        return self.remote
+
+    def session_open(self):
+        return self.opened
+
+    def start(self, session):
+        '''open the remote file'''
+        self.session = session
+        self.start_time = time.time()
+        self.open_time = self.start_time
+        self.send_open()
+
+    def send_open(self):
+        enc_fname = bytearray(self.remote, 'ascii')
+        self.ftp.send(FTP_OP(self.ftp.seq, self.session, OP_OpenFileRO, len(enc_fname), 0, 0, 0, enc_fname))
+
+    def handle_reply(self, op):
+        if op.req_opcode == OP_OpenFileRO:
+            self.handle_open_reply(op)
+        elif op.req_opcode == OP_BurstReadFile:
+            self.handle_burst_read(op)
+        elif op.req_opcode == OP_ReadFile:
+            self.handle_reply_read(op)
+
+    def handle_open_reply(self, op):
+        '''handle OP_OpenFileRO reply'''
+        if self.opened:
+            return
+        if op.opcode == OP_Ack:
+            self.opened = True
+            if self.open_retries == 0:
+                self.ftp.rtt.sample(time.time() - self.open_time)
+            if self.buf is not None:
+                # reopened after the server lost our session
+                if self.reached_eof:
+                    self.send_gap_reads(time.time())
+                else:
+                    self.send_burst(self.gaps.end())
+                return
+            if op.size >= 4:
+                self.size, = struct.unpack("<I", op.payload[0:4])
+            try:
+                if self.callback is not None or self.filename == '-':
+                    self.buf = TransferBuffer()
+                else:
+                    self.buf = TransferBuffer(self.size, self.filename)
+            except Exception as ex:
+                print("Failed to open %s: %s" % (self.filename, ex))
+                self.fail()
+                return
+            self.send_burst(0)
+        elif self.ftp.open_refused(self, op):
+            return
+        else:
+            if self.callback is None or self.ftp.ftp_settings.debug > 0:
+                print("ftp open failed")
+            self.fail()
+
+    def send_burst(self, offset):
+        '''ask for a burst of data from an offset'''
+        self.burst_req = self.burst_size
+        self.last_burst_read = time.time()
+        self.ftp.send(FTP_OP(self.ftp.seq, self.session, OP_BurstReadFile, self.burst_req, 0, 0, offset, None))
+
+    def adapt_burst(self):
+        '''change the packet size of bursts to suit the packet loss seen
+        in the last bursts. Only done when the file size is known, as
+        otherwise a short packet is how the end of the file is found'''
+        if not self.ftp.ftp_settings.burst_adapt or not self.burst_adapt or self.size is None:
+            return
+        total = self.burst_recv + self.burst_lost
+        if total < 8 * self.burst_size:
+            return
+        loss = self.burst_lost / float(total)
+        size = self.burst_size
+        if loss > 0.1:
+            size = max(MIN_Burst, int(size * 0.7))
+        elif loss < 0.02:
+            size = min(MAX_Payload, size + 32)
+        self.burst_recv = 0
+        self.burst_lost = 0
+        if size != self.burst_size:
+            if self.ftp.ftp_settings.debug > 0:
+                print("FTP: burst size %u loss %.1f%%" % (size, loss * 100))
+            self.burst_size = size
+            self.burst_max = max(self.burst_max, size)
+
+    def store(self, op):
+        '''store the payload of a reply'''
+        new = self.gaps.add(op.offset, len(op.payload))
+        if new == 0:
+            self.duplicates += 1
+            if self.ftp.ftp_settings.debug > 0:
+                print("FTP: dup read reply at %u of len %u" % (op.offset, op.size))
+            return
+        self.buf.store(op.offset, op.payload)
+        self.ftp.bytes_received += new
+        if self.callback_progress is not None:
+            self.callback_progress(self.buf, self.gaps.received)
+
+    def handle_burst_read(self, op):
+        '''handle OP_BurstReadFile reply'''
+        if self.buf is None:
+            return
+        self.last_burst_read = time.time()
+        size = len(op.payload)
+        if op.opcode == OP_Ack:
+            if size > self.burst_max:
+                # this server doesn't handle the burst size argument
+                self.burst_size = MAX_Payload
+                self.burst_max = MAX_Payload
+                self.burst_adapt = False
+                if self.ftp.ftp_settings.debug > 0:
+                    print("Setting burst size to %u" % self.burst_size)
+            end = self.gaps.end()
+            if op.offset > end:
+                self.burst_lost += op.offset - end
+            self.burst_recv += size
+            self.store(op)
+            if op.burst_complete:
+                if op.size > 0 and op.size < self.burst_req and (self.size is None or op.offset + op.size >= self.size):
+                    # a burst complete with non-zero size and less than burst packet size
+                    # means EOF
+                    self.set_eof()
+                    return
+                if op.offset + op.size < self.gaps.end():
+                    # the end of a burst we have already moved past
+                    return
+                self.adapt_burst()
+                if self.ftp.ftp_settings.debug > 0:
+                    print("FTP: burst continue at %u" % (op.offset + op.size))
+                self.send_burst(op.offset + op.size)
+        elif op.opcode == OP_Nack:
+            ecode = op.payload[0]
+            if self.ftp.ftp_settings.debug > 0:
+                print("FTP: burst nack: ", op)
+            if ecode == ERR_EndOfFile or ecode == 0:
+                if not self.reached_eof and op.offset > self.gaps.end() and self.size is None:
+                    # we lost the last part of the burst, with no file
+                    # size the stall retry has to find the end
+                    if self.ftp.ftp_settings.debug > 0:
+                        print("burst lost EOF %u %u" % (self.gaps.end(), op.offset))
+                    return
+                self.set_eof()
+            elif ecode == ERR_InvalidSession:
+                self.reopen()
+            elif self.ftp.ftp_settings.debug > 0:
+                print("FTP: burst Nack (ecode:%u): %s" % (ecode, op))
+        else:
+            print("FTP: burst error: %s" % op)
+
+    def reopen(self):
+        '''open the file again in a new session, keeping what has been
+        received so far'''
+        if not self.opened:
+            return
+        if self.ftp.ftp_settings.debug > 0:
+            print("FTP: reopening %s" % self.remote)
+        self.opened = False
+        self.pending = {}
+        self.open_time = time.time()
+        self.ftp.new_session(self)
+        self.send_open()
+
+    def set_eof(self):
+        '''the burst has reached the end of the file'''
+        if not self.reached_eof and self.ftp.ftp_settings.debug > 0:
+            print("EOF at %u with %u gaps t=%.2f" % (self.gaps.end(), self.gaps.num_gaps(self.limit()),
+                                                     time.time() - self.start_time))
+        self.reached_eof = True
+        if self.check_finished():
+            return
+        self.send_gap_reads(time.time())
+
+    def handle_reply_read(self, op):
+        '''handle OP_ReadFile reply'''
+        if self.buf is None:
+            return
+        now = time.time()
+        p = self.pending.pop(op.offset, None)
+        if op.opcode == OP_Ack:
+            if p is not None:
+                if p[2] == 1:
+                    self.ftp.rtt.sample(now - p[1])
+                self.store(op)
+                self.resend_lost(p[3], now)
+            else:
+                self.store(op)
+            if self.check_finished():
+                return
+        elif op.opcode == OP_Nack and len(op.payload) > 0 and op.payload[0] == ERR_InvalidSession:
+            self.reopen()
+            return
+        elif op.opcode == OP_Nack:
+            print("Read failed with %u gaps" % self.gaps.num_gaps(self.limit()), str(op))
+            self.fail()
+            return
+        self.send_gap_reads(now)
+
+    def limit(self):
+        '''return the offset below which holes should be filled'''
+        if self.size is not None and self.reached_eof:
+            return max(self.size, self.gaps.end())
+        return self.gaps.end()
+
+    def send_gap_reads(self, now):
+        '''retry timed out reads of holes and send new ones, keeping up
+        to max_backlog reads outstanding'''
+        settings = self.ftp.ftp_settings
+        timeout = self.ftp.rtt.timeout(settings.retry_time)
+        timed_out = False
+        for (ofs, p) in list(self.pending.items()):
+            if now - p[1] < timeout:
+                continue
+            if self.gaps.covered(ofs, p[0]):
+                self.pending.pop(ofs)
+                continue
+            timed_out = True
+            self.retries += 1
+            self.ftp.retries += 1
+            self.send_gap_read(ofs, p, now)
+        if timed_out:
+            self.ftp.rtt.timed_out()
+        window = max(settings.max_backlog, 1)
+        if len(self.pending) >= window:
+            return
+        for (ofs, length) in self.gaps.gaps(self.limit(), self.burst_size):
+            if ofs in self.pending:
+                continue
+            p = [length, now, 0, 0]
+            self.pending[ofs] = p
+            self.send_gap_read(ofs, p, now)
+            if len(self.pending) >= window:
+                break
+
+    def resend_lost(self, sent, now):
+        '''replies come back in the order the requests were sent, so
+        reads sent before the one just answered have been lost'''
+        for (ofs, p) in list(self.pending.items()):
+            if p[3] >= sent:
+                continue
+            if self.gaps.covered(ofs, p[0]):
+                self.pending.pop(ofs)
+                continue
+            self.retries += 1
+            self.ftp.retries += 1
+            self.send_gap_read(ofs, p, now)
+
+    def send_gap_read(self, ofs, p, now):
+        '''send a read for a hole'''
+        if self.ftp.ftp_settings.debug > 0:
+            print("Gap read of %u at %u pending=%u" % (p[0], ofs, len(self.pending)))
+        self.sends += 1
+        p[1] = now
+        p[2] += 1
+        p[3] = self.sends
+        self.gap_reads += 1
+        self.ftp.send(FTP_OP(self.ftp.seq, self.session, OP_ReadFile, p[0], 0, 0, ofs, None))
+
+    def check(self, now):
+        '''check for lost replies'''
+        if not self.opened:
+            # see if we lost an open reply, waiting longer each time
+            if now - self.open_time > 2**self.open_retries:
+                self.open_time = now
+                self.open_retries += 1
+                if self.open_retries > 2:
+                    self.fail()
+                    return
+                if self.ftp.ftp_settings.debug > 0:
+                    print("FTP: retry open")
+                self.ftp.new_session(self)
+                self.send_open()
+            return
+        # see if burst read has stalled
+        stall_time = max(self.ftp.rtt.timeout(self.ftp.ftp_settings.retry_time), 0.2)
+        if not self.reached_eof and now - self.last_burst_read > stall_time:
+            if self.ftp.ftp_settings.debug > 0:
+                print("Retry read at %u dt=%.2f" % (self.gaps.end(), now - self.last_burst_read))
+            self.retries += 1
+            self.ftp.retries += 1
+            self.send_burst(self.gaps.end())
+        self.send_gap_reads(now)
+
+    def check_finished(self):
+        '''check if download has completed'''
+        if not self.reached_eof or not self.gaps.complete(self.limit()):
+            return False
+        size = self.buf.length
+        dt = time.time() - self.start_time
+        rate = (size / dt) / 1024.0
+        if self.callback is not None:
+            fh = SIO(self.buf.getvalue())
+            self.buf.close()
+            self.callback(fh)
+            self.callback = None
+        elif self.filename == "-":
+            data = self.buf.getvalue()
+            if sys.version_info.major < 3:
+                print(data)
+            else:
+                print(data.decode('utf-8'))
+        else:
+            try:
+                self.buf.save(self.filename)
+            except Exception as ex:
+                print("Failed to write %s: %s" % (self.filename, ex))
+                self.fail()
+                return True
+            print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (size, self.filename, dt, rate))
+        self.ftp.transfer_done(self, True)
+        return True
+
+    def fail(self):
+        '''abandon the download'''
+        if self.buf is not None:
+            self.buf.close()
+        if self.callback is not None:
+            # tell caller that the transfer failed
+            self.callback(None)
+            self.callback = None
+        self.ftp.transfer_done(self, False)
+
+    def status(self):
+        dt = max(time.time() - self.start_time, 0.001)
+        if self.size is None:
+            size = "?"
+        else:
+            size = "%u" % self.size
+        return "get %s: %u/%s bytes %u gaps %u pending %u retries %u dups burst %u %.1f kByte/sec" % (
+            self.remote, self.gaps.received, size, self.gaps.num_gaps(self.limit()), len(self.pending),
+            self.retries, self.duplicates, self.burst_size, (self.gaps.received / dt) / 1024.0)
+
+class WriteTransfer:
+    '''a file upload, keeping up to write_qsize writes outstanding'''
+    def __init__(self, ftp, fh, remote, callback=None, progress_callback=None):
+        self.ftp = ftp
+        fh.seek(0)
+        self.data = fh.read()
+        self.remote = remote
+        self.callback = callback
+        self.progress_callback = progress_callback
+        self.session = None
+        self.block_size = ftp.ftp_settings.write_size
+        self.total = (len(self.data) + self.block_size - 1) // self.block_size
+        self.next_block = 0
+        # block -> [send time, tries, send number]
+        self.pending = {}
+        self.sends = 0
+        self.acks = 0
+        self.created = False
+        self.open_time = None
+        self.open_retries = 0
+        self.start_time = None
+        self.retries = 0
+        self.duplicates = 0
+
+    def name(self):
+        return self.remote
+
+    def session_open(self):
+        return self.created
+
+    def start(self, session):
+        '''create the remote file'''
+        self.session = session
+        self.start_time = time.time()
+        self.open_time = self.start_time
+        self.send_create()
+
+    def send_create(self):
+        enc_fname = bytearray(self.remote, 'ascii')
+        self.ftp.send(FTP_OP(self.ftp.seq, self.session, OP_CreateFile, len(enc_fname), 0, 0, 0, enc_fname))
+
+    def handle_reply(self, op):
+        if op.req_opcode == OP_CreateFile:
+            self.handle_create_file_reply(op)
+        elif op.req_opcode == OP_WriteFile:
+            self.handle_write_reply(op)
+
+    def handle_create_file_reply(self, op):
+        '''handle OP_CreateFile reply'''
+        if self.created:
+            return
+        if op.opcode == OP_Ack:
+            self.created = True
+            if self.open_retries == 0:
+                self.ftp.rtt.sample(time.time() - self.open_time)
+            self.send_more_writes(time.time())
+        elif self.ftp.open_refused(self, op):
+            return
+        else:
+            print("Create failed")
+            self.fail()
+
+    def send_more_writes(self, now):
+        '''retry timed out writes and send some more'''
+        if self.acks == self.total:
+            # all done
+            self.finish()
+            return
+        timeout = self.ftp.rtt.timeout(self.ftp.ftp_settings.retry_time)
+        timed_out = False
+        for (idx, p) in list(self.pending.items()):
+            if now - p[0] >= timeout:
+                timed_out = True
+                self.retries += 1
+                self.ftp.retries += 1
+                self.send_write(idx, p, now)
+        if timed_out:
+            self.ftp.rtt.timed_out()
+        while len(self.pending) < max(self.ftp.ftp_settings.write_qsize, 1) and self.next_block < self.total:
+            p = [now, 0, 0]
+            self.pending[self.next_block] = p
+            self.send_write(self.next_block, p, now)
+            self.next_block += 1
+
+    def send_write(self, idx, p, now):
+        ofs = idx * self.block_size
+        data = self.data[ofs:ofs+self.block_size]
+        self.sends += 1
+        p[0] = now
+        p[1] += 1
+        p[2] = self.sends
+        self.ftp.send(FTP_OP(self.ftp.seq, self.session, OP_WriteFile, len(data), 0, 0, ofs, bytearray(data)))
+
+    def handle_write_reply(self, op):
+        '''handle OP_WriteFile reply'''
+        if op.opcode != OP_Ack:
+            print("Write failed")
+            self.fail()
+            return
+        now = time.time()
+        p = self.pending.pop(op.offset // self.block_size, None)
+        if p is None:
+            self.duplicates += 1
+            return
+        if p[1] == 1:
+            self.ftp.rtt.sample(now - p[0])
+        # replies come back in the order the writes were sent, so
+        # writes sent before this one have been lost
+        for (idx, lost) in list(self.pending.items()):
+            if lost[2] < p[2]:
+                self.retries += 1
+                self.ftp.retries += 1
+                self.send_write(idx, lost, now)
+        self.acks += 1
+        self.ftp.bytes_sent += min(self.block_size, len(self.data) - op.offset)
+        if self.progress_callback:
+            self.progress_callback(self.acks/float(self.total))
+        self.send_more_writes(now)
+
+    def check(self, now):
+        '''check for lost replies'''
+        if not self.created:
+            if now - self.open_time > 2**self.open_retries:
+                self.open_time = now
+                self.open_retries += 1
+                if self.open_retries > 2:
+                    print("Create failed")
+                    self.fail()
+                    return
+                self.ftp.new_session(self)
+                self.send_create()
+            return
+        self.send_more_writes(now)
+
+    def finish(self):
+        '''finish a put'''
+        flen = len(self.data)
+        if self.progress_callback:
+            self.progress_callback(1.0)
+            self.progress_callback = None
+        if self.callback is not None:
+            self.callback(flen)
+            self.callback = None
+        else:
+            print("Sent file of length ", flen)
+        self.ftp.transfer_done(self, True)
+
+    def fail(self):
+        '''abandon the upload'''
+        if self.callback is not None:
+            # tell caller that the transfer failed
+            self.callback(None)
+            self.callback = None
+        if self.progress_callback is not None:
+            self.progress_callback(None)
+            self.progress_callback = None
+        self.ftp.transfer_done(self, False)
+
+    def status(self):
+        dt = max(time.time() - self.start_time, 0.001)
+        done = min(self.acks * self.block_size, len(self.data))
+        return "put %s: %u/%u bytes %u pending %u retries %u dups %.1f kByte/sec" % (
+            self.remote, done, len(self.data), len(self.pending), self.retries, self.duplicates,
+            (done / dt) / 1024.0)
+
+# replies which belong to the session of a transfer
+SESSION_OPS = [OP_OpenFileRO, OP_ReadFile, OP_BurstReadFile, OP_CreateFile, OP_WriteFile]
+
 class FTPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FTPModule, self).__init__(mpstate, "ftp", public=True)
+        self.subscribe_mavlink(types=['FILE_TRANSFER_PROTOCOL'])
         self.add_command('ftp', self.cmd_ftp, "file transfer",
                          ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
                           "set (FTPSETTING)",
@@ -107,46 +825,36 @@ class FTPModule(mp_module.MPModule):
              ('pkt_loss_rx', int, 0),
              ('max_backlog', int, 5),
              ('burst_read_size', int, 80),
+             ('burst_adapt', int, 1),
              ('write_size', int, 80),
              ('write_qsize', int, 5),
-             ('retry_time', float, 0.5)])
+             ('retry_time', float, 0.5),
+             ('max_sessions', int, 1)])
         self.add_completion_function('(FTPSETTING)',
                                      self.ftp_settings.completion)
         self.seq = 0
         self.session = 0
         self.network = 0
         self.last_op = None
-        self.fh = None
-        self.filename = None
-        self.callback = None
-        self.callback_progress = None
-        self.put_callback = None
-        self.put_callback_progress = None
+        self.list_op = None
+        self.crc_name = None
+        self.crc_start = None
         self.total_size = 0
-        self.read_gaps = []
-        self.read_gap_times = {}
-        self.last_gap_send = 0
-        self.read_retries = 0
-        self.read_total = 0
-        self.duplicates = 0
-        self.last_read = None
-        self.last_burst_read = None
-        self.op_start = None
         self.dir_offset = 0
         self.last_op_time = time.time()
-        self.rtt = 0.5
-        self.reached_eof = False
-        self.backlog = 0
-        self.burst_size = self.ftp_settings.burst_read_size
-        self.write_list = None
-        self.write_block_size = 0
-        self.write_acks = 0
-        self.write_total = 0
-        self.write_file_size = 0
-        self.write_idx = 0
-        self.write_recv_idx = -1
-        self.write_pending = 0
-        self.write_last_send = None
+        self.rtt = RTTEstimator()
+        # transfers by session, and those waiting for a session
+        self.transfers = {}
+        self.queue = collections.deque()
+        # sessions given up on, replies to these are ignored
+        self.retired = set()
+        # lowered when the server refuses a second session
+        self.session_limit = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.completed = 0
+        self.failed = 0
         self.warned_component = False
 
     def cmd_ftp(self, args):
@@ -198,34 +906,70 @@ class FTPModule(mp_module.MPModule):
             print("> %s dt=%.2f" % (op, now - self.last_op_time))
         self.last_op_time = time.time()
 
-    def terminate_session(self):
-        '''terminate current session'''
-        self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
-        self.fh = None
-        self.filename = None
-        self.write_list = None
-        if self.callback is not None:
-            # tell caller that the transfer failed
-            self.callback(None)
-            self.callback = None
-        if self.put_callback is not None:
-            # tell caller that the transfer failed
-            self.put_callback(None)
-            self.put_callback = None
-        if self.put_callback_progress is not None:
-            self.put_callback_progress(None)
-            self.put_callback_progress = None
-        self.read_gaps = []
-        self.read_total = 0
-        self.read_gap_times = {}
-        self.last_read = None
-        self.last_burst_read = None
-        self.session = (self.session + 1) % 256
-        self.reached_eof = False
-        self.backlog = 0
-        self.duplicates = 0
+    def terminate_session(self, session):
+        '''terminate a session'''
+        self.send(FTP_OP(self.seq, session, OP_TerminateSession, 0, 0, 0, 0, None))
         if self.ftp_settings.debug > 0:
-            print("Terminated session")
+            print("Terminated session %u" % session)
+
+    def new_session(self, transfer):
+        '''give a transfer a new session, ending any old one'''
+        if transfer.session is not None:
+            self.terminate_session(transfer.session)
+            self.transfers.pop(transfer.session, None)
+            self.retired.add(transfer.session)
+        while True:
+            self.session = (self.session + 1) % 256
+            if self.session not in self.transfers:
+                break
+        self.retired.discard(self.session)
+        transfer.session = self.session
+        self.transfers[self.session] = transfer
+
+    def add_transfer(self, transfer):
+        '''queue a transfer, starting it if a session is free'''
+        self.queue.append(transfer)
+        self.start_queued()
+
+    def max_transfers(self):
+        limit = max(self.ftp_settings.max_sessions, 1)
+        if self.session_limit is not None:
+            limit = min(limit, self.session_limit)
+        return limit
+
+    def start_queued(self):
+        '''start queued transfers while sessions are free'''
+        while len(self.queue) > 0 and len(self.transfers) < self.max_transfers():
+            transfer = self.queue.popleft()
+            transfer.session = None
+            self.new_session(transfer)
+            transfer.start(transfer.session)
+
+    def open_refused(self, transfer, op):
+        '''see if an open failed because the server has no free session.
+        If so the transfer goes back on the queue, returning True'''
+        if len(self.transfers) < 2 or len(op.payload) < 1:
+            return False
+        if op.payload[0] not in [ERR_Fail, ERR_NoSessionsAvailable]:
+            return False
+        self.transfers.pop(transfer.session, None)
+        self.session_limit = max(1, len(self.transfers))
+        if self.ftp_settings.debug > 0:
+            print("FTP: limiting to %u sessions" % self.session_limit)
+        self.queue.appendleft(transfer)
+        return True
+
+    def transfer_done(self, transfer, success):
+        '''a transfer has finished or failed'''
+        if self.transfers.get(transfer.session, None) is transfer:
+            self.transfers.pop(transfer.session)
+            self.retired.add(transfer.session)
+            self.terminate_session(transfer.session)
+        if success:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.start_queued()
 
     def cmd_list(self, args):
         '''list files'''
@@ -237,8 +981,8 @@ class FTPModule(mp_module.MPModule):
         enc_dname = bytearray(dname, 'ascii')
         self.total_size = 0
         self.dir_offset = 0
-        op = FTP_OP(self.seq, self.session, OP_ListDirectory, len(enc_dname), 0, 0, self.dir_offset, enc_dname)
-        self.send(op)
+        self.list_op = FTP_OP(self.seq, self.session, OP_ListDirectory, len(enc_dname), 0, 0, self.dir_offset, enc_dname)
+        self.send(self.list_op)
 
     def handle_list_reply(self, op, m):
         '''handle OP_ListDirectory reply'''
@@ -266,348 +1010,52 @@ class FTPModule(mp_module.MPModule):
                 else:
                     print(d)
             # ask for more
-            more = self.last_op
-            more.offset = self.dir_offset
-            self.send(more)
+            if self.list_op is not None:
+                self.list_op.offset = self.dir_offset
+                self.send(self.list_op)
         elif op.opcode == OP_Nack and len(op.payload) == 1 and op.payload[0] == ERR_EndOfFile:
             print("Total size %.2f kByte" % (self.total_size / 1024.0))
             self.total_size = 0
+            self.list_op = None
         else:
             print('LIST: %s' % op)
 
     def cmd_get(self, args, callback=None, callback_progress=None):
-        '''get file'''
+        '''get file. Downloads are queued and run up to max_sessions at a time'''
         if len(args) == 0:
             print("Usage: get FILENAME <LOCALNAME>")
             return
-        self.terminate_session()
         fname = args[0]
         if len(args) > 1:
-            self.filename = args[1]
+            filename = args[1]
         else:
-            self.filename = os.path.basename(fname)
+            filename = os.path.basename(fname)
         if callback is None or self.ftp_settings.debug > 1:
-            print("Getting %s as %s" % (fname, self.filename))
-        self.op_start = time.time()
-        self.callback = callback
-        self.callback_progress = callback_progress
-        self.read_retries = 0
-        self.duplicates = 0
-        self.reached_eof = False
-        self.burst_size = self.ftp_settings.burst_read_size
-        if self.burst_size < 1:
-            self.burst_size = 239
-        elif self.burst_size > 239:
-            self.burst_size = 239
-        enc_fname = bytearray(fname, 'ascii')
-        self.open_retries = 0
-        op = FTP_OP(self.seq, self.session, OP_OpenFileRO, len(enc_fname), 0, 0, 0, enc_fname)
-        self.send(op)
-
-    def handle_open_RO_reply(self, op, m):
-        '''handle OP_OpenFileRO reply'''
-        if op.opcode == OP_Ack:
-            if self.filename is None:
-                return
-            try:
-                if self.callback is not None or self.filename == '-':
-                    self.fh = SIO()
-                else:
-                    self.fh = open(self.filename, 'wb')
-            except Exception as ex:
-                print("Failed to open %s: %s" % (self.filename, ex))
-                self.terminate_session()
-                return
-            read = FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, 0, None)
-            self.last_burst_read = time.time()
-            self.send(read)
-        else:
-            if self.callback is None or self.ftp_settings.debug > 0:
-                print("ftp open failed")
-            self.terminate_session()
-
-    def check_read_finished(self):
-        '''check if download has completed'''
-        if self.reached_eof and len(self.read_gaps) == 0:
-            ofs = self.fh.tell()
-            dt = time.time() - self.op_start
-            rate = (ofs / dt) / 1024.0
-            if self.callback is not None:
-                self.fh.seek(0)
-                self.callback(self.fh)
-                self.callback = None
-            elif self.filename == "-":
-                self.fh.seek(0)
-                if sys.version_info.major < 3:
-                    print(self.fh.read())
-                else:
-                    print(self.fh.read().decode('utf-8'))
-            else:
-                print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (ofs, self.filename, dt, rate))
-            self.terminate_session()
-            return True
-        return False
+            print("Getting %s as %s" % (fname, filename))
+        self.add_transfer(ReadTransfer(self, fname, filename, callback, callback_progress))
 
-    def write_payload(self, op):
-        '''write payload from a read op'''
-        self.fh.seek(op.offset)
-        self.fh.write(op.payload)
-        self.read_total += len(op.payload)
-        if self.callback_progress is not None:
-            self.callback_progress(self.fh, self.read_total)
-    
-    def handle_burst_read(self, op, m):
-        '''handle OP_BurstReadFile reply'''
-        if self.ftp_settings.pkt_loss_tx > 0:
-            if random.uniform(0,100) < self.ftp_settings.pkt_loss_tx:
-                if self.ftp_settings.debug > 0:
-                    print("FTP: dropping TX")
-                return
-        if self.fh is None or self.filename is None:
-            if op.session != self.session:
-                # old session
-                return
-            print("FTP Unexpected burst read reply")
-            print(op)
-            return
-        self.last_burst_read = time.time()
-        size = len(op.payload)
-        if size > self.burst_size:
-            # this server doesn't handle the burst size argument
-            self.burst_size = MAX_Payload
-            if self.ftp_settings.debug > 0:
-                print("Setting burst size to %u" % self.burst_size)
-        if op.opcode == OP_Ack and self.fh is not None:
-            ofs = self.fh.tell()
-            if op.offset < ofs:
-                # writing an earlier portion, possibly remove a gap
-                gap = (op.offset, len(op.payload))
-                if gap in self.read_gaps:
-                    self.read_gaps.remove(gap)
-                    self.read_gap_times.pop(gap)
-                    if self.ftp_settings.debug > 0:
-                        print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
-                else:
-                    if self.ftp_settings.debug > 0:
-                        print("FTP: dup read reply at %u of len %u ofs=%u" % (op.offset, op.size, self.fh.tell()))
-                    self.duplicates += 1
-                    return
-                self.write_payload(op)
-                self.fh.seek(ofs)
-                if self.check_read_finished():
-                    return
-            elif op.offset > ofs:
-                # we have a gap
-                gap = (ofs, op.offset-ofs)
-                max_read = self.burst_size
-                while True:
-                    if gap[1] <= max_read:
-                        self.read_gaps.append(gap)
-                        self.read_gap_times[gap] = 0
-                        break
-                    g = (gap[0], max_read)
-                    self.read_gaps.append(g)
-                    self.read_gap_times[g] = 0
-                    gap = (gap[0] + max_read, gap[1] - max_read)
-                self.write_payload(op)
-            else:
-                self.write_payload(op)
-            if op.burst_complete:
-                if op.size > 0 and op.size < self.burst_size:
-                    # a burst complete with non-zero size and less than burst packet size
-                    # means EOF
-                    if not self.reached_eof and self.ftp_settings.debug > 0:
-                        print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
-                    self.reached_eof = True
-                    if self.check_read_finished():
-                        return
-                    self.check_read_send()
-                    return
-                more = self.last_op
-                more.offset = op.offset + op.size
-                if self.ftp_settings.debug > 0:
-                    print("FTP: burst continue at %u %u" % (more.offset, self.fh.tell()))
-                self.send(more)
-        elif op.opcode == OP_Nack:
-            ecode = op.payload[0]
-            if self.ftp_settings.debug > 0:
-                print("FTP: burst nack: ", op)
-            if ecode == ERR_EndOfFile or ecode == 0:
-                if not self.reached_eof and op.offset > self.fh.tell():
-                    # we lost the last part of the burst
-                    if self.ftp_settings.debug > 0:
-                        print("burst lost EOF %u %u" % (self.fh.tell(), op.offset))
-                    return
-                if not self.reached_eof and self.ftp_settings.debug > 0:
-                    print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
-                self.reached_eof = True
-                if self.check_read_finished():
-                    return
-                self.check_read_send()
-            elif self.ftp_settings.debug > 0:
-                print("FTP: burst Nack (ecode:%u): %s" % (ecode, op))
-        else:
-            print("FTP: burst error: %s" % op)
-
-    def handle_reply_read(self, op, m):
-        '''handle OP_ReadFile reply'''
-        if self.fh is None or self.filename is None:
-            if self.ftp_settings.debug > 0:
-                print("FTP Unexpected read reply")
-                print(op)
-            return
-        if self.backlog > 0:
-            self.backlog -= 1
-        if op.opcode == OP_Ack and self.fh is not None:
-            gap = (op.offset, op.size)
-            if gap in self.read_gaps:
-                self.read_gaps.remove(gap)
-                self.read_gap_times.pop(gap)
-                ofs = self.fh.tell()
-                self.write_payload(op)
-                self.fh.seek(ofs)
-                if self.ftp_settings.debug > 0:
-                    print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
-                if self.check_read_finished():
-                    return
-            elif op.size < self.burst_size:
-                print("FTP: file size changed to %u" % op.offset+op.size)
-                self.terminate_session()
-            else:
-                self.duplicates += 1
-                if self.ftp_settings.debug > 0:
-                    print("FTP: no gap read", gap, len(self.read_gaps))
-        elif op.opcode == OP_Nack:
-            print("Read failed with %u gaps" % len(self.read_gaps), str(op))
-            self.terminate_session()
-        self.check_read_send()
-            
     def cmd_put(self, args, fh=None, callback=None, progress_callback=None):
         '''put file'''
         if len(args) == 0:
             print("Usage: put FILENAME <REMOTENAME>")
             return
-        if self.write_list is not None:
-            print("put already in progress")
-            return
         fname = args[0]
-        self.fh = fh
-        if self.fh is None:
+        if fh is None:
             try:
-                self.fh = open(fname, 'rb')
+                with open(fname, 'rb') as f:
+                    fh = SIO(f.read())
             except Exception as ex:
                 print("Failed to open %s: %s" % (fname, ex))
                 return
         if len(args) > 1:
-            self.filename = args[1]
+            remote = args[1]
         else:
-            self.filename = os.path.basename(fname)
-        if self.filename.endswith("/"):
-            self.filename += os.path.basename(fname)
+            remote = os.path.basename(fname)
+        if remote.endswith("/"):
+            remote += os.path.basename(fname)
         if callback is None:
-            print("Putting %s as %s" % (fname, self.filename))
-        self.fh.seek(0,2)
-        file_size = self.fh.tell()
-        self.fh.seek(0)
-
-        # setup write list
-        self.write_block_size = self.ftp_settings.write_size
-        self.write_file_size = file_size
-
-        write_blockcount = file_size // self.write_block_size
-        if file_size % self.write_block_size != 0:
-            write_blockcount += 1
-
-        self.write_list = set(range(write_blockcount))
-        self.write_acks = 0
-        self.write_total = write_blockcount
-        self.write_idx = 0
-        self.write_recv_idx = -1
-        self.write_pending = 0
-        self.write_last_send = None
-
-        self.put_callback = callback
-        self.put_callback_progress = progress_callback
-        self.read_retries = 0
-        self.op_start = time.time()
-        enc_fname = bytearray(self.filename, 'ascii')
-        op = FTP_OP(self.seq, self.session, OP_CreateFile, len(enc_fname), 0, 0, 0, enc_fname)
-        self.send(op)
-
-    def put_finished(self, flen):
-        '''finish a put'''
-        if self.put_callback_progress:
-            self.put_callback_progress(1.0)
-            self.put_callback_progress = None
-        if self.put_callback is not None:
-            self.put_callback(flen)
-            self.put_callback = None
-        else:
-            print("Sent file of length ", flen)
-        
-    def handle_create_file_reply(self, op, m):
-        '''handle OP_CreateFile reply'''
-        if self.fh is None:
-            self.terminate_session()
-            return
-        if op.opcode == OP_Ack:
-            self.send_more_writes()
-        else:
-            print("Create failed")
-            self.terminate_session()
-
-    def send_more_writes(self):
-        '''send some more writes'''
-        if len(self.write_list) == 0:
-            # all done
-            self.put_finished(self.write_file_size)
-            self.terminate_session()
-            return
-
-        now = time.time()
-        if self.write_last_send is not None:
-            if now - self.write_last_send > max(min(10*self.rtt, 1),0.2):
-                # we seem to have lost a block of replies
-                self.write_pending = max(0, self.write_pending-1)
-
-        n = min(self.ftp_settings.write_qsize-self.write_pending, len(self.write_list))
-        for i in range(n):
-            # send in round-robin, skipping any that have been acked
-            idx = self.write_idx
-            while idx not in self.write_list:
-                idx = (idx + 1) % self.write_total
-            ofs = idx * self.write_block_size
-            self.fh.seek(ofs)
-            data = self.fh.read(self.write_block_size)
-            write = FTP_OP(self.seq, self.session, OP_WriteFile, len(data), 0, 0, ofs, bytearray(data))
-            self.send(write)
-            self.write_idx = (idx + 1) % self.write_total
-            self.write_pending += 1
-            self.write_last_send = now
-
-    def handle_write_reply(self, op, m):
-        '''handle OP_WriteFile reply'''
-        if self.fh is None:
-            self.terminate_session()
-            return
-        if op.opcode != OP_Ack:
-            print("Write failed")
-            self.terminate_session()
-            return
-
-        # assume the FTP server processes the blocks sequentially. This means
-        # when we receive an ack that any blocks between the last ack and this
-        # one have been lost
-        idx = op.offset // self.write_block_size
-        count = (idx - self.write_recv_idx) % self.write_total
-
-        self.write_pending = max(0, self.write_pending - count)
-        self.write_recv_idx = idx
-        self.write_list.discard(idx)
-        self.write_acks += 1
-        if self.put_callback_progress:
-            self.put_callback_progress(self.write_acks/float(self.write_total))
-        self.send_more_writes()
+            print("Putting %s as %s" % (fname, remote))
+        self.add_transfer(WriteTransfer(self, fh, remote, callback, progress_callback))
 
     def cmd_rm(self, args):
         '''remove file'''
@@ -677,8 +1125,8 @@ class FTPModule(mp_module.MPModule):
             print("Usage: crc NAME")
             return
         name = args[0]
-        self.filename = name
-        self.op_start = time.time()
+        self.crc_name = name
+        self.crc_start = time.time()
         print("Getting CRC for %s" % name)
         enc_name = bytearray(name, 'ascii')
         op = FTP_OP(self.seq, self.session, OP_CalcFileCRC32, len(enc_name), 0, 0, 0, bytearray(enc_name))
@@ -689,23 +1137,32 @@ class FTPModule(mp_module.MPModule):
         if op.opcode == OP_Ack and op.size == 4:
             crc, = struct.unpack("<I", op.payload)
             now = time.time()
-            print("crc: %s 0x%08x in %.1fs" % (self.filename, crc, now - self.op_start))
+            print("crc: %s 0x%08x in %.1fs" % (self.crc_name, crc, now - self.crc_start))
         else:
             print("crc failed %s" % op)
 
     def cmd_cancel(self):
-        '''cancel any pending op'''
-        self.terminate_session()
+        '''cancel all transfers'''
+        queued = list(self.queue)
+        self.queue.clear()
+        for transfer in list(self.transfers.values()) + queued:
+            transfer.fail()
 
     def cmd_status(self):
         '''show status'''
-        if self.fh is None:
+        if len(self.transfers) == 0 and len(self.queue) == 0:
             print("No transfer in progress")
+        for transfer in self.transfers.values():
+            print(transfer.status())
+        for transfer in self.queue:
+            print("queued %s" % transfer.name())
+        if self.rtt.srtt is not None:
+            rtt = "%.3fs" % self.rtt.srtt
         else:
-            ofs = self.fh.tell()
-            dt = time.time() - self.op_start
-            rate = (ofs / dt) / 1024.0
-            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec" % (ofs, len(self.read_gaps), self.read_retries, rate))
+            rtt = "?"
+        print("rtt %s retry %.3fs received %u sent %u retries %u completed %u failed %u" % (
+            rtt, self.rtt.timeout(self.ftp_settings.retry_time), self.bytes_received, self.bytes_sent,
+            self.retries, self.completed, self.failed))
 
     def op_parse(self, m):
         '''parse a FILE_TRANSFER_PROTOCOL msg'''
@@ -714,6 +1171,24 @@ class FTPModule(mp_module.MPModule):
         payload = bytearray(m.payload[12:])[:size]
         return FTP_OP(seq, session, opcode, size, req_opcode, burst_complete, offset, payload)
 
+    def transfer_for_reply(self, op):
+        '''return the transfer a reply belongs to, or None'''
+        transfer = self.transfers.get(op.session, None)
+        if transfer is not None or op.req_opcode not in [OP_OpenFileRO, OP_CreateFile]:
+            return transfer
+        if op.session in self.retired:
+            return None
+        # a server which picks its own session numbers, use its
+        # session if only one transfer is waiting for an open
+        waiting = [t for t in self.transfers.values() if not t.session_open()]
+        if len(waiting) != 1 or op.opcode != OP_Ack:
+            return None
+        transfer = waiting[0]
+        self.transfers.pop(transfer.session)
+        transfer.session = op.session
+        self.transfers[op.session] = transfer
+        return transfer
+
     def mavlink_packet(self, m):
         '''handle a mavlink packet'''
         mtype = m.get_type()
@@ -737,116 +1212,42 @@ class FTPModule(mp_module.MPModule):
                         print("FTP: dropping packet RX")
                     return
 
-            if op.req_opcode == self.last_op.opcode and op.seq == (self.last_op.seq + 1) % 256:
-                self.rtt = max(min(self.rtt, dt), 0.01)
-            if op.req_opcode == OP_ListDirectory:
+            if op.req_opcode in SESSION_OPS:
+                if op.req_opcode == OP_BurstReadFile and self.ftp_settings.pkt_loss_tx > 0:
+                    if random.uniform(0,100) < self.ftp_settings.pkt_loss_tx:
+                        if self.ftp_settings.debug > 0:
+                            print("FTP: dropping TX")
+                        return
+                transfer = self.transfer_for_reply(op)
+                if transfer is None:
+                    # old session
+                    if self.ftp_settings.debug > 0:
+                        print("FTP: reply for unknown session %s" % op)
+                    return
+                transfer.handle_reply(op)
+            elif op.req_opcode == OP_ListDirectory:
                 self.handle_list_reply(op, m)
-            elif op.req_opcode == OP_OpenFileRO:
-                self.handle_open_RO_reply(op, m)
-            elif op.req_opcode == OP_BurstReadFile:
-                self.handle_burst_read(op, m)
             elif op.req_opcode == OP_TerminateSession:
                 pass
-            elif op.req_opcode == OP_CreateFile:
-                self.handle_create_file_reply(op, m)
-            elif op.req_opcode == OP_WriteFile:
-                self.handle_write_reply(op, m)
             elif op.req_opcode in [OP_RemoveFile, OP_RemoveDirectory]:
                 self.handle_remove_reply(op, m)
             elif op.req_opcode == OP_Rename:
                 self.handle_rename_reply(op, m)
             elif op.req_opcode == OP_CreateDirectory:
                 self.handle_mkdir_reply(op, m)
-            elif op.req_opcode == OP_ReadFile:
-                self.handle_reply_read(op, m)
             elif op.req_opcode == OP_CalcFileCRC32:
                 self.handle_crc_reply(op, m)
             else:
                 print('FTP Unknown %s' % str(op))
 
-    def send_gap_read(self, g):
-        '''send a read for a gap'''
-        (offset, length) = g
-        if self.ftp_settings.debug > 0:
-            print("Gap read of %u at %u rem=%u blog=%u" % (length, offset, len(self.read_gaps), self.backlog))
-        read = FTP_OP(self.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
-        self.send(read)
-        self.read_gaps.remove(g)
-        self.read_gaps.append(g)
-        self.last_gap_send = time.time()
-        self.read_gap_times[g] = self.last_gap_send
-        self.backlog += 1
-
-    def check_read_send(self):
-        '''see if we should send another gap read'''
-        if len(self.read_gaps) == 0:
-            return
-        g = self.read_gaps[0]
-        now = time.time()
-        dt = now - self.read_gap_times[g]
-        if not self.reached_eof:
-            # send gap reads once
-            for g in self.read_gap_times.keys():
-                if self.read_gap_times[g] == 0:
-                    self.send_gap_read(g)
-            return
-        if self.read_gap_times[g] > 0 and dt > self.ftp_settings.retry_time:
-            if self.backlog > 0:
-                self.backlog -= 1
-            self.read_gap_times[g] = 0
-
-        if self.read_gap_times[g] != 0:
-            # still pending
-            return
-        if not self.reached_eof and self.backlog >= self.ftp_settings.max_backlog:
-            # don't fill queue too far until we have got past the burst
-            return
-        if now - self.last_gap_send < 0.05:
-            # don't send too fast
-            return
-        self.send_gap_read(g)
-
     def idle_task(self):
         '''check for file gaps and lost requests'''
-        now = time.time()
-
-        # see if we lost an open reply
-        if self.op_start is not None and now - self.op_start > 1.0 and self.last_op.opcode == OP_OpenFileRO:
-            self.op_start = now
-            self.open_retries += 1
-            if self.open_retries > 2:
-                # fail the get
-                self.op_start = None
-                self.terminate_session()
-                return
-            if self.ftp_settings.debug > 0:
-                print("FTP: retry open")
-            send_op = self.last_op
-            self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
-            self.session = (self.session + 1) % 256
-            send_op.session = self.session
-            self.send(send_op)
-
-        if len(self.read_gaps) == 0 and self.last_burst_read is None and self.write_list is None:
+        if len(self.transfers) == 0:
             return
-
-        if self.fh is None:
-            return
-
-        # see if burst read has stalled
-        if not self.reached_eof and self.last_burst_read is not None and now - self.last_burst_read > self.ftp_settings.retry_time:
-            dt = now - self.last_burst_read
-            self.last_burst_read = now
-            if self.ftp_settings.debug > 0:
-                print("Retry read at %u rtt=%.2f dt=%.2f" % (self.fh.tell(), self.rtt, dt))
-            self.send(FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, self.fh.tell(), None))
-            self.read_retries += 1
-
-        # see if we can fill gaps
-        self.check_read_send()
-
-        if self.write_list is not None:
-            self.send_more_writes()
+        now = time.time()
+        for transfer in list(self.transfers.values()):
+            transfer.check(now)
+        self.start_queued()
 
 def init(mpstate):
     '''initialise module'''
@@ -8,6 +8,7 @@ from pymavlink import mavutil
 import re, os, sys
 
 from MAVProxy.modules.lib import live_graph
+from MAVProxy.modules.lib import mp_expression
 
 from MAVProxy.modules.lib import mp_module
 
@@ -126,6 +127,7 @@ class Graph():
                 labels.append(None)
 
         self.fields = fields[:]
+        self.expressions = [mp_expression.compile_expression(f) for f in self.fields]
         self.values = [None] * len(self.fields)
         self.livegraph = live_graph.LiveGraph(fields,
                                               timespan=state.timespan,
@@ -159,8 +161,7 @@ class Graph():
         for i in range(len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            self.values[i] = mavutil.evaluate_expression(f, self.state.master.messages)
+            self.values[i] = self.expressions[i].evaluate(self.state.master.messages)
             if self.values[i] is not None:
                 have_value = True
         if have_value and self.livegraph is not None:
@@ -16,7 +16,6 @@ import fnmatch
 import json
 import math
 import os
-import struct
 import sys
 import time
 import traceback
@@ -28,6 +27,7 @@ else:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_router
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuCallTextDialog
@@ -55,6 +55,15 @@ activityPackets = frozenset([
 ])
 radioStatusPackets = frozenset(['RADIO', 'RADIO_STATUS'])
 
+
+def handles_packets(mod):
+    '''return True if a module has its own mavlink_packet()'''
+    if not hasattr(mod, 'mavlink_packet'):
+        return False
+    return ('mavlink_packet' in mod.__dict__ or
+            getattr(type(mod), 'mavlink_packet', None) is not mp_module.MPModule.mavlink_packet)
+
+
 preferred_ports = [
     '*FTDI*',
     "*Arduino_Mega_2560*",
@@ -88,6 +97,8 @@ class LinkModule(mp_module.MPModule):
         self.add_command('vehicle', self.cmd_vehicle, "vehicle control")
         self.add_command('alllinks', self.cmd_alllinks, "send command on all links", ["(COMMAND)"])
         self.add_command('ping', self.cmd_ping, "ping mavlink nodes")
+        # packets are handled in master_callback(), not mavlink_packet()
+        self.subscribe_mavlink(types=[])
         self.no_fwd_types = set()
         self.no_fwd_types.add("BAD_DATA")
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
@@ -103,6 +114,20 @@ class LinkModule(mp_module.MPModule):
         self.old_streamrate = 0
         self.old_streamrate2 = 0
 
+        # per message type list of modules to pass packets to, rebuilt
+        # when modules or their subscriptions change
+        self.dispatch_table = {}
+        self.dispatch_generation = -1
+
+        # in router mode only these message types, plus types that
+        # modules subscribe to, are decoded
+        self.router_decode_types = set(['HEARTBEAT', 'HIGH_LATENCY2', 'SYS_STATUS', 'STATUSTEXT',
+                                        'COMMAND_ACK', 'MISSION_ACK'])
+        self.router_scanners = {}
+        self.router_warned = set()
+        self.router_ids = None
+        self.router_generation = -1
+
         # a list of TimeSync requests which are listening for and
         # sending TIMESYNC messages at the moment:
         self.outstanding_timesyncs = []
@@ -440,6 +465,7 @@ class LinkModule(mp_module.MPModule):
             signing.setup_signing_device(conn, device)
 
         self.mpstate.mav_master.append(conn)
+        self.mpstate.links_changed()
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         self.mpstate.vehicle_link_map[conn.linknum] = set(())
@@ -508,6 +534,7 @@ class LinkModule(mp_module.MPModule):
             print(msg)
             pass
         self.mpstate.mav_master.pop(i)
+        self.mpstate.links_changed()
         self.status.counters['MasterIn'].pop(i)
         self.status.bytecounters['MasterIn'].pop(i)
         del self.mpstate.vehicle_link_map[conn.linknum]
@@ -554,7 +581,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -612,7 +639,7 @@ class LinkModule(mp_module.MPModule):
     def report_altitude(self, altitude):
         '''possibly report a new altitude'''
         master = self.master
-        if len(self.module_matching('terrain')) > 0 and self.mpstate.settings.basealt != 0:
+        if self.mpstate.settings.basealt != 0 and len(self.module_matching('terrain')) > 0:
             lat = master.field('GLOBAL_POSITION_INT', 'lat', 0)*1.0e-7
             lon = master.field('GLOBAL_POSITION_INT', 'lon', 0)*1.0e-7
             alt1 = self.module('terrain').ElevationModel.GetElevation(lat, lon)
@@ -976,6 +1003,108 @@ class LinkModule(mp_module.MPModule):
         '''handle an incoming mavlink packet'''
         pass
 
+    def forward_to_outputs(self, buf):
+        '''send a packet buffer to all mavlink outputs'''
+        for r in self.mpstate.mav_outputs:
+            if hasattr(r, 'ws') and r.ws is not None:
+                from wsproto.connection import ConnectionState
+                if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
+                    continue
+            r.write(buf)
+
+    def update_router_ids(self):
+        '''work out which message IDs router mode needs to decode or treat specially'''
+        generation = getattr(self.mpstate, 'modules_generation', None)
+        if (self.router_ids is not None and generation == self.router_generation and
+                self.router_ids['no_fwd_types'] == self.no_fwd_types and
+                self.router_ids['decode_types'] == self.router_decode_types):
+            return self.router_ids
+        decode_types = set(self.router_decode_types)
+        registry = getattr(self.mpstate, 'registry', None)
+        if registry is not None:
+            decode_types.update(registry.wake_type_names())
+        ids = mp_router.msgid_map()
+        catch_all = []
+        for (mod, pm) in self.mpstate.modules:
+            if not handles_packets(mod):
+                continue
+            types = getattr(mod, 'subscribed_types', None)
+            if types is None:
+                # the module takes every message type
+                catch_all.append(mod.name)
+            else:
+                decode_types.update(types)
+        if catch_all:
+            decode = frozenset(ids.values())
+            new = set(catch_all) - self.router_warned
+            if new:
+                print("router: modules %s take all message types, so all messages are decoded" %
+                      ', '.join(sorted(new)))
+                self.router_warned.update(new)
+        else:
+            decode = mp_router.msgids_for_types(decode_types)
+        self.router_ids = {
+            'no_fwd_types': set(self.no_fwd_types),
+            'decode_types': set(self.router_decode_types),
+            'decode': decode,
+            'no_fwd': mp_router.msgids_for_types(self.no_fwd_types),
+            'data': mp_router.msgids_for_types(dataPackets),
+            'global_position_int': ids.get('GLOBAL_POSITION_INT', -1),
+            'request_data_stream': ids.get('REQUEST_DATA_STREAM', -1),
+        }
+        self.router_generation = generation
+        return self.router_ids
+
+    def route_buffer(self, master, s):
+        '''router mode handling of data from master. Frames are
+        forwarded and logged without being decoded, and only message
+        types that MAVProxy needs are decoded. Returns the list of
+        decoded messages'''
+        scanner = self.router_scanners.get(master, None)
+        if scanner is None:
+            scanner = mp_router.FrameScanner()
+            self.router_scanners[master] = scanner
+        ids = self.update_router_ids()
+        master.mav.total_bytes_received += len(s)
+        frames = scanner.scan(s)
+        if not frames:
+            return None
+        ret = []
+        logqueue = self.mpstate.logqueue
+        if logqueue:
+            usec = self.get_usec()
+            usec = (usec & ~3) | master.linknum
+        allow_rate = self.mpstate.settings.mavfwd_rate
+        sysid_outputs = self.mpstate.sysid_outputs
+        for (msgid, sysid, frame) in frames:
+            master.mav.total_packets_received += 1
+            if msgid in ids['decode'] or sysid in sysid_outputs:
+                # full processing, including forwarding and logging
+                try:
+                    m = master.mav.decode(bytearray(frame))
+                except mavutil.mavlink.MAVError as reason:
+                    m = mavutil.mavlink.MAVLink_bad_data(bytearray(frame), reason.message)
+                    master.mav.total_receive_errors += 1
+                self.master_callback(m, master)
+                ret.append(m)
+                continue
+            self.status.counters['MasterIn'][master.linknum] += 1
+            if msgid == ids['global_position_int']:
+                # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
+                for sysid in sysid_outputs:
+                    sysid_outputs[sysid].write(frame)
+                if self.mpstate.settings.fwdpos:
+                    for link in self.mpstate.mav_master:
+                        if link != master:
+                            link.write(frame)
+            if logqueue and msgid not in ids['data']:
+                logqueue.put_timestamped(usec, frame)
+            if msgid in ids['no_fwd']:
+                continue
+            if allow_rate or msgid != ids['request_data_stream']:
+                self.forward_to_outputs(frame)
+        return ret
+
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
         sysid = m.get_srcSystem()
@@ -1019,7 +1148,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_timestamped(usec, m.get_msgbuf())
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -1062,32 +1191,30 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        if hasattr(r, 'ws') and r.ws is not None:
-                            from wsproto.connection import ConnectionState
-                            if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
-                                continue
-                        r.write(m.get_msgbuf())
-
-            sysid = m.get_srcSystem()
-            target_sysid = self.target_system
+                    self.forward_to_outputs(m.get_msgbuf())
 
             # pass to modules
-            for (mod, pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
-                # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
-                if not self.message_is_from_primary_vehicle(m) and not mod.multi_vehicle and mtype == 'HEARTBEAT':
-                    continue
-                # sysid 51/'3' is used by SiK radio for the injected RADIO/RADIO_STATUS mavlink frames.
-                # In order to be able to pass these to e.g. the graph module, which is not multi-vehicle,
-                # special handling is needed, so that the module gets both RADIO_STATUS and (single) target
-                # vehicle information.
-                if not (sysid == 51 and mtype in radioStatusPackets):
-                    if not mod.multi_vehicle and sysid != target_sysid:
+            sysid = m.get_srcSystem()
+            from_target = sysid == self.target_system
+            # sysid 51/'3' is used by SiK radio for the injected RADIO/RADIO_STATUS mavlink frames.
+            # In order to be able to pass these to e.g. the graph module, which is not multi-vehicle,
+            # special handling is needed, so that the module gets both RADIO_STATUS and (single) target
+            # vehicle information.
+            if sysid == 51 and mtype in radioStatusPackets:
+                from_target = True
+            # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
+            from_primary = mtype != 'HEARTBEAT' or self.message_is_from_primary_vehicle(m)
+
+            for (mod, multi_vehicle, sysids) in self.module_dispatch_list(mtype):
+                if not multi_vehicle:
+                    if not from_primary:
+                        continue
+                    if not from_target:
                         # only pass packets not from our target to modules that
                         # have marked themselves as being multi-vehicle capable
                         continue
+                if sysids is not None and sysid not in sysids:
+                    continue
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -1105,6 +1232,32 @@ class LinkModule(mp_module.MPModule):
                     elif self.mpstate.settings.moddebug == 1:
                         print(msg)
 
+    def module_dispatch_list(self, mtype):
+        '''return list of (module, multi_vehicle, sysids) which want
+        messages of type mtype, in module load order'''
+        generation = getattr(self.mpstate, 'modules_generation', None)
+        if generation is None or generation != self.dispatch_generation:
+            self.dispatch_table = {}
+            self.dispatch_generation = generation
+        ret = self.dispatch_table.get(mtype, None)
+        if ret is not None:
+            return ret
+        registry = getattr(self.mpstate, 'registry', None)
+        if registry is not None and registry.wake(mtype):
+            # a deferred module was loaded to handle this type
+            self.dispatch_table = {}
+            self.dispatch_generation = self.mpstate.modules_generation
+        ret = []
+        for (mod, pm) in self.mpstate.modules:
+            if not handles_packets(mod):
+                continue
+            types = getattr(mod, 'subscribed_types', None)
+            if types is not None and mtype not in types:
+                continue
+            ret.append((mod, mod.multi_vehicle, getattr(mod, 'subscribed_sysids', None)))
+        self.dispatch_table[mtype] = ret
+        return ret
+
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
         if len(args) < 1:
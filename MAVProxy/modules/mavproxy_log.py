@@ -4,27 +4,353 @@ log command handling
 AP_FLAKE8_CLEAN
 '''
 
+import mmap
 import os
 import time
 
+import numpy as np
+
 from MAVProxy.modules.lib import mp_module
 
+# LOG_DATA carries a log in chunks of this many bytes
+CHUNK_SIZE = 90
+# LOG_REQUEST_DATA count for the rest of a log
+COUNT_ALL = 0xFFFFFFFF
+# requests past the last chunk which go unanswered before a log with no
+# short LOG_DATA at its end is saved anyway
+END_PROBES = 3
+
+
+class LogRequest(object):
+    '''a LOG_REQUEST_DATA for chunks start to end, which the vehicle
+    sends in order. end is None for the rest of the log'''
+    def __init__(self, start, end, now, timed):
+        self.start = start
+        self.end = end
+        self.next = start
+        self.sent = now
+        self.timed = timed
+
+    def covers(self, chunk):
+        '''return True if chunk is still to come from this request'''
+        return self.next <= chunk and (self.end is None or chunk < self.end)
+
+    def remaining(self, nchunks):
+        '''return the number of chunks still to come, given the number
+        of chunks in the log or None if that is unknown'''
+        if self.end is not None:
+            return max(self.end - self.next, 0)
+        if nchunks is None:
+            return COUNT_ALL
+        return max(nchunks - self.next, 0)
+
+
+class LogDownload(object):
+    '''download of one log
+
+    Received chunks are marked in a bitmap, and the data stored at its
+    offset in a memory map of a temporary file when the size is known,
+    or in memory when it isn't, so out of order data needs no seeking.
+    The file is only given its name once saved, so a download which
+    was interrupted can't be mistaken for a complete log.
+
+    The vehicle only works on the latest LOG_REQUEST_DATA, so a new
+    request cuts short the one before. Holes are requested a run at a
+    time, sending another request once the data still to come is less
+    than the link carries in a round trip.
+    '''
+    def __init__(self, module, lognum, filename, size):
+        self.module = module
+        self.lognum = lognum
+        self.filename = filename
+        self.size = size
+        self.tmpname = filename + ".tmp"
+        self.fh = open(self.tmpname, "w+b")
+        self.mm = None
+        self.buf = bytearray()
+        if size:
+            self.fh.truncate(size)
+            self.mm = mmap.mmap(self.fh.fileno(), size)
+            self.buf = self.mm
+        self.chunks = np.zeros(max(self.num_chunks() or 0, 1024), dtype=bool)
+        self.received = 0
+        self.highest = -1
+        self.end_seen = False
+        self.end_timeouts = 0
+        self.requests = []
+        self.cursor = 0
+        self.start_time = time.time()
+        self.last_data = self.start_time
+        self.num_requests = 0
+        self.timeouts = 0
+        self.last_timeout = None
+        self.duplicates = 0
+        self.srtt = None
+        self.rate = None
+        self.peak_rate = None
+        self.rate_time = self.start_time
+        self.rate_bytes = 0
+
+    def num_chunks(self):
+        '''return the number of chunks in the log, or None if unknown'''
+        if self.size is None:
+            return None
+        return (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def limit(self):
+        '''return the number of chunks which should be filled'''
+        n = self.num_chunks()
+        if n is None:
+            return self.highest + 1
+        return n
+
+    def missing(self):
+        '''return the number of holes below the limit'''
+        limit = self.limit()
+        return limit - int(np.count_nonzero(self.chunks[:limit]))
+
+    def received_bytes(self):
+        return min(self.received * CHUNK_SIZE, self.size or len(self.buf))
+
+    def complete(self):
+        '''return True once the log has no holes and its end has been
+        seen. The size in LOG_ENTRY may be stale if the log is still
+        being written, so it doesn't end the download on its own'''
+        if self.missing() != 0:
+            return False
+        return self.end_seen or self.end_timeouts >= END_PROBES
+
+    def retries(self):
+        return max(self.num_requests - 1, 0)
+
+    def window(self):
+        '''return the number of chunks the link carries in a round trip.
+        This uses the fastest rate seen, as the rate while filling holes
+        is limited by the window'''
+        if self.srtt is None or self.peak_rate is None:
+            return 10
+        return max(int(self.peak_rate * self.srtt / CHUNK_SIZE), 1)
+
+    def timeout(self):
+        '''return how long to wait for data before giving up on the
+        outstanding requests'''
+        if self.srtt is None:
+            return 2.0
+        return min(max(3 * self.srtt, 0.5), 2.0)
+
+    def store(self, ofs, data):
+        '''store data at an offset'''
+        end = ofs + len(data)
+        if end > len(self.buf):
+            if self.mm is not None:
+                # the log is longer than its LOG_ENTRY said
+                self.buf = bytearray(self.mm)
+                self.mm.close()
+                self.mm = None
+            self.buf.extend(bytes(end - len(self.buf)))
+        self.buf[ofs:end] = data
+
+    def handle_data(self, m, now):
+        '''handle a LOG_DATA message'''
+        chunk = m.ofs // CHUNK_SIZE
+        self.last_data = now
+        if m.count < CHUNK_SIZE:
+            # a short packet marks the end of the log
+            self.size = m.ofs + m.count
+            self.end_seen = True
+        elif self.size is not None and m.ofs + m.count > self.size and not self.end_seen:
+            # the log has grown since its LOG_ENTRY
+            self.size = m.ofs + m.count
+        if m.count > 0:
+            if chunk >= len(self.chunks):
+                grow = max(chunk + 1, 2 * len(self.chunks)) - len(self.chunks)
+                self.chunks = np.concatenate((self.chunks, np.zeros(grow, dtype=bool)))
+            if self.chunks[chunk]:
+                self.duplicates += 1
+            else:
+                self.chunks[chunk] = True
+                self.received += 1
+                self.highest = max(self.highest, chunk)
+                self.store(m.ofs, bytearray(m.data[:m.count]))
+                self.rate_bytes += m.count
+        self.update_rate(now)
+        self.update_requests(chunk, now)
+
+    def update_rate(self, now):
+        dt = now - self.rate_time
+        if dt < 1.0:
+            return
+        rate = self.rate_bytes / dt
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate
+        self.peak_rate = max(self.peak_rate or 0, self.rate)
+        self.rate_time = now
+        self.rate_bytes = 0
+
+    def drop_request(self, r):
+        '''forget a request the vehicle has stopped working on, so its
+        holes are requested again'''
+        self.cursor = min(self.cursor, r.next)
+        self.requests.remove(r)
+
+    def update_requests(self, chunk, now):
+        '''note the progress of the request chunk came from'''
+        for i in range(len(self.requests)):
+            r = self.requests[i]
+            if not r.covers(chunk):
+                continue
+            if r.timed and chunk == r.start and r.next == r.start:
+                rtt = now - r.sent
+                if self.srtt is None:
+                    self.srtt = rtt
+                else:
+                    self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            r.next = max(r.next, chunk + 1)
+            # the vehicle has moved on from the requests before this one
+            for old in self.requests[:i]:
+                self.drop_request(old)
+            n = self.num_chunks()
+            if (r.end is not None and r.next >= r.end) or (n is not None and r.next >= n):
+                self.requests.remove(r)
+            break
+
+    def request(self, start, end, now):
+        '''request chunks start to end, or the rest of the log if end
+        is None'''
+        count = COUNT_ALL if end is None else (end - start) * CHUNK_SIZE
+        # data for requests given up on may still arrive for a while, so
+        # only time requests well after a timeout
+        timed = self.last_timeout is None or now - self.last_timeout > self.timeout()
+        self.requests.append(LogRequest(start, end, now, timed))
+        self.num_requests += 1
+        self.module.master.mav.log_request_data_send(
+            self.module.target_system,
+            self.module.target_component,
+            self.lognum,
+            start * CHUNK_SIZE,
+            count
+        )
+
+    def next_hole(self, limit):
+        '''return (start, end) of the next run of missing chunks after
+        the cursor which isn't still to come from a request'''
+        while self.cursor < limit:
+            start = self.cursor + int(np.argmin(self.chunks[self.cursor:limit]))
+            if self.chunks[start]:
+                self.cursor = limit
+                break
+            covering = [r for r in self.requests if r.covers(start)]
+            if covering:
+                end = covering[0].end
+                self.cursor = limit if end is None else end
+                continue
+            found = self.chunks[start:limit]
+            end = start + int(np.argmax(found)) if found.any() else limit
+            for r in self.requests:
+                if start < r.next < end:
+                    end = r.next
+            self.cursor = end
+            return (start, end)
+        return None
+
+    def send_requests(self, now):
+        '''request holes while the data to come fits in a round trip'''
+        limit = self.limit()
+        nchunks = self.num_chunks()
+        window = self.window()
+        while sum([r.remaining(nchunks) for r in self.requests]) < window:
+            hole = self.next_hole(limit)
+            if hole is not None:
+                self.request(hole[0], hole[1], now)
+                continue
+            if not self.end_seen and not self.requests:
+                # we haven't seen where the log ends yet, so ask for
+                # anything past what we have
+                self.request(self.limit(), None, now)
+            break
+
+    def start(self):
+        self.request(0, None, self.start_time)
+
+    def check(self, now):
+        '''check for lost data, and request more'''
+        if self.requests and now - self.last_data > self.timeout():
+            # the rest of the outstanding requests have been lost
+            for r in self.requests[:]:
+                self.drop_request(r)
+            if not self.end_seen and self.missing() == 0:
+                self.end_timeouts += 1
+            self.timeouts += 1
+            self.last_timeout = now
+            self.last_data = now
+        if not self.requests and self.cursor >= self.limit():
+            self.cursor = 0
+        self.send_requests(now)
+
+    def status(self, now):
+        '''return a status string'''
+        dt = max(now - self.start_time, 0.001)
+        received = self.received_bytes()
+        rate = self.rate if self.rate is not None else received / dt
+        if self.size is None:
+            size = "?"
+            eta = ""
+        else:
+            size = self.size
+            remaining = max(self.size - received, 0)
+            pct = 100.0 if self.size == 0 else (100.0 * received) / self.size
+            eta = f"{pct:.1f}% "
+            if rate > 0:
+                eta += "ETA %s " % time.strftime("%M:%S", time.gmtime(remaining / rate))
+        return (
+            f"Downloading {self.filename} - " +
+            f"{received}/{size} bytes " + eta +
+            f"{rate / 1000.0:.1f} kbyte/s " +
+            f"({self.retries()} retries {self.missing()} missing)"
+        )
+
+    def close(self, length):
+        '''write the first length bytes of the log and close the file'''
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+        else:
+            self.fh.seek(0)
+            self.fh.write(self.buf[:length])
+        self.fh.truncate(length)
+        self.fh.close()
+        os.replace(self.tmpname, self.filename)
+
+    def length(self):
+        '''return the length of the completed log'''
+        if self.end_seen:
+            return self.size
+        return len(self.buf)
+
+    def finish(self):
+        '''save the completed log'''
+        self.close(self.length())
+
+    def cancel(self):
+        '''save the part of the log received without holes'''
+        limit = self.limit()
+        got = self.chunks[:limit]
+        prefix = int(np.argmin(got)) if not got.all() else limit
+        self.close(min(prefix * CHUNK_SIZE, self.received_bytes() if self.size is None else self.size))
+
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
+        self.subscribe_mavlink(types=['LOG_ENTRY', 'LOG_DATA'])
         self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
         self.reset()
 
     def reset(self):
-        self.download_set = set()
-        self.download_file = None
-        self.download_lognum = None
-        self.download_filename = None
-        self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
-        self.retries = 0
+        self.download = None
         self.entries = {}
         self.download_queue = []
         self.last_status = time.time()
@@ -50,110 +376,51 @@ class LogModule(mp_module.MPModule):
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download is None:
             return
         # lose some data
         # import random
         # if random.uniform(0,1) < 0.05:
         #    print('dropping ', str(m))
         #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
-            status = (
-                f"Finished downloading {self.download_filename} " +
-                f"({size} bytes {dt:0.1f} seconds, " +
-                f"{speed:.1f} kbyte/sec " +
-                f"{self.retries} retries)"
-            )
-            self.console.set_status('LogDownload', status, row=4)
-            print(status)
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-            self.master.mav.log_request_end_send(
-                self.target_system,
-                self.target_component
-            )
-            if len(self.download_queue):
-                self.log_download_next()
+        self.download.handle_data(m, time.time())
+        if self.download.complete():
+            self.log_download_finished()
+            return
+        self.download.send_requests(time.time())
         self.update_status()
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
-            return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(
-                self.target_system,
-                self.target_component,
-                self.download_lognum,
-                (1 + highest) * 90,
-                0xffffffff
-            )
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(
-                    self.target_system,
-                    self.target_component,
-                    self.download_lognum,
-                    start * 90,
-                    (end + 1 - start) * 90
-                )
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
+    def log_download_finished(self):
+        '''save a completed download and move on to the next'''
+        download = self.download
+        dt = time.time() - download.start_time
+        size = download.length()
+        download.finish()
+        if not download.end_seen:
+            print(f"Warning: no end of log seen for {download.filename}, it may be cut short at {size} bytes")
+        speed = size / (1000.0 * dt)
+        status = (
+            f"Finished downloading {download.filename} " +
+            f"({size} bytes {dt:0.1f} seconds, " +
+            f"{speed:.1f} kbyte/sec " +
+            f"{download.retries()} retries)"
+        )
+        self.console.set_status('LogDownload', status, row=4)
+        print(status)
+        self.download = None
+        self.master.mav.log_request_end_send(
+            self.target_system,
+            self.target_component
+        )
+        if len(self.download_queue):
+            self.log_download_next()
 
     def log_status(self, console=False):
         '''show download status'''
-        if self.download_filename is None:
+        if self.download is None:
             print("No download")
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        file_size = os.path.getsize(self.download_filename)
-        if m is None:
-            size = 0
-            pct = 0
-        elif m.size == 0:
-            size = 0
-            pct = 100
-        else:
-            size = m.size
-            pct = (100.0*file_size)/size
-        highest = 0
-        if len(self.download_set):
-            highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        status = (
-            f"Downloading {self.download_filename} - " +
-            f"{os.path.getsize(self.download_filename)}/{size} bytes " +
-            f"{pct:.1f}% {speed:.1f} kbyte/s " +
-            f"({self.retries} retries {len(diff)} missing)"
-        )
+        status = self.download.status(time.time())
         if console:
             self.console.set_status('LogDownload', status, row=4)
         else:
@@ -193,21 +460,10 @@ class LogModule(mp_module.MPModule):
     def log_download(self, log_num, filename):
         '''download a log file'''
         print("Downloading log %u as %s" % (log_num, filename))
-        self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(
-            self.target_system,
-            self.target_component,
-            log_num,
-            0,
-            0xFFFFFFFF
-        )
-        self.download_filename = filename
-        self.download_set = set()
-        self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
-        self.retries = 0
+        m = self.entries.get(log_num, None)
+        size = None if m is None else m.size
+        self.download = LogDownload(self, log_num, filename, size)
+        self.download.start()
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
@@ -223,7 +479,6 @@ class LogModule(mp_module.MPModule):
             self.log_status()
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(
                 self.target_system,
                 self.target_component,
@@ -244,8 +499,8 @@ class LogModule(mp_module.MPModule):
             )
 
         elif args[0] == "cancel":
-            if self.download_file is not None:
-                self.download_file.close()
+            if self.download is not None:
+                self.download.cancel()
             self.reset()
 
         elif args[0] == "download":
@@ -284,15 +539,16 @@ class LogModule(mp_module.MPModule):
     def update_status(self):
         '''update log download status in console'''
         now = time.time()
-        if self.download_file is not None and now - self.last_status > 0.5:
+        if self.download is not None and now - self.last_status > 0.5:
             self.last_status = now
             self.log_status(True)
 
     def idle_task(self):
         '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        if self.download is not None:
+            self.download.check(time.time())
+            if self.download.complete():
+                self.log_download_finished()
         self.update_status()
 
 
@@ -70,6 +70,7 @@ class MapModule(mp_module.MPModule):
               ('contour_levels', int, 20),
               ('contour_grid_spacing', float, 30.0),
               ('contour_grid_extent', float, 20000.0),
+              ('max_fps', float, 5),
             ])
         
         service='MicrosoftHyb'
@@ -84,7 +85,8 @@ class MapModule(mp_module.MPModule):
         terrain_module = self.module('terrain')
         if terrain_module is not None:
             elevation = terrain_module.ElevationModel.database
-        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title)
+        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title,
+                                        max_fps=self.map_settings.max_fps)
         if self.instance == 1:
             self.mpstate.map = self.map
             mpstate.map_functions = { 'draw_lines' : self.draw_lines }
@@ -98,6 +100,7 @@ class MapModule(mp_module.MPModule):
                                                                 'follow',
                                                                 'menu',
                                                                 'marker',
+                                                                'status',
                                                                 'clear'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
@@ -284,7 +287,7 @@ class MapModule(mp_module.MPModule):
         '''map commands'''
         from MAVProxy.modules.mavproxy_map import mp_slipmap
         if len(args) < 1:
-            print("usage: map <icon|set|menu|marker>")
+            print("usage: map <icon|set|menu|marker|status>")
         elif args[0] == "menu":
             self.cmd_menu(args[1:])
         elif args[0] == "icon":
@@ -328,6 +331,9 @@ class MapModule(mp_module.MPModule):
         elif args[0] == "set":
             self.map_settings.command(args[1:])
             self.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
+            self.map.add_object(mp_slipmap.SlipFrameRate(self.map_settings.max_fps))
+        elif args[0] == "status":
+            print(self.map.status())
         elif args[0] == "sethome":
             self.cmd_set_home(args)
         elif args[0] == "sethomepos":
@@ -8,6 +8,7 @@ June 2012
 
 import functools
 import math
+from collections import OrderedDict
 import os, sys
 import time
 import cv2
@@ -40,7 +41,8 @@ class MPSlipMap():
                  elevation=None,
                  download=True,
                  show_flightmode_legend=True,
-                 timelim_pipe=None):
+                 timelim_pipe=None,
+                 max_fps=5):
 
         self.lat = lat
         self.lon = lon
@@ -57,6 +59,7 @@ class MPSlipMap():
         self.brightness = brightness
         self.legend = show_flightmode_legend
         self.timelim_pipe = timelim_pipe
+        self.max_fps = max_fps
 
         self.drag_step = 10
 
@@ -64,6 +67,14 @@ class MPSlipMap():
         self.app_ready = multiproc.Event()
         self.event_queue = multiproc.Queue()
         self.object_queue = multiproc.Queue()
+        # positions are coalesced to the latest per object and sent in
+        # batches, at most every flush_interval seconds
+        self.pending_positions = OrderedDict()
+        self.flush_interval = 0.05
+        self.last_flush = 0
+        self.positions_queued = 0
+        self.positions_coalesced = 0
+        self.stats = None
         self.close_window = multiproc.Semaphore()
         self.close_window.acquire()
         self.child = multiproc.Process(target=self.child_task)
@@ -117,53 +128,80 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def queue_object(self, obj):
+        '''send an object to the map process, after any pending positions'''
+        self.flush()
+        self.object_queue.put(obj)
+
+    def flush(self):
+        '''send any pending positions to the map process'''
+        if self.pending_positions:
+            self.object_queue.put(SlipPositionBatch(list(self.pending_positions.values())))
+            self.pending_positions = OrderedDict()
+        self.last_flush = time.time()
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self.queue_object(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self.queue_object(SlipRemoveObject(key))
 
     def set_zoom(self, ground_width):
         '''set ground width of view'''
-        self.object_queue.put(SlipZoom(ground_width))
+        self.queue_object(SlipZoom(ground_width))
 
     def set_center(self, lat, lon):
         '''set center of view'''
-        self.object_queue.put(SlipCenter((lat,lon)))
+        self.queue_object(SlipCenter((lat,lon)))
 
     def set_follow(self, enable):
         '''set follow on/off'''
-        self.object_queue.put(SlipFollow(enable))
+        self.queue_object(SlipFollow(enable))
 
     def set_follow_object(self, key, enable):
         '''set follow on/off on an object'''
-        self.object_queue.put(SlipFollowObject(key, enable))
+        self.queue_object(SlipFollowObject(key, enable))
         
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self.queue_object(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer='', rotation=0, label=None, colour=None):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation, label, colour))
+        pos = SlipPosition(key, latlon, layer, rotation, label, colour)
+        pkey = (key, pos.layer)
+        old = self.pending_positions.pop(pkey, None)
+        if old is not None:
+            pos.merge(old)
+            self.positions_coalesced += 1
+        self.pending_positions[pkey] = pos
+        self.positions_queued += 1
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
 
     def event_queue_empty(self):
         '''return True if there are no events waiting to be processed'''
+        # users poll for events regularly, so this is a good time to
+        # send any positions which are still pending
+        self.flush()
         return self.event_queue.empty()
 
     def set_layout(self, layout):
         '''set window layout'''
-        self.object_queue.put(layout)
+        self.queue_object(layout)
     
     def get_event(self):
         '''return next event or None'''
         if self.event_queue.empty():
             return None
         evt = self.event_queue.get()
-        while isinstance(evt, win_layout.WinLayout):
-            win_layout.set_layout(evt, self.set_layout)
+        while isinstance(evt, (win_layout.WinLayout, SlipMapStats)):
+            if isinstance(evt, SlipMapStats):
+                self.stats = evt
+            else:
+                win_layout.set_layout(evt, self.set_layout)
             if self.event_queue.empty():
                 return None
             evt = self.event_queue.get()
@@ -180,6 +218,15 @@ class MPSlipMap():
             for callback in self._callbacks:
                 callback(event)
 
+    def status(self):
+        '''return a string describing the update channel'''
+        ret = "positions:%u coalesced:%u" % (self.positions_queued, self.positions_coalesced)
+        stats = self.stats
+        if stats is not None:
+            ret += " drawn:%u map coalesced:%u latency mean:%.0fms max:%.0fms" % (
+                stats.positions, stats.coalesced, stats.latency_mean*1000, stats.latency_max*1000)
+        return ret
+
     def icon(self, filename):
         '''load an icon from the data directory'''
         return mp_tile.mp_icon(filename)
@@ -23,11 +23,14 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMouseEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObjectSelection
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPosition
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPositionBatch
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMapStats
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipRemoveObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollow
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollowObject
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFrameRate
 
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import win_layout
@@ -42,6 +45,16 @@ from MAVProxy.modules.lib.mp_menu import MPMenuTop
 
 from MAVProxy.modules.mavproxy_map.mp_elevation import TERRAIN_SERVICES
 
+# layers with an object moved in the last DYNAMIC_TIME seconds are
+# drawn every frame, other layers are drawn once and cached
+DYNAMIC_TIME = 2.0
+
+def composite_overlay(img, overlay):
+    '''composite a cached overlay from render_overlay onto img'''
+    (img0, diff, (y1, y2, x1, x2)) = overlay
+    roi = img[y1:y2, x1:x2]
+    roi[:] = img0 + (np.multiply(diff, roi, dtype=np.uint16) + 127) // 255
+
 class MPSlipMapFrame(wx.Frame):
     """ The main frame of the viewer
     """
@@ -60,6 +73,24 @@ class MPSlipMapFrame(wx.Frame):
         state.popup_latlon = None
         state.popup_started = False
         state.default_popup = None
+        # key -> set of layers the key has been added to
+        state.key_layers = {}
+        # layer -> version, changed whenever the contents of a layer change
+        state.layer_version = {}
+        # layer -> time an object in it last moved
+        state.layer_moved = {}
+        # layers which have held objects which change with time
+        state.dynamic_layers = set()
+        # layers which have held thumbnails or icons, which are blended
+        # with the map in a way an overlay can't reproduce
+        state.thumbnail_layers = set()
+        # oldest position applied but not yet drawn, for latency
+        state.undrawn_time = None
+        state.positions_applied = 0
+        state.positions_coalesced = 0
+        state.latency_sum = 0
+        state.latency_count = 0
+        state.latency_max = 0
         state.panel = MPSlipMapPanel(self, state)
         self.last_layout_send = time.time()
         self.Bind(wx.EVT_IDLE, self.on_idle)
@@ -164,14 +195,31 @@ class MPSlipMapFrame(wx.Frame):
             state.panel.change_zoom(1.2)
         state.need_redraw = True
 
+    def object_layers(self, key):
+        '''return the layers holding an object key, in layer order'''
+        state = self.state
+        layers = state.key_layers.get(key, None)
+        if not layers:
+            return []
+        # layers or objects may have been removed since the key was added
+        for layer in list(layers):
+            if layer not in state.layers or key not in state.layers[layer]:
+                layers.discard(layer)
+        if not layers:
+            del state.key_layers[key]
+            return []
+        if len(layers) == 1:
+            return list(layers)
+        return [layer for layer in state.layers if layer in layers]
+
     def find_object(self, key, layers):
         '''find an object to be modified'''
         state = self.state
 
         if layers is None or layers == '':
-            layers = state.layers.keys()
+            layers = self.object_layers(key)
         for layer in layers:
-            if key in state.layers[layer]:
+            if layer in state.layers and key in state.layers[layer]:
                 return state.layers[layer][key]
         return None
 
@@ -208,7 +256,12 @@ class MPSlipMapFrame(wx.Frame):
             # its a new layer
             state.layers[obj.layer] = {}
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        state.key_layers.setdefault(obj.key, set()).add(obj.layer)
+        if obj.dynamic:
+            state.dynamic_layers.add(obj.layer)
+        if isinstance(obj, SlipThumbnail):
+            state.thumbnail_layers.add(obj.layer)
+        self.layer_changed(obj.layer)
         if (not self.legend_checkbox_menuitem_added and
             isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -218,10 +271,65 @@ class MPSlipMapFrame(wx.Frame):
     def remove_object(self, key):
         '''remove an object by key from all layers'''
         state = self.state
-        for layer in state.layers:
+        for layer in self.object_layers(key):
             state.layers[layer].pop(key, None)
+            self.layer_changed(layer)
+        state.key_layers.pop(key, None)
         state.need_redraw = True
 
+    def layer_changed(self, layer):
+        '''note that the contents of a layer have changed'''
+        state = self.state
+        state.layer_version[layer] = state.layer_version.get(layer, 0) + 1
+        state.need_redraw = True
+
+    def set_position(self, obj):
+        '''move an object'''
+        state = self.state
+        object = self.find_object(obj.key, obj.layer)
+        if object is not None:
+            object.update_position(obj)
+            if getattr(object, 'follow', False):
+                self.follow(object)
+            if obj.label is not None:
+                object.label = obj.label
+            if obj.colour is not None:
+                object.colour = obj.colour
+            state.layer_moved[object.layer] = time.time()
+            self.layer_changed(object.layer)
+            state.positions_applied += 1
+            if state.undrawn_time is None or obj.time < state.undrawn_time:
+                state.undrawn_time = obj.time
+
+    def apply_positions(self, positions):
+        '''apply a dict of coalesced positions'''
+        for obj in positions.values():
+            self.set_position(obj)
+        positions.clear()
+
+    def position_drawn(self):
+        '''called when the map has been drawn, to measure latency'''
+        state = self.state
+        if state.undrawn_time is None:
+            return
+        latency = max(0, time.time() - state.undrawn_time)
+        state.undrawn_time = None
+        state.latency_sum += latency
+        state.latency_count += 1
+        state.latency_max = max(state.latency_max, latency)
+
+    def send_stats(self):
+        '''send update statistics to the parent'''
+        state = self.state
+        latency_mean = 0
+        if state.latency_count > 0:
+            latency_mean = state.latency_sum / state.latency_count
+        state.event_queue.put(SlipMapStats(state.positions_applied, state.positions_coalesced,
+                                           latency_mean, state.latency_max))
+        state.latency_sum = 0
+        state.latency_count = 0
+        state.latency_max = 0
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -233,13 +341,31 @@ class MPSlipMapFrame(wx.Frame):
         if now - self.last_layout_send > 1:
             self.last_layout_send = now
             state.event_queue.put(win_layout.get_wx_window_layout(self))
+            self.send_stats()
 
         # receive any display objects from the parent
         obj = None
 
+        # positions are coalesced to the latest per object across all
+        # the batches waiting, and applied before any other object
+        positions = {}
+
         while not state.object_queue.empty():
             obj = state.object_queue.get()
 
+            if isinstance(obj, SlipPositionBatch):
+                for pos in obj.positions:
+                    pkey = (pos.key, pos.layer)
+                    old = positions.pop(pkey, None)
+                    if old is not None:
+                        pos.merge(old)
+                        state.positions_coalesced += 1
+                    positions[pkey] = pos
+                continue
+
+            if positions:
+                self.apply_positions(positions)
+
             if isinstance(obj, win_layout.WinLayout):
                 win_layout.set_wx_window_layout(self, obj)
                 
@@ -248,16 +374,7 @@ class MPSlipMapFrame(wx.Frame):
 
             if isinstance(obj, SlipPosition):
                 # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    if obj.label is not None:
-                        object.label = obj.label
-                    if obj.colour is not None:
-                        object.colour = obj.colour
-                    state.need_redraw = True
+                self.set_position(obj)
 
             if isinstance(obj, SlipDefaultPopup):
                 state.default_popup = obj
@@ -289,35 +406,37 @@ class MPSlipMapFrame(wx.Frame):
 
             if isinstance(obj, SlipFollowObject):
                 # enable/disable follow on an object
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        if hasattr(state.layers[layer][obj.key], 'follow'):
-                            state.layers[layer][obj.key].follow = obj.enable
+                for layer in self.object_layers(obj.key):
+                    if hasattr(state.layers[layer][obj.key], 'follow'):
+                        state.layers[layer][obj.key].follow = obj.enable
                 
             if isinstance(obj, SlipBrightness):
                 # set map brightness
                 state.brightness = obj.brightness
                 state.need_redraw = True
 
+            if isinstance(obj, SlipFrameRate):
+                # change the redraw rate
+                state.panel.set_frame_rate(obj.max_fps)
+
             if isinstance(obj, SlipClearLayer):
                 # remove all objects from a layer
                 if obj.layer in state.layers:
                     state.layers.pop(obj.layer)
-                state.need_redraw = True
+                self.layer_changed(obj.layer)
 
             if isinstance(obj, SlipRemoveObject):
                 # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
+                self.remove_object(obj.key)
 
             if isinstance(obj, SlipHideObject):
                 # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+                for layer in self.object_layers(obj.key):
+                    state.layers[layer][obj.key].set_hidden(obj.hide)
+                    self.layer_changed(layer)
+
+        if positions:
+            self.apply_positions(positions)
 
         if state.timelim_pipe is not None:
             while state.timelim_pipe[1].poll():
@@ -329,7 +448,7 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     for key in state.layers[layer].keys():
                         state.layers[layer][key].set_time_range(obj)
-                state.need_redraw = True
+                    self.layer_changed(layer)
 
         if obj is None:
             time.sleep(0.05)
@@ -345,10 +464,14 @@ class MPSlipMapPanel(wx.Panel):
         self.state = state
         self.img = None
         self.map_img = None
+        self.base_key = None
+        # cached images of runs of static layers
+        self.overlay_view = None
+        self.overlays = {}
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
-        self.redraw_timer.Start(200)
+        self.set_frame_rate(state.max_fps)
         self.mouse_pos = None
         self.mouse_down = None
         self.click_pos = None
@@ -566,6 +689,50 @@ class MPSlipMapPanel(wx.Panel):
             if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
                 obj.draw(img, self.pixmapper, bounds)
 
+    def set_frame_rate(self, max_fps):
+        '''set the maximum rate the map is redrawn at'''
+        max_fps = max(0.5, max_fps)
+        self.redraw_timer.Start(int(1000 / max_fps))
+
+    def layer_runs(self, keys):
+        '''split sorted layer keys into runs of (dynamic, layers)'''
+        state = self.state
+        tnow = time.time()
+        runs = []
+        for k in keys:
+            dynamic = (k in state.dynamic_layers or
+                       tnow - state.layer_moved.get(k, 0) < DYNAMIC_TIME)
+            if runs and runs[-1][0] == dynamic:
+                runs[-1][1].append(k)
+            else:
+                runs.append((dynamic, [k]))
+        return runs
+
+    def layers_key(self, layers):
+        '''return a key which changes when any of the layers change'''
+        state = self.state
+        return (tuple([(k, state.layer_version.get(k, 0)) for k in layers]), state.legend)
+
+    def render_overlay(self, layers, bounds, shape):
+        '''draw layers onto black and white backgrounds. As drawing
+        blends linearly with the background, the layers can then be
+        composited onto any background as img0 + diff*background/255.
+        Only the area drawn on is kept'''
+        state = self.state
+        img0 = np.zeros(shape, dtype=np.uint8)
+        img1 = np.full(shape, 255, dtype=np.uint8)
+        for k in layers:
+            self.draw_objects(state.layers[k], bounds, img0)
+            self.draw_objects(state.layers[k], bounds, img1)
+        diff = np.clip(img1.astype(np.int16) - img0, 0, 255).astype(np.uint8)
+        drawn = ((img0 != 0) | (diff != 255)).any(axis=2)
+        rows = np.flatnonzero(drawn.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(drawn.any(axis=0))
+        (y1, y2, x1, x2) = (rows[0], rows[-1]+1, cols[0], cols[-1]+1)
+        return (img0[y1:y2, x1:x2].copy(), diff[y1:y2, x1:x2].copy(), (y1, y2, x1, x2))
+
     def redraw_map(self):
         '''redraw the map with current settings'''
         state = self.state
@@ -575,32 +742,67 @@ class MPSlipMapPanel(wx.Panel):
         if view_same and not state.need_redraw:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-            
         # find display bounding box
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, mp_util.wrap_180(lon2-state.lon))
 
-        # get the image
-        img = self.map_img.copy()
-
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
+        # cached overlays are only valid for one view
+        overlay_view = (state.lat, state.lon, state.width, state.height, state.ground_width)
+        if overlay_view != self.overlay_view:
+            self.overlay_view = overlay_view
+            self.overlays = {}
 
-        # draw layer objects
         keys = state.layers.keys()
         keys = sorted(list(keys))
-        for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+        runs = self.layer_runs(keys)
+
+        # the map, grid and any static layers below the first dynamic
+        # layer are drawn together
+        below = []
+        if runs and not runs[0][0]:
+            below = runs.pop(0)[1]
+        base_key = (self.current_view(), state.brightness, state.mt.get_service(),
+                    state.mt.downloads_completed, state.grid, self.layers_key(below))
+        if base_key != self.base_key or self.map_img is None:
+            # get the new map
+            map_img = state.mt.area_to_image(state.lat, state.lon,
+                                             state.width, state.height, state.ground_width)
+            if state.brightness != 0: # valid state.brightness range is [-255, 255]
+                brightness = np.uint8(np.abs(state.brightness))
+                if state.brightness > 0:
+                    map_img = np.where((255 - map_img) < brightness, 255, map_img + brightness)
+                else:
+                    map_img = np.where((255 + map_img) < brightness, 0, map_img - brightness)
+
+            # possibly draw a grid
+            if state.grid:
+                SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(map_img, self.pixmapper, bounds)
+
+            for k in below:
+                self.draw_objects(state.layers[k], bounds, map_img)
+            self.map_img = map_img
+            self.base_key = base_key
+
+        # get the image
+        img = self.map_img.copy()
+
+        # draw the remaining layers, dynamic layers directly and static
+        # layers from cached overlays
+        overlays = {}
+        for (dynamic, layers) in runs:
+            if dynamic or state.thumbnail_layers.intersection(layers):
+                for k in layers:
+                    self.draw_objects(state.layers[k], bounds, img)
+                continue
+            run = tuple(layers)
+            key = self.layers_key(layers)
+            cached = self.overlays.get(run, None)
+            if cached is None or cached[0] != key:
+                cached = (key, self.render_overlay(layers, bounds, img.shape))
+            overlays[run] = cached
+            if cached[1] is not None:
+                composite_overlay(img, cached[1])
+        self.overlays = overlays
 
         # draw information objects
         for key in state.info:
@@ -615,6 +817,7 @@ class MPSlipMapPanel(wx.Panel):
         self.Refresh()
         self.last_view = self.current_view()
         state.need_redraw = False
+        state.frame.position_drawn()
 
     def on_redraw_timer(self, event):
         '''the redraw timer ensures we show new map tiles as they
@@ -753,6 +956,7 @@ class MPSlipMapPanel(wx.Panel):
                 if (isinstance(state.layers[l][key], SlipThumbnail)
                     and not isinstance(state.layers[l][key], SlipIcon)):
                     state.layers[l].pop(key)
+                    state.frame.layer_changed(l)
 
     def on_key_down(self, event):
         '''handle keyboard input'''
@@ -28,6 +28,10 @@ def image_shape(img):
 
 class SlipObject:
     '''an object to display on the map'''
+    # set for objects whose appearance changes with time, so their
+    # layer is redrawn every frame
+    dynamic = False
+
     def __init__(self, key, layer, popup_menu=None):
         self.key = key
         self.layer = str(layer)
@@ -269,19 +273,23 @@ class SlipPolygon(SlipObject):
         '''draw a polygon on the image'''
         if self.hidden:
             return
-        self._has_timestamps = len(self.points) > 0 and len(self.points[0]) > 3
+        self.draw_points(img, pixmapper, self.points)
+
+    def draw_points(self, img, pixmapper, points):
+        '''draw lines joining a list of points'''
+        self._has_timestamps = len(points) > 0 and len(points[0]) > 3
         self._pix_points = []
-        for i in range(len(self.points)-1):
-            if len(self.points[i]) > 2:
-                colour = self.points[i][2]
+        for i in range(len(points)-1):
+            if len(points[i]) > 2:
+                colour = points[i][2]
             else:
                 colour = self.colour
-            if len(self.points[i]) > 3:
-                timestamp = self.points[i][3]
+            if len(points[i]) > 3:
+                timestamp = points[i][3]
                 if self._timestamp_range is not None:
                     if timestamp < self._timestamp_range[0] or timestamp > self._timestamp_range[1]:
                         continue
-            self.draw_line(img, pixmapper, self.points[i], self.points[i+1],
+            self.draw_line(img, pixmapper, points[i], points[i+1],
                            colour, self.linewidth)
 
     def clicked(self, px, py):
@@ -309,6 +317,53 @@ class SlipPolygon(SlipObject):
         '''extra selection information sent when object is selected'''
         return self._selected_vertex
 
+class SlipFlightPath(SlipPolygon):
+    '''a flight path which is simplified to suit the zoom level. Points
+    are (lat, lon, colour, timestamp, importance) tuples, where
+    importance is how far in metres the path moves if the point is
+    left out. Points which matter less than half a pixel are skipped'''
+    def __init__(self, key, points, layer, colour, linewidth, showlines=True, showcircles=True):
+        SlipPolygon.__init__(self, key, points, layer, colour, linewidth,
+                             showlines=showlines, showcircles=showcircles)
+        if len(points) > 0 and len(points[0]) > 4:
+            self._importance = np.array([p[4] for p in points])
+        else:
+            self._importance = None
+        self._drawn = None
+
+    def metres_per_pixel(self, pixmapper):
+        '''return the size of a pixel in metres near the path'''
+        (lat, lon) = self.points[0][:2]
+        lat = mp_util.constrain(lat, -85, 85)
+        (x1, y1) = pixmapper((lat, lon))
+        (x2, y2) = pixmapper((lat + 0.01, lon))
+        pixels = math.hypot(x2 - x1, y2 - y1)
+        if pixels <= 0:
+            return None
+        return mp_util.gps_distance(lat, lon, lat + 0.01, lon) / pixels
+
+    def draw(self, img, pixmapper, bounds):
+        '''draw the path on the image'''
+        if self.hidden:
+            return
+        self._drawn = None
+        if self._importance is None or len(self.points) < 3:
+            self.draw_points(img, pixmapper, self.points)
+            return
+        mpp = self.metres_per_pixel(pixmapper)
+        if mpp is None:
+            self.draw_points(img, pixmapper, self.points)
+            return
+        self._drawn = np.flatnonzero(self._importance >= 0.5 * mpp)
+        self.draw_points(img, pixmapper, [self.points[i] for i in self._drawn])
+
+    def selection_info(self):
+        '''return the index of the selected point in the full path'''
+        i = self._selected_vertex
+        if i is None or self._drawn is None or i >= len(self._drawn):
+            return i
+        return int(self._drawn[i])
+
 class UnclosedSlipPolygon(SlipPolygon):
     '''a polygon to display on the map - but one with no return point or
     closing vertex'''
@@ -605,9 +660,34 @@ class SlipPosition:
         self.rotation = rotation
         self.label = label
         self.colour = colour
+        # when the position was set, for measuring map latency
+        self.time = time.time()
+
+    def merge(self, older):
+        '''merge an older position for the same object which this one
+        replaces, keeping any label or colour it set'''
+        if self.label is None:
+            self.label = older.label
+        if self.colour is None:
+            self.colour = older.colour
+
+class SlipPositionBatch:
+    '''the latest positions of a set of objects'''
+    def __init__(self, positions):
+        self.positions = positions
+
+class SlipMapStats:
+    '''statistics sent from the map process'''
+    def __init__(self, positions, coalesced, latency_mean, latency_max):
+        self.positions = positions
+        self.coalesced = coalesced
+        self.latency_mean = latency_mean
+        self.latency_max = latency_max
 
 class SlipClickLocation(SlipObject):
     '''current click location tuple'''
+    dynamic = True
+
     def __init__(self, location, layer='', timeout=-1):
         self.location = location
         self.linewidth = 2
@@ -661,6 +741,11 @@ class SlipBrightness:
     def __init__(self, brightness):
         self.brightness = brightness
 
+class SlipFrameRate:
+    '''an object to change the maximum map frame rate'''
+    def __init__(self, max_fps):
+        self.max_fps = max_fps
+
 class SlipClearLayer:
     '''remove all objects in a layer'''
     def __init__(self, layer):
@@ -24,7 +24,7 @@ import sys
 import math
 import threading
 import os
-import pathlib
+import sqlite3
 import string
 import time
 import cv2
@@ -36,11 +36,19 @@ if sys.version_info.major < 3:
     from urllib2 import Request as url_request
     from urllib2 import urlopen as url_open
     from urllib2 import URLError as url_error
+    from urllib2 import HTTPError as url_http_error
+    from urllib import getproxies as url_getproxies
+    from urlparse import urlparse, urljoin
+    import httplib as http_client
 else:
     from urllib.request import Request as url_request
     from urllib.request import urlopen as url_open
+    from urllib.request import getproxies as url_getproxies
     from urllib.error import URLError as actual_url_error
+    from urllib.error import HTTPError as url_http_error
+    from urllib.parse import urlparse, urljoin
     from http.client import RemoteDisconnected
+    import http.client as http_client
     url_error = (RemoteDisconnected, actual_url_error)
 
 from MAVProxy.modules.lib import mp_util
@@ -175,11 +183,129 @@ class TileInfoScaled(TileInfo):
 
 
 
+class TileConnectionPool:
+    '''keep-alive HTTP connections to tile servers. Each download
+    thread has its own pool, as connections can't be shared'''
+    def __init__(self, timeout=20):
+        self.timeout = timeout
+        self.conns = {}
+        # http.client doesn't know about proxies, urllib does
+        self.use_urllib = bool(url_getproxies())
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+        self.conns = {}
+
+    def request_urllib(self, url, headers):
+        '''fetch a URL with urllib, returning (status, headers, body)'''
+        req = url_request(url)
+        for (k, v) in headers.items():
+            req.add_header(k, v)
+        try:
+            resp = url_open(req, timeout=self.timeout)
+        except url_http_error as e:
+            return (e.code, e.headers, b'')
+        return (resp.getcode(), resp.info(), resp.read())
+
+    def request(self, url, headers):
+        '''fetch a URL, following redirects and re-using connections.
+        Returns (status, headers, body)'''
+        if self.use_urllib:
+            return self.request_urllib(url, headers)
+        for redirect in range(5):
+            u = urlparse(url)
+            key = (u.scheme, u.netloc)
+            path = u.path or '/'
+            if u.query:
+                path += '?' + u.query
+            for attempt in range(2):
+                conn = self.conns.pop(key, None)
+                reused = conn is not None
+                if conn is None:
+                    if u.scheme == 'https':
+                        conn = http_client.HTTPSConnection(u.netloc, timeout=self.timeout)
+                    else:
+                        conn = http_client.HTTPConnection(u.netloc, timeout=self.timeout)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (OSError, http_client.HTTPException):
+                    conn.close()
+                    if reused:
+                        # the server may have closed an idle connection
+                        continue
+                    raise
+                break
+            if resp.will_close:
+                conn.close()
+            else:
+                self.conns[key] = conn
+            if resp.status in [301, 302, 303, 307, 308]:
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            return (resp.status, resp.headers, body)
+        raise TileException('too many redirects for %s' % url)
+
+
+class TileIndex:
+    '''SQLite index of the tiles in the disk cache, so lookups don't
+    need to stat the tile files. The tile images stay in the existing
+    directory layout'''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        try:
+            self.db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tiles (service TEXT, zoom INTEGER, x INTEGER, y INTEGER, '
+                            'mtime REAL, PRIMARY KEY (service, zoom, x, y))')
+        except sqlite3.Error as ex:
+            print("tile index disabled: %s" % ex)
+            self.db = None
+
+    def lookup(self, tile):
+        '''return the mtime of a tile, or None if it is not in the index'''
+        if self.db is None:
+            return None
+        try:
+            with self.lock:
+                row = self.db.execute('SELECT mtime FROM tiles WHERE service=? AND zoom=? AND x=? AND y=?',
+                                      (tile.service, tile.zoom, tile.x, tile.y)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return row[0]
+
+    def update(self, tile, mtime):
+        '''add or refresh a tile'''
+        if self.db is None:
+            return
+        try:
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)',
+                                (tile.service, tile.zoom, tile.x, tile.y, mtime))
+        except sqlite3.Error:
+            pass
+
+    def remove(self, tile):
+        '''remove a tile from the index'''
+        if self.db is None:
+            return
+        try:
+            with self.lock:
+                self.db.execute('DELETE FROM tiles WHERE service=? AND zoom=? AND x=? AND y=?',
+                                (tile.service, tile.zoom, tile.x, tile.y))
+        except sqlite3.Error:
+            pass
+
+
 class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, download_threads=4):
 
         if cache_path is None:
             try:
@@ -207,9 +333,19 @@ class MPTile:
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
+        # _download_pending is a dictionary of TileInfo objects,
+        # _download_active holds the keys being downloaded now
         self._download_pending = {}
-        self._download_thread = None
+        self._download_active = set()
+        self._download_lock = threading.Lock()
+        self._download_threads = 0
+        self.download_threads = download_threads
+        # downloads closest to the view centre are done first
+        self._view_centre = None
+        self._index = TileIndex(os.path.join(cache_path, 'tile_index.sqlite'))
+        self.downloads_cancelled = 0
+        # changes whenever a download finishes, so views can be redrawn
+        self.downloads_completed = 0
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
         try:
@@ -265,97 +401,172 @@ class MPTile:
         '''return number of tiles pending download'''
         return len(self._download_pending)
 
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
+    def next_download(self):
+        '''choose the next tile to download, the closest to the view
+        centre or if there is no view the most recently requested'''
+        with self._download_lock:
+            tile_info = None
+            best = None
+            for (key, t) in self._download_pending.items():
+                if key in self._download_active:
+                    continue
+                if self._view_centre is not None:
+                    score = -t.distance(*self._view_centre)
+                else:
+                    score = t.request_time
+                if best is None or score > best:
+                    (tile_info, best) = (t, score)
+            if tile_info is not None:
+                self._download_active.add(tile_info.key())
+            return tile_info
+
+    def download_done(self, key):
+        '''remove a tile from the pending list'''
+        with self._download_lock:
+            self._download_pending.pop(key, None)
+            self._download_active.discard(key)
+            self.downloads_completed += 1
+
+    def set_view(self, lat, lon, keys):
+        '''set the view centre for download ordering and cancel pending
+        downloads of tiles which are no longer in view'''
+        with self._download_lock:
+            self._view_centre = (lat, lon)
+            for key in list(self._download_pending.keys()):
+                if key not in keys and key not in self._download_active:
+                    self._download_pending.pop(key)
+                    self.downloads_cancelled += 1
+
+    def download_tile(self, pool, tile_info):
+        '''download one tile into the disk cache'''
+        url = tile_info.url(self.service)
+        path = self.tile_to_path(tile_info)
+        key = tile_info.key()
+
+        headers = {'User-Agent': 'MAVProxy'}
+        # try to re-use our cached data:
+        mtime = self._index.lookup(tile_info)
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(path)
+            except Exception:
+                pass
+        if mtime is not None:
+            headers['If-Modified-Since'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime))
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
 
-            keys = sorted(self._download_pending.keys())
+        try:
+            if self.debug:
+                print("Downloading %s [%u left]" % (url, self.tiles_pending()))
+            (status, resp_headers, img) = pool.request(url, headers)
+        except (OSError, http_client.HTTPException, TileException) + url_error as e:
+            status = None
+            resp_headers = None
+            if self.debug:
+                print("Failed %s: %s" % (url, str(e)))
+
+        if status == 304:
+            # cache hit; reset its refresh time
+            self._index.update(tile_info, time.time())
+            return
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+        if status != 200:
+            if status is not None and self.debug:
+                print("Failed %s: HTTP %s" % (url, status))
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            return
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+        content_type = resp_headers.get('content-type', None)
+        if content_type is None or content_type.find('image') == -1:
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            if self.debug:
+                print("non-image response %s" % url)
+            return
 
-            try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                req.add_header('User-Agent', 'MAVProxy')
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+                if not key in self._tile_cache:
+                    self._tile_cache[key] = self._unavailable
+            return
 
-                # try to re-use our cached data:
-                try:
-                    mtime = os.path.getmtime(path)
-                    req.add_header('If-Modified-Since', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime)))
-                except Exception:
-                    pass
-
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
+        mp_util.mkdir_p(os.path.dirname(path))
+        tmpname = '%s.%u.tmp' % (path, threading.get_ident())
+        h = open(tmpname,'wb')
+        h.write(img)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(tmpname, path)
+        self._index.update(tile_info, time.time())
+
+    def downloader(self):
+        '''a download thread'''
+        pool = TileConnectionPool()
+        try:
+            while True:
+                time.sleep(self.tile_delay)
+                tile_info = self.next_download()
+                if tile_info is None:
+                    break
                 try:
-                    if e.getcode() == 304:
-                        # cache hit; touch the file to reset its refresh time
-                        pathlib.Path(path).touch()
-                        self._download_pending.pop(key)
-                        continue
-                except Exception as ex:
-                    pass
+                    self.download_tile(pool, tile_info)
+                finally:
+                    self.download_done(tile_info.key())
+        finally:
+            pool.close()
+            with self._download_lock:
+                self._download_threads -= 1
 
-                #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
+    def start_download_thread(self):
+        '''start enough download threads for the pending tiles'''
+        with self._download_lock:
+            wanted = min(self.download_threads, len(self._download_pending) - len(self._download_active))
+            while self._download_threads < wanted:
+                t = threading.Thread(target=self.downloader, name='tile_download')
+                t.daemon = True
+                self._download_threads += 1
+                t.start()
+
+    def queue_download(self, tile):
+        '''add a tile to the download queue'''
+        key = tile.key()
+        with self._download_lock:
+            if key in self._download_pending:
+                self._download_pending[key].refresh_time()
             else:
-                img = resp.read()
-
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
+                self._download_pending[key] = tile
+        self.start_download_thread()
 
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
+    def tile_mtime(self, tile):
+        '''return modification time of a tile in the disk cache, or
+        None if it is not cached'''
+        mtime = self._index.lookup(tile)
+        if mtime is not None:
+            return mtime
+        if self._index.db is not None and tile.key() in self._download_pending:
+            # not in the index and being downloaded, so not on disk yet
+            return None
+        # tiles cached before the index existed
+        try:
+            mtime = os.path.getmtime(self.tile_to_path(tile))
+        except OSError:
+            return None
+        self._index.update(tile, mtime)
+        return mtime
 
-    def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
-            return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+    def cache_tile(self, key, img):
+        '''add an image to the in-memory tile cache'''
+        self._tile_cache[key] = img
+        while len(self._tile_cache) > self.cache_size:
+            self._tile_cache.popitem(last=False)
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -382,20 +593,18 @@ class MPTile:
             key = tile_info.key()
             if key in self._tile_cache:
                 img = self._tile_cache[key]
-                if np.array_equal(img, np.array(self._unavailable)):
+                if img is self._unavailable:
                     continue
+                self._tile_cache.move_to_end(key)
             else:
-                path = self.tile_to_path(tile_info)
-                if not os.path.exists(path):
+                if self.tile_mtime(tile_info) is None:
                     continue
-                img = cv2.imread(path)
+                img = cv2.imread(self.tile_to_path(tile_info))
                 if img is None:
                     continue
                 #cv2.rectangle(img, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
                 # add it to the tile cache
-                self._tile_cache[key] = img
-                while len(self._tile_cache) > self.cache_size:
-                    self._tile_cache.popitem(0)
+                self.cache_tile(key, img)
 
             # copy out the quadrant we want
             availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -420,32 +629,30 @@ class MPTile:
         key = tile.key()
         if key in self._tile_cache:
             img = self._tile_cache[key]
-            if np.array_equal(img, self._unavailable):
+            if img is self._unavailable:
                 img = self.load_tile_lowres(tile)
                 if img is None:
                     img = self._unavailable
+            else:
+                self._tile_cache.move_to_end(key)
             return img
 
-
-        path = self.tile_to_path(tile)
-        if not os.path.exists(path):
+        mtime = self.tile_mtime(tile)
+        if mtime is None:
             ret = None
         else:
-            ret = cv2.imread(path)
+            ret = cv2.imread(self.tile_to_path(tile))
+            if ret is None:
+                # removed from the disk cache behind our back
+                self._index.remove(tile)
         if ret is not None:
             #cv2.rectangle(ret, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
             # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
+            if mtime + self.refresh_age < time.time():
+                self.queue_download(tile)
+
             # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
+            self.cache_tile(key, ret)
             return ret
 
         if not self.download:
@@ -454,11 +661,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -592,10 +795,11 @@ class MPTile:
 
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
-        # close to the middle of the image first
+        # downloads happen close to the middle of the image first, and
+        # tiles which have scrolled out of view are not downloaded
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self.set_view(midlat, midlon, set([t.key() for t in tlist]))
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
         for t in tlist:
@@ -653,6 +857,7 @@ if __name__ == "__main__":
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--threads", type='int', default=4, help="tile download threads")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
@@ -671,7 +876,8 @@ if __name__ == "__main__":
         print(lat, lon, ground_width)
 
     mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
+            tile_delay=opts.delay, max_zoom=opts.max_zoom,
+            download_threads=opts.threads)
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
     else:
@@ -4,6 +4,146 @@ from MAVProxy.modules.lib import mp_module
 import paho.mqtt.client as mqtt
 import json
 import numbers
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def convert_to_dict(message):
+    """converts mavlink message to python dict"""
+    if hasattr(message, '_fieldnames'):
+        result = {}
+        for field in message._fieldnames:
+            result[field] = convert_to_dict(getattr(message, field))
+        return result
+    if isinstance(message, numbers.Number):
+        return message
+    return str(message)
+
+
+def parse_types(value):
+    """parse a comma separated list of message types into a set"""
+    return set([t.strip() for t in value.split(',') if t.strip()])
+
+
+def parse_rates(value):
+    """parse TYPE:HZ,TYPE:HZ into a dict"""
+    ret = {}
+    for item in value.split(','):
+        if ':' not in item:
+            continue
+        (mtype, rate) = item.split(':', 1)
+        try:
+            ret[mtype.strip()] = float(rate)
+        except ValueError:
+            print(f'mqtt: bad rate {item}')
+    return ret
+
+
+class MqttPublisher(object):
+    """publish messages from a thread. Only the latest message of each
+    topic is kept, so a slow broker delays updates rather than building
+    a backlog, and each topic is published at most at its rate cap"""
+
+    def __init__(self, client, max_topics=1000):
+        self.client = client
+        self.max_topics = max_topics
+        self.encoding = 'json'
+        self.default_rate = 0
+        self.rates = {}
+        # topic -> (mtype, msg) waiting to be published
+        self.pending = {}
+        self.next_publish = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.published = 0
+        self.coalesced = 0
+        self.dropped_full = 0
+        self.dropped_broker = 0
+        self.errors = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='mqtt_publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(1.0)
+            self.thread = None
+
+    def queue(self, topic, mtype, msg):
+        """queue a message, replacing any unpublished message on the topic"""
+        with self.cond:
+            if topic in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_topics:
+                self.dropped_full += 1
+                return
+            self.pending[topic] = (mtype, msg)
+            self.cond.notify()
+
+    def encode(self, msg):
+        """encode a message for publishing"""
+        if self.encoding == 'raw':
+            return msg.get_msgbuf()
+        if self.encoding == 'msgpack' and msgpack is not None:
+            return msgpack.packb(convert_to_dict(msg))
+        return json.dumps(convert_to_dict(msg))
+
+    def take_ready(self):
+        """wait for and return the list of topics due to be published"""
+        with self.cond:
+            while self.running:
+                tnow = time.time()
+                ready = []
+                wait = 0.5
+                for (topic, (mtype, msg)) in self.pending.items():
+                    t = self.next_publish.get(topic, 0)
+                    if t <= tnow:
+                        ready.append((topic, mtype, msg))
+                    else:
+                        wait = min(wait, t - tnow)
+                if ready:
+                    for (topic, mtype, msg) in ready:
+                        del self.pending[topic]
+                        rate = self.rates.get(mtype, self.default_rate)
+                        if rate > 0:
+                            self.next_publish[topic] = tnow + 1.0 / rate
+                    return ready
+                self.cond.wait(wait)
+        return []
+
+    def run(self):
+        while self.running:
+            for (topic, mtype, msg) in self.take_ready():
+                try:
+                    info = self.client.publish(topic, self.encode(msg))
+                except (MQTTException, ValueError) as e:
+                    self.errors += 1
+                    print(f'mqtt: Exception occurred: {e}')
+                    continue
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.published += 1
+                elif info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                    self.dropped_broker += 1
+                else:
+                    self.errors += 1
+
+    def status(self):
+        return (f'published:{self.published} pending:{len(self.pending)} coalesced:{self.coalesced} '
+                f'dropped_full:{self.dropped_full} dropped_broker:{self.dropped_broker} errors:{self.errors}')
 
 
 class MqttModule(mp_module.MPModule):
@@ -16,30 +156,73 @@ class MqttModule(mp_module.MPModule):
             [('ip', str, '127.0.0.1'),
              ('port', int, '1883'),
              ('name', str, 'mavproxy'),
-             ('prefix', str, '')
+             ('prefix', str, ''),
+             ('encoding', str, 'json'),
+             ('rate', float, 0),
+             ('rates', str, ''),
+             ('allow', str, ''),
+             ('deny', str, ''),
+             ('queue_size', int, 1000),
              ])
-        self.add_command('mqtt', self.mqtt_command, "mqtt module", ['connect', 'set (MQTTSETTING)'])
+        self.mqtt_settings.set_callback(self.settings_changed)
+        self.publisher = MqttPublisher(self.client)
+        self.allow = set()
+        self.deny = set()
+        self.filtered = 0
+        self.apply_settings()
+        self.add_command('mqtt', self.mqtt_command, "mqtt module", ['connect', 'disconnect', 'status',
+                                                                   'set (MQTTSETTING)'])
         self.add_completion_function('(MQTTSETTING)', self.mqtt_settings.completion)
 
+    def apply_settings(self):
+        """update the filters and publisher from the settings"""
+        self.allow = parse_types(self.mqtt_settings.allow)
+        self.deny = parse_types(self.mqtt_settings.deny)
+        encoding = self.mqtt_settings.encoding
+        if encoding not in ['json', 'msgpack', 'raw']:
+            print(f'mqtt: unknown encoding {encoding}, using json')
+            encoding = 'json'
+        elif encoding == 'msgpack' and msgpack is None:
+            print('mqtt: msgpack not installed, using json')
+            encoding = 'json'
+        self.publisher.encoding = encoding
+        self.publisher.default_rate = self.mqtt_settings.rate
+        self.publisher.rates = parse_rates(self.mqtt_settings.rates)
+        self.publisher.max_topics = self.mqtt_settings.queue_size
+
+    def settings_changed(self, setting):
+        self.apply_settings()
+
     def mavlink_packet(self, m):
         """handle an incoming mavlink packet"""
-        try:
-            data = self.convert_to_dict(m)
-            self.client.publish(f'{self.mqtt_settings.prefix}/{m.get_type()}', json.dumps(data))
-        except MQTTException as e:
-            print(f'mqtt: Exception occurred: {e}')
+        mtype = m.get_type()
+        if (self.allow and mtype not in self.allow) or mtype in self.deny:
+            self.filtered += 1
+            return
+        self.publisher.queue(f'{self.mqtt_settings.prefix}/{mtype}', mtype, m)
 
     def connect(self):
         """connect to mqtt broker"""
+        self.publisher.stop()
         try:
             self.client.reinitialise(client_id=self.mqtt_settings.name)
+            # limit the messages paho holds when the broker is slow
+            self.client.max_queued_messages_set(self.mqtt_settings.queue_size)
             print(f'connecting to {self.mqtt_settings.ip}:{self.mqtt_settings.port}')
             self.client.connect(self.mqtt_settings.ip, int(self.mqtt_settings.port), 30)
-        except MQTTException as e:
+        except (MQTTException, OSError) as e:
             print(f'mqtt: could not establish connection: {e}')
             return
+        self.client.loop_start()
+        self.publisher.start()
         print('connected...')
 
+    def disconnect(self):
+        """disconnect from mqtt broker"""
+        self.publisher.stop()
+        self.client.disconnect()
+        self.client.loop_stop()
+
     def mqtt_command(self, args):
         """control behaviour of the module"""
         if len(args) == 0:
@@ -48,21 +231,21 @@ class MqttModule(mp_module.MPModule):
             self.mqtt_settings.command(args[1:])
         elif args[0] == 'connect':
             self.connect()
+        elif args[0] == 'disconnect':
+            self.disconnect()
+        elif args[0] == 'status':
+            print(f'mqtt: {self.publisher.status()} filtered:{self.filtered}')
 
     def usage(self):
         """show help on command line options"""
-        return "Usage: mqtt <set|connect>"
+        return "Usage: mqtt <set|connect|disconnect|status>"
 
     def convert_to_dict(self, message):
         """converts mavlink message to python dict"""
-        if hasattr(message, '_fieldnames'):
-            result = {}
-            for field in message._fieldnames:
-                result[field] = self.convert_to_dict(getattr(message, field))
-            return result
-        if isinstance(message, numbers.Number):
-            return message
-        return str(message)
+        return convert_to_dict(message)
+
+    def unload(self):
+        self.disconnect()
 
 
 def init(mpstate):
@@ -22,7 +22,6 @@
 
 #Utility functions
 
-import copy
 import hashlib
 import random
 
@@ -132,7 +131,7 @@ class MarkerData:
         self.model_name = model_name
 
     def add_pos(self, pos):
-        self.marker_pos_list.append(copy.deepcopy(pos))
+        self.marker_pos_list.append(pos)
         return len(self.marker_pos_list)
 
 
@@ -161,7 +160,7 @@ class MarkerSetData:
         self.unlabeled_markers.set_model_name("")
 
     def add_marker_data(self, marker_data):
-        self.marker_data_list.append(copy.deepcopy(marker_data))
+        self.marker_data_list.append(marker_data)
         return len(self.marker_data_list)
 
     def add_unlabeled_marker(self, pos):
@@ -195,7 +194,7 @@ class LegacyMarkerData:
         self.marker_pos_list=[]
 
     def add_pos(self, pos):
-        self.marker_pos_list.append(copy.deepcopy(pos))
+        self.marker_pos_list.append(pos)
         return len(self.marker_pos_list)
 
     def get_marker_count(self):
@@ -245,7 +244,7 @@ class RigidBody:
         self.marker_num = -1
 
     def add_rigid_body_marker(self, rigid_body_marker):
-        self.rb_marker_list.append(copy.deepcopy(rigid_body_marker))
+        self.rb_marker_list.append(rigid_body_marker)
         return len(self.rb_marker_list)
 
 
@@ -293,7 +292,7 @@ class RigidBodyData:
 
 
     def add_rigid_body(self, rigid_body):
-        self.rigid_body_list.append(copy.deepcopy(rigid_body))
+        self.rigid_body_list.append(rigid_body)
         return len(self.rigid_body_list)
 
 
@@ -321,7 +320,7 @@ class Skeleton:
 
 
     def add_rigid_body(self, rigid_body):
-        self.rigid_body_list.append(copy.deepcopy(rigid_body))
+        self.rigid_body_list.append(rigid_body)
         return len(self.rigid_body_list)
 
 
@@ -344,7 +343,7 @@ class SkeletonData:
 
 
     def add_skeleton(self, new_skeleton):
-        self.skeleton_list.append(copy.deepcopy(new_skeleton))
+        self.skeleton_list.append(new_skeleton)
 
 
     def get_skeleton_count(self):
@@ -432,11 +431,11 @@ class Asset:
         self.asset_id=new_id
 
     def add_rigid_body(self, rigid_body):
-        self.rigid_body_list.append(copy.deepcopy(rigid_body))
+        self.rigid_body_list.append(rigid_body)
         return len(self.rigid_body_list)
 
     def add_marker(self, marker):
-        self.marker_list.append(copy.deepcopy(marker))
+        self.marker_list.append(marker)
         return len(self.marker_list)
 
     def get_rigid_body_count(self):
@@ -474,7 +473,7 @@ class AssetData:
         self.asset_list=[]
 
     def add_asset(self, new_asset):
-        self.asset_list.append(copy.deepcopy(new_asset))
+        self.asset_list.append(new_asset)
 
     def get_asset_count(self):
         return len(self.asset_list)
@@ -541,7 +540,7 @@ class LabeledMarkerData:
         self.labeled_marker_list=[]
 
     def add_labeled_marker(self, labeled_marker):
-        self.labeled_marker_list.append(copy.deepcopy(labeled_marker))
+        self.labeled_marker_list.append(labeled_marker)
         return len(self.labeled_marker_list)
 
     def get_labeled_marker_count(self):
@@ -567,7 +566,7 @@ class ForcePlateChannelData:
 
 
     def add_frame_entry(self, frame_entry):
-        self.frame_list.append(copy.deepcopy(frame_entry))
+        self.frame_list.append(frame_entry)
         return len(self.frame_list)
 
 
@@ -595,7 +594,7 @@ class ForcePlate:
         self.channel_data_list=[]
 
     def add_channel_data(self, channel_data):
-        self.channel_data_list.append(copy.deepcopy(channel_data))
+        self.channel_data_list.append(channel_data)
         return len(self.channel_data_list)
 
     def get_as_string(self, tab_str, level):
@@ -614,7 +613,7 @@ class ForcePlateData:
         self.force_plate_list=[]
 
     def add_force_plate(self, force_plate):
-        self.force_plate_list.append(copy.deepcopy(force_plate))
+        self.force_plate_list.append(force_plate)
         return len(self.force_plate_list)
 
 
@@ -642,7 +641,7 @@ class DeviceChannelData:
 
 
     def add_frame_entry(self, frame_entry):
-        self.frame_list.append(copy.deepcopy(frame_entry))
+        self.frame_list.append(frame_entry)
         return len(self.frame_list)
 
 
@@ -671,7 +670,7 @@ class Device:
         self.channel_data_list = []
 
     def add_channel_data(self, channel_data):
-        self.channel_data_list.append(copy.deepcopy(channel_data))
+        self.channel_data_list.append(channel_data)
         return len(self.channel_data_list)
 
     def get_as_string(self, tab_str, level, device_num):
@@ -692,7 +691,7 @@ class DeviceData:
         self.device_list=[]
 
     def add_device(self, device):
-        self.device_list.append(copy.deepcopy(device))
+        self.device_list.append(device)
         return len(self.device_list)
 
 
@@ -52,8 +52,121 @@ Quaternion = struct.Struct( '<ffff' )
 FloatValue = struct.Struct( '<f' )
 DoubleValue = struct.Struct( '<d' )
 NNIntValue = struct.Struct( '<I')
+Int32Value = struct.Struct( '<i' )
+Int64Value = struct.Struct( '<q' )
+ShortValue = struct.Struct( '<h' )
 FPCalMatrixRow = struct.Struct( '<ffffffffffff' )
 FPCorners      = struct.Struct( '<ffffffffffff')
+# header of each packet in a recording: receive time, NatNet version, length
+RecordHeader = struct.Struct( '<dBBI' )
+
+def unpack_cstring( data, offset ):
+    """return the NUL terminated string at offset in data, without
+    copying the rest of the packet"""
+    end = offset
+    while True:
+        block = bytes( data[end:end+64] )
+        i = block.find( b'\0' )
+        if i >= 0:
+            return bytes( data[offset:end+i] )
+        if len( block ) < 64:
+            return bytes( data[offset:] )
+        end += 64
+
+def has_data_size( major, minor ):
+    """NatNet 4.1 and later give the size of each section of a frame"""
+    return ( ( major == 4 ) and ( minor > 0 ) ) or ( major > 4 )
+
+def unpack_rigid_body_poses( data, offset, count, major, minor, ids, ret ):
+    """add (id, pos, rot) of count rigid bodies at offset to ret,
+    skipping those not in ids unless ids is None. Returns the offset
+    after the rigid bodies"""
+    for i in range( count ):
+        new_id, = Int32Value.unpack_from( data, offset )
+        if ids is None or new_id in ids:
+            ret.append( ( new_id, Vector3.unpack_from( data, offset+4 ), Quaternion.unpack_from( data, offset+16 ) ) )
+        offset += 32
+        if major < 3 and major != 0:
+            marker_count, = Int32Value.unpack_from( data, offset )
+            offset += 4 + 12 * marker_count
+            if major >= 2:
+                offset += 8 * marker_count
+        if major >= 2:
+            offset += 4
+        if ( ( major == 2 ) and ( minor >= 6 ) ) or major > 2:
+            offset += 2
+    return offset
+
+def unpack_frame_rigid_bodies( data, major, minor, ids=None ):
+    """return a list of (id, pos, rot) of the rigid bodies, including
+    those of skeletons, in a NAT_FRAMEOFDATA packet. Nothing else in
+    the frame is decoded, and if ids is given only those rigid bodies
+    are returned, stopping once they have all been found"""
+    ret = []
+    sized = has_data_size( major, minor )
+    # message ID, packet size and frame number
+    offset = 8
+
+    # marker sets
+    count, = Int32Value.unpack_from( data, offset )
+    offset += 4
+    if sized:
+        size, = Int32Value.unpack_from( data, offset )
+        offset += 4 + size
+    else:
+        for i in range( count ):
+            offset += len( unpack_cstring( data, offset ) ) + 1
+            marker_count, = Int32Value.unpack_from( data, offset )
+            offset += 4 + 12 * marker_count
+
+    # legacy other markers
+    count, = Int32Value.unpack_from( data, offset )
+    offset += 4
+    if sized:
+        size, = Int32Value.unpack_from( data, offset )
+        offset += 4 + size
+    else:
+        offset += 12 * count
+
+    # rigid bodies
+    count, = Int32Value.unpack_from( data, offset )
+    offset += 4
+    if sized:
+        offset += 4
+    offset = unpack_rigid_body_poses( data, offset, count, major, minor, ids, ret )
+    if ids is not None and len( ret ) >= len( ids ):
+        return ret
+
+    # skeletons (version 2.1 and later)
+    if ( major == 2 and minor > 0 ) or major > 2:
+        count, = Int32Value.unpack_from( data, offset )
+        offset += 4
+        if sized:
+            offset += 4
+        for i in range( count ):
+            rigid_body_count, = Int32Value.unpack_from( data, offset+4 )
+            offset = unpack_rigid_body_poses( data, offset+8, rigid_body_count, major, minor, ids, ret )
+    return ret
+
+def write_recorded_packet( fh, data, major, minor, receive_time ):
+    """append a received packet to a recording"""
+    fh.write( RecordHeader.pack( receive_time, major, minor, len( data ) ) )
+    fh.write( data )
+
+def read_recorded_packets( fh ):
+    """return a list of (receive_time, major, minor, data) of the
+    packets in a recording"""
+    ret = []
+    while True:
+        header = fh.read( RecordHeader.size )
+        if len( header ) < RecordHeader.size:
+            break
+        receive_time, major, minor, length = RecordHeader.unpack( header )
+        data = fh.read( length )
+        if len( data ) < length:
+            break
+        ret.append( ( receive_time, major, minor, data ) )
+    return ret
 
 class NatNetClient:
     # print_level = 0 off
@@ -83,6 +196,20 @@ class NatNetClient:
         self.rigid_body_listener = None
         self.new_frame_listener  = None
 
+        # Set this to a set of rigid body IDs to only decode those from
+        # each frame, when there is no new_frame_listener and frames
+        # aren't being printed. rigid_body_listener is then only called
+        # for those rigid bodies
+        self.rigid_body_ids = None
+
+        # time.time() when the packet being processed was received
+        self.frame_receive_time = 0
+        self.frame_count = 0
+
+        # Set this to a file opened for binary writing to record the
+        # data packets received, see read_recorded_packets()
+        self.record_file = None
+
         # Set Application Name
         self.__application_name = "Not Set"
 
@@ -325,17 +452,17 @@ class NatNetClient:
         offset = 0
 
         # ID (4 bytes)
-        new_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        new_id = Int32Value.unpack_from( data, offset )[0]
         offset += 4
 
         trace_mf( "RB: %3.1d ID: %3.1d"% (rb_num, new_id))
 
         # Position and orientation
-        pos = Vector3.unpack( data[offset:offset+12] )
+        pos = Vector3.unpack_from( data, offset )
         offset += 12
         trace_mf( "\tPosition    : [%3.2f, %3.2f, %3.2f]"% (pos[0], pos[1], pos[2] ))
 
-        rot = Quaternion.unpack( data[offset:offset+16] )
+        rot = Quaternion.unpack_from( data, offset )
         offset += 16
         trace_mf( "\tOrientation : [%3.2f, %3.2f, %3.2f, %3.2f]"% (rot[0], rot[1], rot[2], rot[3] ))
 
@@ -348,7 +475,7 @@ class NatNetClient:
         # RB Marker Data ( Before version 3.0.  After Version 3.0 Marker data is in description )
         if( major < 3  and major != 0) :
             # Marker count (4 bytes)
-            marker_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            marker_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             marker_count_range = range( 0, marker_count )
             trace_mf( "\tMarker Count:", marker_count )
@@ -359,7 +486,7 @@ class NatNetClient:
 
             # Marker positions
             for i in marker_count_range:
-                pos = Vector3.unpack( data[offset:offset+12] )
+                pos = Vector3.unpack_from( data, offset )
                 offset += 12
                 trace_mf( "\tMarker", i, ":", pos[0],",", pos[1],",", pos[2] )
                 rb_marker_list[i].pos=pos
@@ -367,14 +494,14 @@ class NatNetClient:
             if major >= 2:
                 # Marker ID's
                 for i in marker_count_range:
-                    new_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                    new_id = Int32Value.unpack_from( data, offset )[0]
                     offset += 4
                     trace_mf( "\tMarker ID", i, ":", new_id )
                     rb_marker_list[i].id=new_id
 
                 # Marker sizes
                 for i in marker_count_range:
-                    size = FloatValue.unpack( data[offset:offset+4] )
+                    size = FloatValue.unpack_from( data, offset )
                     offset += 4
                     trace_mf( "\tMarker Size", i, ":", size[0] )
                     rb_marker_list[i].size=size
@@ -382,14 +509,14 @@ class NatNetClient:
             for i in marker_count_range:
                 rigid_body.add_rigid_body_marker(rb_marker_list[i])
         if major >= 2 :
-            marker_error, = FloatValue.unpack( data[offset:offset+4] )
+            marker_error, = FloatValue.unpack_from( data, offset )
             offset += 4
             trace_mf( "\tMean Marker Error: %3.2f"% marker_error )
             rigid_body.error = marker_error
 
         # Version 2.6 and later
         if ( ( major == 2 ) and ( minor >= 6 ) ) or major > 2 :
-            param, = struct.unpack( 'h', data[offset:offset+2] )
+            param, = ShortValue.unpack_from( data, offset )
             tracking_valid = ( param & 0x01 ) != 0
             offset += 2
             is_valid_str='False'
@@ -406,12 +533,12 @@ class NatNetClient:
     # Unpack a skeleton object from a data packet
     def __unpack_skeleton( self, data, major, minor, skeleton_num=0):
         offset = 0
-        new_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        new_id = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Skeleton %3.1d ID: %3.1d"% (skeleton_num, new_id ))
         skeleton = MoCapData.Skeleton(new_id)
 
-        rigid_body_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        rigid_body_count = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Rigid Body Count : %3.1d"% rigid_body_count )
         if(rigid_body_count > 0):
@@ -426,7 +553,7 @@ class NatNetClient:
         offset = 0
         trace_dd( "\tAsset        : %d"% (asset_num ))
         # Asset ID 4 bytes
-        new_id =  int.from_bytes(data[offset:offset+4],'little',  signed=True)
+        new_id =  Int32Value.unpack_from( data, offset )[0]
         offset += 4
         asset = MoCapData.Asset()
     
@@ -434,7 +561,7 @@ class NatNetClient:
         asset.set_id(new_id)
 
         # # of RigidBodies
-        numRBs =  int.from_bytes(data[offset:offset+4],'little',  signed=True)
+        numRBs =  Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_dd( "\tRigid Bodies : %d" % (numRBs))
         
@@ -447,7 +574,7 @@ class NatNetClient:
             asset.add_rigid_body(rigid_body)
 
         # # of Markers
-        numMarkers =  int.from_bytes(data[offset:offset+4],'little',  signed=True)
+        numMarkers =  Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_dd( "\tMarkers      : %d" % (numMarkers))
         
@@ -464,7 +591,7 @@ class NatNetClient:
     def __unpack_frame_prefix_data( self, data):
         offset = 0
         # Frame number (4 bytes)
-        frame_number = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        frame_number = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Frame #: %3.1d"% frame_number )
         frame_prefix_data=MoCapData.FramePrefixData(frame_number)
@@ -475,7 +602,7 @@ class NatNetClient:
         offset=0
 
         if( ( (major == 4) and (minor>0) ) or (major > 4)):
-            sizeInBytes = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            sizeInBytes = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             trace_mf( "Byte Count: %3.1d"% sizeInBytes )
 
@@ -485,7 +612,7 @@ class NatNetClient:
         offset = 0
 
         # Markerset count (4 bytes)
-        other_marker_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        other_marker_count = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Other Marker Count:", other_marker_count )
 
@@ -498,7 +625,7 @@ class NatNetClient:
             # get legacy_marker positions
             ### legacy_marker_data
             for j in range( 0, other_marker_count ):
-                pos = Vector3.unpack( data[offset:offset+12] )
+                pos = Vector3.unpack_from( data, offset )
                 offset += 12
                 trace_mf( "\tMarker %3.1d : [x=%3.2f,y=%3.2f,z=%3.2f]"%( j, pos[0], pos[1], pos[2] ))
                 other_marker_data.add_pos(pos)
@@ -509,7 +636,7 @@ class NatNetClient:
         marker_set_data=MoCapData.MarkerSetData()
         offset = 0
         # Markerset count (4 bytes)
-        marker_set_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        marker_set_count = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Markerset Count:", marker_set_count )
 
@@ -520,12 +647,12 @@ class NatNetClient:
         for i in range( 0, marker_set_count ):
             marker_data = MoCapData.MarkerData()
             # Model name
-            model_name, separator, remainder = bytes(data[offset:]).partition( b'\0' )
+            model_name = unpack_cstring( data, offset )
             offset += len( model_name ) + 1
             trace_mf( "Model Name      : ", model_name.decode( 'utf-8' ) )
             marker_data.set_model_name(model_name)
             # Marker count (4 bytes)
-            marker_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            marker_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             if(marker_count < 0):
                 print("WARNING: Early return.  Invalid marker count")
@@ -543,19 +670,19 @@ class NatNetClient:
                     offset = len(data)
                     return offset, marker_set_data
                     break
-                pos = Vector3.unpack( data[offset:offset+12] )
+                pos = Vector3.unpack_from( data, offset )
                 offset += 12
                 trace_mf( "\tMarker %3.1d : [x=%3.2f,y=%3.2f,z=%3.2f]"%( j, pos[0], pos[1], pos[2] ))
                 marker_data.add_pos(pos)
             marker_set_data.add_marker_data(marker_data)
 
         # Unlabeled markers count (4 bytes)
-        #unlabeled_markers_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        #unlabeled_markers_count = Int32Value.unpack_from( data, offset )[0]
         #offset += 4
         #trace_mf( "Unlabeled Marker Count:", unlabeled_markers_count )
 
         #for i in range( 0, unlabeled_markers_count ):
-        #    pos = Vector3.unpack( data[offset:offset+12] )
+        #    pos = Vector3.unpack_from( data, offset )
         #    offset += 12
         #    trace_mf( "\tMarker %3.1d : [%3.2f,%3.2f,%3.2f]"%( i, pos[0], pos[1], pos[2] ))
         #    marker_set_data.add_unlabeled_marker(pos)
@@ -565,7 +692,7 @@ class NatNetClient:
         rigid_body_data = MoCapData.RigidBodyData()
         offset = 0
         # Rigid body count (4 bytes)
-        rigid_body_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        rigid_body_count = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Rigid Body Count:", rigid_body_count )
 
@@ -588,7 +715,7 @@ class NatNetClient:
         # Version 2.1 and later
         skeleton_count = 0
         if( ( major == 2 and minor > 0 ) or major > 2 ):
-            skeleton_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            skeleton_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             trace_mf( "Skeleton Count:", skeleton_count )
             
@@ -616,7 +743,7 @@ class NatNetClient:
         # Labeled markers (Version 2.3 and later)
         labeled_marker_count = 0
         if( ( major == 2 and minor > 3 ) or major > 2 ):
-            labeled_marker_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            labeled_marker_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             trace_mf( "Labeled Marker Count:", labeled_marker_count )
 
@@ -627,12 +754,12 @@ class NatNetClient:
             for lm_num in range( 0, labeled_marker_count ):
                 model_id = 0
                 marker_id = 0
-                tmp_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                tmp_id = Int32Value.unpack_from( data, offset )[0]
                 offset += 4
                 model_id, marker_id = self.__decode_marker_id(tmp_id)
-                pos = Vector3.unpack( data[offset:offset+12] )
+                pos = Vector3.unpack_from( data, offset )
                 offset += 12
-                size = FloatValue.unpack( data[offset:offset+4] )
+                size = FloatValue.unpack_from( data, offset )
                 offset += 4
                 trace_mf("%3.1d ID     : [MarkerID: %3.1d] [ModelID: %3.1d]"%(lm_num, marker_id,model_id))
                 trace_mf("    pos  : [%3.2f, %3.2f, %3.2f]"%(pos[0],pos[1],pos[2]))
@@ -642,7 +769,7 @@ class NatNetClient:
                 # Version 2.6 and later
                 param = 0
                 if( ( major == 2 and minor >= 6 ) or major > 2):
-                    param, = struct.unpack( 'h', data[offset:offset+2] )
+                    param, = ShortValue.unpack_from( data, offset )
                     offset += 2
                     #occluded = ( param & 0x01 ) != 0
                     #point_cloud_solved = ( param & 0x02 ) != 0
@@ -651,7 +778,7 @@ class NatNetClient:
                 # Version 3.0 and later
                 residual = 0.0
                 if major >= 3 :
-                    residual, = FloatValue.unpack( data[offset:offset+4] )
+                    residual, = FloatValue.unpack_from( data, offset )
                     offset += 4
                     residual = residual * 1000.0
                     trace_mf( "    err  : [%3.2f]"% residual )
@@ -668,7 +795,7 @@ class NatNetClient:
         # Force Plate data (version 2.9 and later)
         force_plate_count = 0
         if( ( major == 2 and minor >= 9 ) or major > 2 ):
-            force_plate_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            force_plate_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             trace_mf( "Force Plate Count:", force_plate_count )
 
@@ -678,12 +805,12 @@ class NatNetClient:
 
             for i in range( 0, force_plate_count ):
                 # ID
-                force_plate_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                force_plate_id = Int32Value.unpack_from( data, offset )[0]
                 offset += 4
                 force_plate = MoCapData.ForcePlate(force_plate_id)
 
                 # Channel Count
-                force_plate_channel_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                force_plate_channel_count = Int32Value.unpack_from( data, offset )[0]
                 offset += 4
 
                 trace_mf( "\tForce Plate %3.1d ID: %3.1d Num Channels: %3.1d"% (i, force_plate_id, force_plate_channel_count ))
@@ -691,7 +818,7 @@ class NatNetClient:
                 # Channel Data
                 for j in range( force_plate_channel_count ):
                     fp_channel_data = MoCapData.ForcePlateChannelData()
-                    force_plate_channel_frame_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                    force_plate_channel_frame_count = Int32Value.unpack_from( data, offset )[0]
                     offset += 4
                     out_string="\tChannel %3.1d: "%( j )
                     out_string+="  %3.1d Frames - Frame Data: "%(force_plate_channel_frame_count)
@@ -699,7 +826,7 @@ class NatNetClient:
                     # Force plate frames
                     n_frames_show = min(force_plate_channel_frame_count, n_frames_show_max)
                     for k in range( force_plate_channel_frame_count ):
-                        force_plate_channel_val = FloatValue.unpack( data[offset:offset+4] )
+                        force_plate_channel_val = FloatValue.unpack_from( data, offset )
                         offset += 4
                         fp_channel_data.add_frame_entry(force_plate_channel_val)
 
@@ -719,7 +846,7 @@ class NatNetClient:
         # Device data (version 2.11 and later)
         device_count = 0
         if ( major == 2 and minor >= 11 ) or (major > 2) :
-            device_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+            device_count = Int32Value.unpack_from( data, offset )[0]
             offset += 4
             trace_mf( "Device Count:", device_count )
 
@@ -730,11 +857,11 @@ class NatNetClient:
             for i in range( 0, device_count ):
 
                 # ID
-                device_id = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                device_id = Int32Value.unpack_from( data, offset )[0]
                 offset += 4
                 device = MoCapData.Device(device_id)
                 # Channel Count
-                device_channel_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                device_channel_count = Int32Value.unpack_from( data, offset )[0]
                 offset += 4
 
                 trace_mf( "\tDevice %3.1d      ID: %3.1d Num Channels: %3.1d"% (i, device_id, device_channel_count ))
@@ -742,7 +869,7 @@ class NatNetClient:
                 # Channel Data
                 for j in range( 0, device_channel_count ):
                     device_channel_data = MoCapData.DeviceChannelData()
-                    device_channel_frame_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                    device_channel_frame_count = Int32Value.unpack_from( data, offset )[0]
                     offset += 4
                     out_string="\tChannel %3.1d "% (j)
                     out_string+="  %3.1d Frames - Frame Data: "%(device_channel_frame_count)
@@ -750,8 +877,8 @@ class NatNetClient:
                     # Device Frame Data
                     n_frames_show = min(device_channel_frame_count, n_frames_show_max)
                     for k in range( 0, device_channel_frame_count ):
-                        device_channel_val = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
-                        device_channel_val = FloatValue.unpack( data[offset:offset+4] )
+                        device_channel_val = Int32Value.unpack_from( data, offset )[0]
+                        device_channel_val = FloatValue.unpack_from( data, offset )
                         offset += 4
                         if k < n_frames_show:
                             out_string += "%3.2f "%(device_channel_val)
@@ -769,11 +896,11 @@ class NatNetClient:
         offset = 0
 
         # Timecode
-        timecode = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        timecode = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         frame_suffix_data.timecode = timecode
 
-        timecode_sub = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        timecode_sub = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         frame_suffix_data.timecode_sub = timecode_sub
 
@@ -785,34 +912,34 @@ class NatNetClient:
         else:
             # Timestamp (increased to double precision in 2.7 and later)
             if ( major == 2 and minor >= 7 ) or (major > 2 ):
-                timestamp, = DoubleValue.unpack( data[offset:offset+8] )
+                timestamp, = DoubleValue.unpack_from( data, offset )
                 offset += 8
             else:
-                timestamp, = FloatValue.unpack( data[offset:offset+4] )
+                timestamp, = FloatValue.unpack_from( data, offset )
                 offset += 4
             trace_mf("Timestamp : %3.2f"%timestamp)
             frame_suffix_data.timestamp = timestamp
 
             # Hires Timestamp (Version 3.0 and later)
             if major >= 3 :
-                stamp_camera_mid_exposure = int.from_bytes( data[offset:offset+8], byteorder='little',  signed=True )
+                stamp_camera_mid_exposure = Int64Value.unpack_from( data, offset )[0]
                 trace_mf("Mid-exposure timestamp         : %3.1d"%stamp_camera_mid_exposure)
                 offset += 8
                 frame_suffix_data.stamp_camera_mid_exposure = stamp_camera_mid_exposure
 
-                stamp_data_received = int.from_bytes( data[offset:offset+8], byteorder='little',  signed=True )
+                stamp_data_received = Int64Value.unpack_from( data, offset )[0]
                 offset += 8
                 frame_suffix_data.stamp_data_received = stamp_data_received
                 trace_mf("Camera data received timestamp : %3.1d"%stamp_data_received)
 
-                stamp_transmit = int.from_bytes( data[offset:offset+8], byteorder='little',  signed=True )
+                stamp_transmit = Int64Value.unpack_from( data, offset )[0]
                 offset += 8
                 trace_mf("Transmit timestamp             : %3.1d"%stamp_transmit)
                 frame_suffix_data.stamp_transmit = stamp_transmit
 
             # Precision Timestamp (Version 4.1 and later) (defaults as 0 if N/A)
             if major >= 4:
-                prec_timestamp_secs = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                prec_timestamp_secs = Int32Value.unpack_from( data, offset )[0]
                 #hours = int(prec_timestamp_secs/3600)
                 #minutes=int(prec_timestamp_secs/60)%60
                 #seconds=prec_timestamp_secs%60
@@ -822,13 +949,13 @@ class NatNetClient:
                 offset += 4
                 frame_suffix_data.prec_timestamp_secs = prec_timestamp_secs
 
-                prec_timestamp_frac_secs = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+                prec_timestamp_frac_secs = Int32Value.unpack_from( data, offset )[0]
                 trace_mf("Precision timestamp (frac sec) : %3.1d"%prec_timestamp_frac_secs)
                 offset += 4
                 frame_suffix_data.prec_timestamp_frac_secs = prec_timestamp_frac_secs
 
             # Frame parameters
-            param, = struct.unpack( 'h', data[offset:offset+2] )
+            param, = ShortValue.unpack_from( data, offset )
             offset += 2
         is_recording = ( param & 0x01 ) != 0
         tracked_models_changed = ( param & 0x02 ) != 0
@@ -1251,27 +1378,27 @@ class NatNetClient:
     def __unpack_asset_rigid_body_data( self, data, major, minor ):
         offset = 0
         # ID
-        rbID =  int.from_bytes(data[offset:offset+4],'little',  signed=True)
+        rbID =  Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_dd( "\tID         : %d"% (rbID ))
 
         # Position: x,y,z
-        pos = Vector3.unpack( data[offset:offset+12] )
+        pos = Vector3.unpack_from( data, offset )
         offset += 12
         trace_mf( "\tPosition    : [%3.2f, %3.2f, %3.2f]"% (pos[0], pos[1], pos[2] ))
 
         # Orientation: qx, qy, qz, qw
-        rot = Quaternion.unpack( data[offset:offset+16] )
+        rot = Quaternion.unpack_from( data, offset )
         offset += 16
         trace_mf( "\tOrientation : [%3.2f, %3.2f, %3.2f, %3.2f]"% (rot[0], rot[1], rot[2], rot[3] ))
 
         # Mean error
-        mean_error, = FloatValue.unpack( data[offset:offset+4] )
+        mean_error, = FloatValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "\tMean Error  : %3.2f"% mean_error )
 
         # Params
-        marker_params, = struct.unpack( 'h', data[offset:offset+2] )
+        marker_params, = ShortValue.unpack_from( data, offset )
         offset += 2
         trace_mf( "\tParams      :", marker_params )
 
@@ -1285,27 +1412,27 @@ class NatNetClient:
     def __unpack_asset_marker_data( self, data, major, minor ):
         offset = 0
         # ID
-        marker_id =  int.from_bytes(data[offset:offset+4],'little',  signed=True)
+        marker_id =  Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_dd( "\tID          : %d"% (marker_id ))
 
         # Position: x,y,z
-        pos = Vector3.unpack( data[offset:offset+12] )
+        pos = Vector3.unpack_from( data, offset )
         offset += 12
         trace_mf( "\tPosition    : [%3.2f, %3.2f, %3.2f]"% (pos[0], pos[1], pos[2] ))
 
         # Size
-        marker_size, = FloatValue.unpack( data[offset:offset+4] )
+        marker_size, = FloatValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "\tMarker Size : %3.2f"% marker_size )
 
         # Params
-        marker_params, = struct.unpack( 'h', data[offset:offset+2] )
+        marker_params, = ShortValue.unpack_from( data, offset )
         offset += 2
         trace_mf( "\tParams      :", marker_params )
 
         # Residual
-        residual, = FloatValue.unpack( data[offset:offset+4] )
+        residual, = FloatValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "\tResidual    : %3.2f"% residual )
 
@@ -1318,7 +1445,7 @@ class NatNetClient:
         offset = 0
 
         # Asset Count
-        asset_count = int.from_bytes( data[offset:offset+4], byteorder='little',  signed=True )
+        asset_count = Int32Value.unpack_from( data, offset )[0]
         offset += 4
         trace_mf( "Asset Count:", asset_count )
 
@@ -1586,6 +1713,14 @@ class NatNetClient:
                 print("ERROR: data socket access timeout occurred. Server not responding")
                 #return 4
             if len( data ) > 0 :
+                self.frame_receive_time = time.time()
+                record_file = self.record_file
+                if record_file is not None:
+                    try:
+                        write_recorded_packet( record_file, data, self.get_major(), self.get_minor(), self.frame_receive_time )
+                    except ValueError:
+                        # recording stopped
+                        pass
                 #peek ahead at message_id
                 message_id = get_message_id(data)
                 tmp_str="mi_%1.1d"%message_id
@@ -1600,7 +1735,10 @@ class NatNetClient:
                             print_level = 1
                         else:
                             print_level = 0
-                message_id = self.__process_message( data , print_level)
+                try:
+                    message_id = self.__process_message( data , print_level)
+                except ( struct.error, UnicodeDecodeError, IndexError, ValueError ) as msg:
+                    print("ERROR: malformed NatNet packet: %s" % msg)
 
                 data=bytearray(0)
         return 0
@@ -1622,18 +1760,31 @@ class NatNetClient:
 
         packet_size = int.from_bytes( data[2:4], byteorder='little',  signed=True )
 
+        # slices of a memoryview share the packet rather than copying it
+        data = memoryview( data )
+
         #skip the 4 bytes for message ID and packet_size
         offset = 4
         if message_id == self.NAT_FRAMEOFDATA :
             trace( "Message ID  : %3.1d NAT_FRAMEOFDATA"% message_id )
             trace( "Packet Size : ", packet_size )
+            self.frame_count += 1
+
+            rigid_body_ids = self.rigid_body_ids
+            if rigid_body_ids is not None and self.new_frame_listener is None and print_level < 1:
+                # only the rigid bodies we want are needed
+                rigid_bodies = unpack_frame_rigid_bodies( data, major, minor, rigid_body_ids )
+                if self.rigid_body_listener is not None:
+                    for ( new_id, pos, rot ) in rigid_bodies:
+                        self.rigid_body_listener( new_id, pos, rot )
+                return message_id
 
             offset_tmp, mocap_data = self.__unpack_mocap_data( data[offset:], packet_size, major, minor )
             offset += offset_tmp
             #print("MoCap Frame: %d\n"%(mocap_data.prefix_data.frame_number))
-            # get a string version of the data for output
-            mocap_data_str=mocap_data.get_as_string()
             if print_level >= 1:
+                # get a string version of the data for output
+                mocap_data_str=mocap_data.get_as_string()
                 print("%s\n"%mocap_data_str)
 
         elif message_id == self.NAT_MODELDEF :
@@ -1670,7 +1821,7 @@ class NatNetClient:
                     tmpString = message.decode('utf-8')
                     # Decode bitstream version
                     if( tmpString.startswith('Bitstream') ):
-                        nn_version = self.__unpack_bitstream_info(data[offset:],packet_size, major, minor)
+                        nn_version = self.__unpack_bitstream_info(bytes(data[offset:]),packet_size, major, minor)
                         # This is the current server version
                         if(len(nn_version)>1):
                             for i in range( len(nn_version) ):
@@ -1795,6 +1946,34 @@ class NatNetClient:
 
 
 
+    def benchmark( self, packets, rigid_body_ids, repeat=1 ):
+        """decode recorded (receive_time, major, minor, data) frames with
+        the full decoder and with the rigid body fast path. Returns
+        (full_seconds, fast_seconds, match) where match is True if both
+        gave the same poses for rigid_body_ids"""
+        saved = ( self.rigid_body_listener, self.rigid_body_ids, list( self.__nat_net_requested_version ) )
+        results = []
+        times = []
+        for ids in [ None, rigid_body_ids ]:
+            poses = []
+            self.rigid_body_ids = ids
+            self.rigid_body_listener = lambda new_id, pos, rot: poses.append( ( new_id, pos, rot ) )
+            t0 = time.perf_counter()
+            for i in range( repeat ):
+                for ( receive_time, major, minor, data ) in packets:
+                    self.__nat_net_requested_version[0] = major
+                    self.__nat_net_requested_version[1] = minor
+                    try:
+                        self.__process_message( data )
+                    except ( struct.error, UnicodeDecodeError, IndexError, ValueError ):
+                        # as in the data thread, skip malformed packets
+                        pass
+            times.append( time.perf_counter() - t0 )
+            results.append( poses )
+        ( self.rigid_body_listener, self.rigid_body_ids, self.__nat_net_requested_version ) = saved
+        full = [ pose for pose in results[0] if pose[0] in rigid_body_ids ]
+        return times[0], times[1], full == results[1]
+
     def run( self ):
         # Create the data socket
         self.data_socket = self.__create_data_socket( self.data_port )
@@ -1841,3 +2020,55 @@ class NatNetClient:
         self.command_thread.join()
         self.data_thread.join()
 
+
+
+def make_test_frame( frame_number, num_rigid_bodies, num_markers ):
+    """return a NatNet 4.1 NAT_FRAMEOFDATA packet with a marker set and
+    labeled markers of num_markers each and num_rigid_bodies rigid
+    bodies, with IDs from 1"""
+    def section( count, body ):
+        return Int32Value.pack( count ) + Int32Value.pack( len( body ) ) + body
+    marker_set = b'all\0' + Int32Value.pack( num_markers )
+    marker_set += b''.join( [ Vector3.pack( i, i+0.5, -i ) for i in range( num_markers ) ] )
+    rigid_bodies = b''.join( [ Int32Value.pack( i+1 ) + Vector3.pack( i*0.1, 1.0, -0.5 ) +
+                               Quaternion.pack( 0, 0, 0.1*i, 1 ) + FloatValue.pack( 0.001 ) + ShortValue.pack( 1 )
+                               for i in range( num_rigid_bodies ) ] )
+    labeled_markers = b''.join( [ Int32Value.pack( i ) + Vector3.pack( i, i, i ) + FloatValue.pack( 0.01 ) +
+                                  ShortValue.pack( 0 ) + FloatValue.pack( 0.0 )
+                                  for i in range( num_markers ) ] )
+    payload = Int32Value.pack( frame_number )
+    payload += section( 1, marker_set )
+    payload += section( 0, b'' )
+    payload += section( num_rigid_bodies, rigid_bodies )
+    payload += section( 0, b'' )
+    payload += section( 0, b'' )
+    payload += section( num_markers, labeled_markers )
+    payload += section( 0, b'' )
+    payload += section( 0, b'' )
+    payload += Int32Value.pack( 0 ) + Int32Value.pack( 0 ) + DoubleValue.pack( frame_number / 240.0 )
+    payload += Int64Value.pack( 0 ) * 3 + Int32Value.pack( 0 ) * 2 + ShortValue.pack( 0 )
+    return struct.pack( '<hh', NatNetClient.NAT_FRAMEOFDATA, len( payload ) ) + payload
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("python -m MAVProxy.modules.mavproxy_optitrack.NatNetClient [options]")
+    parser.add_argument("--benchmark", default=None, help="recording of NatNet data packets to decode, from 'optitrack record'")
+    parser.add_argument("--bodies", type=int, default=20, help="rigid bodies in each generated frame")
+    parser.add_argument("--markers", type=int, default=100, help="markers in each generated frame")
+    parser.add_argument("--frames", type=int, default=2400, help="number of frames to generate")
+    parser.add_argument("--id", type=int, default=1, help="rigid body ID to decode on the fast path")
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        with open( args.benchmark, 'rb' ) as fh:
+            packets = [ p for p in read_recorded_packets( fh ) if get_message_id( p[3] ) == NatNetClient.NAT_FRAMEOFDATA ]
+    else:
+        packets = [ ( 0, 4, 1, make_test_frame( i, args.bodies, args.markers ) ) for i in range( args.frames ) ]
+    if len( packets ) == 0:
+        print( "No frames to decode" )
+        sys.exit(1)
+    client = NatNetClient()
+    ( t_full, t_fast, match ) = client.benchmark( packets, set( [ args.id ] ) )
+    print( "%u frames of %u bytes: full %.1fus/frame fast %.1fus/frame (%.1fx) match=%s" % (
+        len( packets ), len( packets[0][3] ), 1.0e6 * t_full / len( packets ), 1.0e6 * t_fast / len( packets ),
+        t_full / max( t_fast, 1.0e-9 ), match ) )
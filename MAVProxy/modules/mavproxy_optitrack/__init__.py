@@ -21,12 +21,19 @@ class optitrack(mp_module.MPModule):
             ('print_lv', int, 0),
             ('multicast', bool, True)]
         )
-        self.add_command('optitrack', self.cmd_optitrack, "optitrack control", ['<start>', '<stop>', 'set (OPTITRACKSETTING)'])
+        self.add_command('optitrack', self.cmd_optitrack, "optitrack control",
+                         ['<start>', '<stop>', '<status>', 'record (FILENAME)', 'set (OPTITRACKSETTING)'])
         self.streaming_client = NatNetClient.NatNetClient()
         # Configure the streaming client to call our rigid body handler on the emulator to send data out.
         self.streaming_client.rigid_body_listener = self.receive_rigid_body_frame
+        # only the rigid body we send needs to be decoded from each frame
+        self.streaming_client.rigid_body_ids = set([self.optitrack_settings.obj_id])
         self.last_msg_time = 0
         self.started = False
+        # time from receiving a frame to sending ATT_POS_MOCAP
+        self.latency_count = 0
+        self.latency_sum = 0
+        self.latency_max = 0
 
     # This is a callback function that gets connected to the NatNet client. It is called once per rigid body per frame
     def receive_rigid_body_frame(self, new_id, position, rotation):
@@ -36,10 +43,14 @@ class optitrack(mp_module.MPModule):
                 time_us = int(now * 1.0e6)
                 self.master.mav.att_pos_mocap_send(time_us, (rotation[3], rotation[0], rotation[2], -rotation[1]), position[0], position[2], -position[1])
                 self.last_msg_time = now
+                latency = time.time() - self.streaming_client.frame_receive_time
+                self.latency_count += 1
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
 
     def usage(self):
         '''show help on command line options'''
-        return "Usage: optitrack <start|stop|set>"
+        return "Usage: optitrack <start|stop|status|record|set>"
 
     def cmd_start(self):
         self.streaming_client.set_client_address(self.optitrack_settings.client)
@@ -49,6 +60,30 @@ class optitrack(mp_module.MPModule):
         self.streaming_client.run()
         self.started = True
 
+    def cmd_status(self):
+        '''show frame and latency statistics'''
+        print("frames %u sent %u" % (self.streaming_client.frame_count, self.latency_count))
+        if self.latency_count > 0:
+            print("latency mean %.2fms max %.2fms" % (1000 * self.latency_sum / self.latency_count,
+                                                      1000 * self.latency_max))
+
+    def cmd_record(self, args):
+        '''record the NatNet data packets to a file'''
+        if len(args) == 0 or args[0] == "stop":
+            if self.streaming_client.record_file is not None:
+                fh = self.streaming_client.record_file
+                self.streaming_client.record_file = None
+                fh.close()
+                print("Stopped recording")
+            return
+        try:
+            fh = open(args[0], 'wb')
+        except OSError as e:
+            print("Failed to open %s: %s" % (args[0], e))
+            return
+        self.streaming_client.record_file = fh
+        print("Recording to %s" % args[0])
+
     def cmd_optitrack(self, args):
         '''control behaviour of the module'''
         if len(args) == 0:
@@ -59,8 +94,13 @@ class optitrack(mp_module.MPModule):
             if self.started:
                 self.started = False
                 self.streaming_client.shutdown()
+        elif args[0] == "status":
+            self.cmd_status()
+        elif args[0] == "record":
+            self.cmd_record(args[1:])
         elif args[0] == "set":
             self.optitrack_settings.command(args[1:])
+            self.streaming_client.rigid_body_ids = set([self.optitrack_settings.obj_id])
         else:
             print(self.usage())
 
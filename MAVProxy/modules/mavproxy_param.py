@@ -358,7 +358,7 @@ class ParamState:
             mav.srcComponent = mavutil.mavlink.MAV_COMP_ID_MISSIONPLANNER
             try:
                 buf = p.pack(mav)
-                self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + buf))
+                self.mpstate.logqueue.put_timestamped(usec, buf)
                 # also give to param editor so it can update for changes
                 if editor:
                     editor.mavlink_packet(p)
@@ -562,7 +562,10 @@ class ParamState:
             return
 
         # Take the help tree and check if parameter is a bitmask
-        phelp = htree[uname]
+        phelp = htree.get(uname)
+        if phelp is None:
+            print(f"Parameter {uname} not found in documentation")
+            return
         bitmask_values = self.param_help.get_bitmask_from_help(phelp)
         if bitmask_values is None:
             print(f"Parameter {uname} is not a bitmask")
@@ -596,7 +599,7 @@ class ParamState:
         if bit_indices == []:
             # No bit index was specified, but the parameter and action was.
             # Print the available bitmask information.
-            print("%s: %s" % (uname, phelp.get('humanName')))
+            print("%s: %s" % (uname, phelp.human_name))
             s = "%-16.16s %s" % (uname, value)
             print(s)
 
@@ -932,6 +935,7 @@ class ParamState:
 class ParamModule(mp_module.MPModule):
     def __init__(self, mpstate, **kwargs):
         super(ParamModule, self).__init__(mpstate, "param", "parameter handling", public=True, multi_vehicle=True)
+        self.subscribe_mavlink(types=['PARAM_VALUE', 'HEARTBEAT'])
         self.xml_filepath = kwargs.get("xml-filepath", None)
         self.pstate = {}
         self.check_new_target_system()
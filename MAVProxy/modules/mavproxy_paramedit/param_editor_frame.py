@@ -13,6 +13,7 @@ import math
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.mavproxy_paramedit import checklisteditor as cle
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.mavproxy_paramedit import ph_event
 ParamEditorEvent = ph_event.ParamEditorEvent
 
@@ -337,35 +338,32 @@ class ParamEditorFrame(wx.Frame):
             self.display_list.SetCellBackgroundColour(row, PE_VALUE,
                                                       wx.Colour(152, 251, 152))
         self.set_row_size(row)
+        phelp = self.htree.get(name)
+        if phelp is None:
+            self.display_list.SetCellValue(row, PE_OPTION, option)
+            return
         try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Bitmask":
-                    bits = str(f).split(',')
-                    self.display_list.SetCellEditor(row, PE_OPTION, cle.GridCheckListEditor(bits, PE_VALUE, pvalue))
-                    val = ""
-                    binary = bin(int(pvalue))[2:]
-                    for b in bits:
-                        bopt = b.split(":")
-                        if len(bopt) != 2:
-                            continue
-                        bvalue = int(bopt[0])
-                        bstr = bopt[1].strip()
-                        if (int(pvalue) & (1 << bvalue)) != 0:
-                            val = val + "%u: %s\n" % (bvalue, bstr)
-                    val = val.strip()
-                    self.display_list.SetCellValue(row, PE_OPTION, str(val))
-                    self.set_row_size(row, 25*len(bits))
-                    return
+            if phelp.bitmask is not None:
+                bits = ["%u:%s" % (bvalue, bstr) for (bvalue, bstr) in sorted(phelp.bitmask.items())]
+                self.display_list.SetCellEditor(row, PE_OPTION, cle.GridCheckListEditor(bits, PE_VALUE, pvalue))
+                val = ""
+                for (bvalue, bstr) in sorted(phelp.bitmask.items()):
+                    if (int(pvalue) & (1 << bvalue)) != 0:
+                        val = val + "%u: %s\n" % (bvalue, bstr.strip())
+                val = val.strip()
+                self.display_list.SetCellValue(row, PE_OPTION, str(val))
+                self.set_row_size(row, 25*len(bits))
+                return
         except Exception as e:
             pass
         try:
-            if self.htree[name].values is not None:
-                v = self.htree[name].findall('values')[0].getchildren()
-                for i in range(len(v)):
-                    if float(v[i].get('code')) == pvalue:
-                        selected = str(v[i].get('code'))+":"+str(v[i])
-                        sel_ind = i
-                    v[i] = str(v[i].get('code'))+":"+str(v[i])
+            if len(phelp.values) > 0:
+                v = []
+                for (code, text) in phelp.values:
+                    if float(code) == pvalue:
+                        selected = code+":"+text
+                        sel_ind = len(v)
+                    v.append(code+":"+text)
                 self.display_list.SetCellEditor(row, PE_OPTION, cle.GridDropListEditor(v, PE_VALUE, sel_ind))
                 self.display_list.SetCellValue(row, PE_OPTION, str(selected))
                 return
@@ -373,12 +371,13 @@ class ParamEditorFrame(wx.Frame):
             pass
         Range = {}
         try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Increment":
-                    Range['Increment'] = float(f)
-                if f.get('name') == "Range":
-                    Range['Min'] = float(str(f).split(' ')[0])
-                    Range['Max'] = float(str(f).split(' ')[1])
+            increment = phelp.field("Increment")
+            if increment is not None:
+                Range['Increment'] = float(increment)
+            prange = phelp.field("Range")
+            if prange is not None:
+                Range['Min'] = float(prange.split(' ')[0])
+                Range['Max'] = float(prange.split(' ')[1])
         except Exception as e:
             pass
         if len(Range) > 1:
@@ -397,22 +396,14 @@ class ParamEditorFrame(wx.Frame):
         # Provide data derived from XML
         unit = ""
         option = ""
-        try:
-            desc = str(self.htree[name].get('humanName')) + "\n\n" + str(self.htree[name].get('documentation'))
-        except Exception as e:
-            desc = str(e)
-        try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Units":
-                    unit = str(f)
-        except Exception as e:
-            unit = ""
-        try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Range":
-                    option = "Range:"+str(f)
-        except Exception as e:
-            option = ""
+        phelp = self.htree.get(name)
+        if phelp is None:
+            return (unit, option, "'%s' not found in documentation" % name)
+        desc = phelp.human_name + "\n\n" + phelp.documentation
+        unit = phelp.field("Units", "")
+        prange = phelp.field("Range")
+        if prange is not None:
+            option = "Range:"+prange
         return(unit, option, desc)
 
     def Read_File(self, event):  # wxGlade: ParamEditor.<event_handler>
@@ -515,11 +506,9 @@ class ParamEditorFrame(wx.Frame):
             if isinstance(param,str) and key.lower() in param.lower():
                 temp[param] = value
             else:
-                try:
-                    if key.lower() in (self.htree[param].get('documentation').lower() + self.htree[param].get('humanName').lower()):
-                        temp[param] = value
-                except Exception as e:
-                    continue
+                phelp = self.htree.get(param)
+                if phelp is not None and key.lower() in (phelp.documentation.lower() + phelp.human_name.lower()):
+                    temp[param] = value
         for param, value in self.param_received.items():
             if param in temp:
                 temp[param] = value
@@ -570,17 +559,7 @@ class ParamEditorFrame(wx.Frame):
         else:
             return
         try:
-            xml = open(path, 'rb').read()
-            from lxml import objectify
-            objectify.enable_recursive_str()
-            tree = objectify.fromstring(xml)
-            for p in tree.vehicles.parameters.param:
-                n = p.get('name').split(':')[1]
-                self.htree[n] = p
-            for lib in tree.libraries.parameters:
-                for p in lib.param:
-                    n = p.get('name')
-                    self.htree[n] = p
+            self.htree = param_help.load_param_docs(path)
         except Exception as e:
             print (e)
 
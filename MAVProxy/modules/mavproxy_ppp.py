@@ -12,6 +12,7 @@ from MAVProxy.modules.lib import mp_module
 class PPPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(PPPModule, self).__init__(mpstate, "ppp", "PPP link")
+        self.subscribe_mavlink(types=['PPP'])
         self.command = "noauth nodefaultroute nodetach nodeflate nobsdcomp mtu 128".split()
         self.packet_count = 0
         self.byte_count = 0
@@ -49,8 +50,8 @@ class PPPModule(mp_module.MPModule):
         self.byte_count = 0
         self.packet_count = 0
 
-        # ask mavproxy to add us to the select loop
-        self.mpself.select_extra[self.ppp_fd] = (self.ppp_read, self.ppp_fd)
+        # ask mavproxy to add us to the main loop
+        self.mpstate.register_fd(self.ppp_fd, self.ppp_read, self.ppp_fd)
 
 
     def stop_ppp_link(self):
@@ -58,7 +59,7 @@ class PPPModule(mp_module.MPModule):
         if self.ppp_fd == -1:
             return
         try:
-            self.mpself.select_extra.pop(self.ppp_fd)
+            self.mpstate.unregister_fd(self.ppp_fd)
             os.close(self.ppp_fd)
             os.waitpid(self.pid, 0)
         except Exception:
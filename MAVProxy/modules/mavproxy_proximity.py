@@ -27,6 +27,7 @@ class proximity(mp_module.MPModule):
     def __init__(self, mpstate, multi_vehicle=True):
         """Initialise module"""
         super(proximity, self).__init__(mpstate, "proximity", "")
+        self.subscribe_mavlink(types=['GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED', 'DISTANCE_SENSOR', 'OBSTACLE_DISTANCE'])
 
         self.proximity_settings = mp_settings.MPSettings(
             [ ('verbose', bool, False),
@@ -11,28 +11,50 @@ import json
 import socket
 from threading import Thread
 
-from flask import Flask
+from flask import Flask, Response, request
 from werkzeug.serving import make_server
 from MAVProxy.modules.lib import mp_module
 
-def mavlink_to_json(msg):
-    '''Translate mavlink python messages in json string'''
-    ret = '\"%s\": {' % msg._type
+def mavlink_to_dict(msg):
+    '''Translate mavlink python messages in a dict of strings'''
+    ret = {}
     for fieldname in msg._fieldnames:
-        data = getattr(msg, fieldname)
-        ret += '\"%s\" : \"%s\", ' % (fieldname, data)
-    ret = ret[0:-2] + '}'
+        ret[fieldname] = '%s' % getattr(msg, fieldname)
     return ret
 
+def mavlink_to_json(msg):
+    '''Translate mavlink python messages in json string'''
+    return '%s: %s' % (json.dumps(msg._type), json.dumps(mavlink_to_dict(msg)))
+
 def mpstatus_to_json(status):
     '''Translate MPStatus in json string'''
-    msg_keys = list(status.msgs.keys())
-    data = '{'
-    for key in msg_keys[:-1]:
-        data += mavlink_to_json(status.msgs[key]) + ','
-    data += mavlink_to_json(status.msgs[msg_keys[-1]])
-    data += '}'
-    return data
+    msgs = status.msgs.copy()
+    return '{' + ','.join([mavlink_to_json(m) for m in msgs.values()]) + '}'
+
+class MessageSnapshots():
+    '''the latest message of each type in serialized form. A type is
+    only serialized again when a new message of that type arrives'''
+    def __init__(self):
+        # type -> (msg, dict, json)
+        self.cache = {}
+        self.serialized = 0
+
+    def get(self, key, msg):
+        '''return (dict, json) for a message'''
+        entry = self.cache.get(key, None)
+        if entry is None or entry[0] is not msg:
+            d = mavlink_to_dict(msg)
+            entry = (msg, d, json.dumps(d))
+            self.cache[key] = entry
+            self.serialized += 1
+        return entry[1:]
+
+    def full_json(self, msgs):
+        '''return the json for a whole status.msgs dict'''
+        ret = []
+        for (key, msg) in msgs.items():
+            ret.append('%s: %s' % (json.dumps(msg._type), self.get(key, msg)[1]))
+        return '{' + ','.join(ret) + '}'
 
 class RestServer():
     '''Rest Server'''
@@ -51,6 +73,8 @@ class RestServer():
         # Save status
         self.status = None
         self.server = None
+        self.snapshots = MessageSnapshots()
+        self.stream_clients = 0
 
     def update_dict(self, mpstate):
         '''We don't have time to waste'''
@@ -95,31 +119,76 @@ class RestServer():
         if not self.status:
             return '{"result": "No message"}'
 
-        try:
-            status_dict = json.loads(mpstatus_to_json(self.status))
-        except Exception as e:
-            print(e)
-            return
+        msgs = self.status.msgs.copy()
 
         # If no key, send the entire json
         if not arg:
-            return json.dumps(status_dict)
+            return self.snapshots.full_json(msgs)
 
-        # Get item from path
-        new_dict = status_dict
+        # Get item from path, the first key is the message type
         args = arg.split('/')
-        for key in args:
-            if key in new_dict:
+        msg = msgs.get(args[0], None)
+        if msg is None:
+            return '{"key": "%s", "last_dict": %s}' % (args[0], self.snapshots.full_json(msgs))
+        (new_dict, data) = self.snapshots.get(args[0], msg)
+        if len(args) == 1:
+            return data
+        for key in args[1:]:
+            if isinstance(new_dict, dict) and key in new_dict:
                 new_dict = new_dict[key]
             else:
                 return '{"key": "%s", "last_dict": %s}' % (key, json.dumps(new_dict))
 
         return json.dumps(new_dict)
 
+    def stream(self, arg=None):
+        '''stream changed messages as server-sent events. The message
+        types can be limited with a path of comma separated types, and
+        the update rate set with ?rate=HZ'''
+        types = None
+        if arg:
+            types = set(arg.strip('/').split(','))
+        try:
+            rate = min(max(float(request.args.get('rate', 10)), 0.1), 50)
+        except ValueError:
+            rate = 10
+        return Response(self.stream_events(types, 1.0/rate), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    def stream_events(self, types, period):
+        '''generate events for messages which change'''
+        sent = {}
+        last_send = time.time()
+        self.stream_clients += 1
+        try:
+            while self.running():
+                if self.status is not None:
+                    msgs = self.status.msgs.copy()
+                    events = []
+                    for (key, msg) in msgs.items():
+                        if sent.get(key, None) is msg:
+                            continue
+                        if types is not None and key not in types:
+                            continue
+                        sent[key] = msg
+                        events.append('event: %s\ndata: %s\n\n' % (key, self.snapshots.get(key, msg)[1]))
+                    if events:
+                        last_send = time.time()
+                        yield ''.join(events)
+                if time.time() - last_send > 15:
+                    # lets the server notice clients which have gone away
+                    last_send = time.time()
+                    yield ': keepalive\n\n'
+                time.sleep(period)
+        finally:
+            self.stream_clients -= 1
+
     def add_endpoint(self):
         '''Set endpoits'''
         self.app.add_url_rule('/rest/mavlink/<path:arg>', 'rest', self.request)
         self.app.add_url_rule('/rest/mavlink/', 'rest', self.request)
+        self.app.add_url_rule('/rest/stream/<path:arg>', 'stream', self.stream)
+        self.app.add_url_rule('/rest/stream/', 'stream', self.stream)
 
 class ServerModule(mp_module.MPModule):
     ''' Server Module '''
@@ -129,11 +198,11 @@ class ServerModule(mp_module.MPModule):
         self.rest_server = RestServer()
 
         self.add_command('restserver', self.cmds, \
-            "restserver module", ['start', 'stop', 'address 127.0.0.1:4777'])
+            "restserver module", ['start', 'stop', 'status', 'address 127.0.0.1:4777'])
 
     def usage(self):
         '''show help on command line options'''
-        return "Usage: restserver <address|freq|stop|start>"
+        return "Usage: restserver <address|freq|stop|start|status>"
 
     def cmds(self, args):
         '''control behaviour of the module'''
@@ -155,6 +224,13 @@ class ServerModule(mp_module.MPModule):
                 return
             self.rest_server.stop()
 
+        elif args[0] == "status":
+            print("Rest server %s: types:%u serialized:%u stream clients:%u" % (
+                "running" if self.rest_server.running() else "stopped",
+                len(self.rest_server.snapshots.cache),
+                self.rest_server.snapshots.serialized,
+                self.rest_server.stream_clients))
+
         elif args[0] == "address":
             # Check if have necessary amount of arguments
             if len(args) != 2:
@@ -133,12 +133,15 @@ class SigningModule(mp_module.MPModule):
         self.saved_key = key
         for m in self.mpstate.mav_master:
             self.setup_signing_link(m)
+        # signed links can't be decoded by link workers
+        self.mpstate.links_changed()
         print("Setup signing key")
 
     def cmd_signing_disable(self, args):
         '''disable signing locally'''
         self.saved_key = None
         self.master.disable_signing()
+        self.mpstate.links_changed()
         print("Disabled signing")
 
     def cmd_signing_remove(self, args):
@@ -149,6 +152,7 @@ class SigningModule(mp_module.MPModule):
             return
         self.master.mav.setup_signing_send(self.target_system, self.target_component, [0]*32, 0)
         self.master.disable_signing()
+        self.mpstate.links_changed()
         print("Removed signing")
 
     def idle_task(self):
@@ -2,9 +2,12 @@
   MAVProxy terrain handling module
 """
 
+import os
 import time
 
 from MAVProxy.modules.lib import mp_elevation
+from MAVProxy.modules.lib import mp_terraingrid
+from MAVProxy.modules.lib import srtm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
@@ -15,6 +18,8 @@ class TerrainModule(mp_module.MPModule):
 
         self.current_request = None
         self.sent_mask = 0
+        self.current_grid = None
+        self.last_grid_time = 0
         self.last_send_time = time.time()
         self.requests_received = 0
         self.blocks_sent = 0
@@ -26,10 +31,28 @@ class TerrainModule(mp_module.MPModule):
         self.terrain_settings = mp_settings.MPSettings([('debug', int, 0),
                                                         ('enable', int, 1),
                                                         ('offline', int, 0),
+                                                        ('tile_cache_mb', int, 256),
+                                                        ('link_share', float, 0.5),
+                                                        ('max_rate', float, 50.0),
                                                         mp_settings.MPSetting('source', str, "SRTM3", choice=mp_elevation.TERRAIN_SERVICES.keys())])
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
+        srtm.set_cache_size(self.terrain_settings.tile_cache_mb)
+        self.pacer = mp_terraingrid.TerrainPacer()
+        self.init_model()
+        self.subscribe_mavlink(types=['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'RADIO_STATUS'])
+
+    def init_model(self):
+        '''(re)create the elevation model and grid cache'''
         self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+        cachedir = None
+        downloader = getattr(self.ElevationModel, 'downloader', None)
+        if downloader is not None:
+            cachedir = os.path.join(downloader.cachedir, 'grids')
+        self.grid_cache = mp_terraingrid.TerrainGridCache(self.ElevationModel, cachedir=cachedir)
+        self.current_grid = None
+        self.pacer.link_share = self.terrain_settings.link_share
+        self.pacer.max_rate = self.terrain_settings.max_rate
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
@@ -41,10 +64,14 @@ class TerrainModule(mp_module.MPModule):
             print("blocks_sent: %u requests_received: %u" % (
                 self.blocks_sent,
                 self.requests_received))
+            print("tile cache: %s" % srtm.tile_cache.status())
+            print("grid cache: %s" % self.grid_cache.status())
+            print("pacing: %s" % self.pacer.status())
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
+            srtm.set_cache_size(self.terrain_settings.tile_cache_mb)
             # Re-init terrain model
-            self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+            self.init_model()
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
         else:
@@ -71,6 +98,7 @@ class TerrainModule(mp_module.MPModule):
         if mtype == 'TERRAIN_REQUEST' and self.terrain_settings.enable:
             self.current_request = msg
             self.sent_mask = 0
+            self.current_grid = None
             self.requests_received += 1
         elif mtype == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
@@ -79,33 +107,24 @@ class TerrainModule(mp_module.MPModule):
                 print(msg)
                 self.check_lat = 0
                 self.check_lon = 0
+        elif mtype == 'RADIO_STATUS':
+            self.pacer.radio_status(msg.txbuf)
 
     def send_terrain_data_bit(self, bit):
-        '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
-        self.master.mav.terrain_data_send(self.current_request.lat,
-                                          self.current_request.lon,
-                                          self.current_request.grid_spacing,
-                                          bit,
-                                          data)
+        '''send one block of terrain data from the current grid'''
+        (data, valid) = self.current_grid
+        if not valid[bit]:
+            if self.terrain_settings.debug:
+                print("no alt for block %u" % bit)
+            return False
+        mav = self.master.mav
+        nbytes = mav.total_bytes_sent
+        mav.terrain_data_send(self.current_request.lat,
+                              self.current_request.lon,
+                              self.current_request.grid_spacing,
+                              bit,
+                              data[bit].tolist())
+        self.pacer.sent(mav.total_bytes_sent - nbytes)
         self.blocks_sent += 1
         self.last_send_time = time.time()
         self.sent_mask |= 1<<bit
@@ -119,25 +138,41 @@ class TerrainModule(mp_module.MPModule):
                                              north=28*self.current_request.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
-
+        return True
 
     def send_terrain_data(self):
-        '''send some terrain data'''
+        '''send as much terrain data as the link allows'''
+        req = self.current_request
+        if self.current_grid is None or (not self.current_grid[1].all() and
+                                         time.time() - self.last_grid_time > 1.0):
+            # compute the whole grid at once, retrying while tiles are missing
+            self.current_grid = self.grid_cache.get(req.lat, req.lon, req.grid_spacing)
+            self.last_grid_time = time.time()
+        pending = False
         for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+            if req.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+                if not self.current_grid[1][bit]:
+                    pending = True
+                    continue
+                if not self.pacer.ready():
+                    return
                 self.send_terrain_data_bit(bit)
-                return
+        if pending:
+            return
         # no bits to send
         self.current_request = None
+        self.current_grid = None
         self.sent_mask = 0
 
     def idle_task(self):
         '''called when idle'''
-        if self.current_request is None:
+        if self.master is None:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        self.pacer.measure(self.master.mav.total_bytes_sent)
+        if self.current_request is None:
             return
+        self.pacer.set_link(self.master)
+        self.pacer.update()
         self.send_terrain_data()
 
 def init(mpstate):
@@ -21,6 +21,7 @@ from MAVProxy.modules.lib import mp_module
 class TimeSyncModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TimeSyncModule, self).__init__(mpstate, "timesync")
+        self.subscribe_mavlink(types=['TIMESYNC'])
         self.add_command('timesync', self.cmd_timesync, "timesync")
 
     def cmd_timesync(self, args):
@@ -74,6 +74,12 @@ class WPModule(mission_item_protocol.MissionItemProtocolModule):
     def command_name(self):
         return "wp"
 
+    def mavlink_types(self):
+        # HOME_POSITION is not handled here, but must be decoded for
+        # master.messages in router mode
+        return super(WPModule, self).mavlink_types() + ['MISSION_CURRENT', 'MISSION_ITEM_REACHED',
+                                                        'COMMAND_ACK', 'HOME_POSITION']
+
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
         mtype = m.get_type()
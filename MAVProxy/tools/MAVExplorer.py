@@ -24,6 +24,7 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib.graph_ui import Graph_UI
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -274,12 +275,7 @@ def expression_ok(expression, msgs=None):
                     f = f[:a2]
             if f.endswith(':2'):
                 f = f[:-2]
-            if f[-1] == '}':
-                # avoid passing nocondition unless needed to allow us to work witih older
-                # pymavlink versions
-                res = mavutil.evaluate_expression(f, msgs, nocondition=True)
-            else:
-                res = mavutil.evaluate_expression(f, msgs)
+            res = mp_expression.evaluate_expression(f, msgs, nocondition=True)
             if res is None:
                 expression_ok = False
         except Exception:
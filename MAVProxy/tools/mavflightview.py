@@ -8,6 +8,7 @@ AP_FLAKE8_CLEAN
 
 import cv2
 import functools
+import numpy as np
 import random
 import re
 import sys
@@ -18,6 +19,9 @@ from pymavlink import mavwp
 from pymavlink import mavextra
 
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
+from MAVProxy.modules.lib import mp_expression
+from MAVProxy.modules.lib import mp_flightpath
+from MAVProxy.modules.lib import mp_logindex
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.lib import grapher
@@ -208,14 +212,16 @@ colour_source_max = 0
 colour_over_255 = 0
 
 
-def colour_for_point(mlog, point, instance, options):
+def colour_key_for_point(mlog, options):
+    '''return a key for the colour of the current point, or None if the
+    point should not be plotted. Points with the same key in one path
+    have the same colour'''
     global colour_source_max, colour_source_min, colour_over_255
-    '''indicate a colour to be used to plot point'''
     source = getattr(options, "colour_source", "flightmode")
     if source == "flightmode":
-        return colour_for_point_flightmode(mlog, point, instance, options)
+        return ("flightmode", getattr(mlog, 'mav_type', None), getattr(mlog, 'flightmode', ''))
     elif source == "type":
-        return colour_for_point_type(mlog, point, instance, options)
+        return "type"
 
     # evaluate source as an expression which should return a
     # number in the range 0..255
@@ -254,9 +260,25 @@ def colour_for_point(mlog, point, instance, options):
         colour_source_min = v
     if v > colour_source_max:
         colour_source_max = v
+    return v
+
 
-    b = v
-    return (b, b, b)
+def colour_for_key(key, instance, options):
+    '''return the colour for a key from colour_key_for_point'''
+    source = getattr(options, "colour_source", "flightmode")
+    if source == "flightmode":
+        return colour_for_flightmode(key[1], key[2], instance)
+    elif source == "type":
+        return map_colours[instance]
+    return (key, key, key)
+
+
+def colour_for_point(mlog, point, instance, options):
+    '''indicate a colour to be used to plot point'''
+    key = colour_key_for_point(mlog, options)
+    if key is None:
+        return None
+    return colour_for_key(key, instance, options)
 
 
 def colour_for_point_flightmode(mlog, point, instance, options):
@@ -349,20 +371,105 @@ def pos_expressions(type_list):
     return ret
 
 
-def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
-    '''create a map for a log file'''
+def mission_item_fields(m):
+    '''return the fields of a MISSION_ITEM as a list, for caching'''
+    return [m.seq, m.frame, m.command, m.current, m.autocontinue,
+            m.param1, m.param2, m.param3, m.param4, m.x, m.y, m.z]
+
+
+def add_mission_item(wp, m, seq=None):
+    '''add a MISSION_ITEM to a waypoint loader, filling any gap before it.
+    wp.set() changes m.seq, so the item goes at seq if given and at the
+    updated m.seq otherwise'''
+    while m.seq > wp.count():
+        print("Adding dummy WP %u" % wp.count())
+        wp.set(m, wp.count())
+    if seq is None:
+        seq = m.seq
+    wp.set(m, seq)
+
+
+def path_cache_key(options, flightmode_selections):
+    '''return the cache key for the paths of a log with a set of options'''
+    params = {}
+    for name in ['types', 'rawgps', 'rawgps2', 'dualgps', 'ekf', 'nkf', 'ahr2',
+                 'condition', 'mode', 'rate', 'colour_source', 'decimate', 'mission']:
+        params[name] = getattr(options, name, None)
+    if any(flightmode_selections):
+        params['selections'] = list(flightmode_selections)
+        params['flightmodes'] = options._flightmodes
+    return mp_flightpath.cache_key(params)
+
+
+def path_points(path):
+    '''return the list of map points of an extracted path. Points are
+    (lat, lon, colour, tdays, importance) tuples'''
+    colours = [tuple(c) for c in path['colours'].tolist()]
+    return list(zip(path['lat'].tolist(),
+                    path['lon'].tolist(),
+                    [colours[i] for i in path['colour_idx'].tolist()],
+                    path['tdays'].tolist(),
+                    path['importance'].tolist()))
+
+
+def extract_path(builder, rate, decimate, start=0):
+    '''return a dict of arrays for the points of a PathBuilder from start
+    onwards, limited to rate points per second and decimated to within
+    decimate metres'''
+    (lat, lon, timestamp, colour_idx) = builder.arrays(start)
+    keep = mp_flightpath.rate_limit(timestamp, rate)
+    (lat, lon, timestamp, colour_idx) = (lat[keep], lon[keep], timestamp[keep], colour_idx[keep])
+    importance = mp_flightpath.path_importance(lat, lon, colour_idx, decimate)
+    keep = importance > 0
+    return {
+        'lat': lat[keep],
+        'lon': lon[keep],
+        'tdays': grapher.timestamps_to_days(timestamp[keep]),
+        'colour_idx': colour_idx[keep],
+        'importance': importance[keep],
+        'colours': np.array(builder.colours),
+    }
+
+
+def mavflightview_mav(mlog, options=None, flightmode_selections=[], progress=None):
+    '''create a map for a log file. If given, progress is called about
+    once a second while the log is read with the list of PathBuilder
+    objects, one per position expression'''
+    global colour_source_max, colour_source_min, colour_over_255
     wp = mavwp.MAVWPLoader()
     if options.mission is not None:
         wp.load(options.mission)
     fen = mavwp.MAVFenceLoader()
     if options.fence is not None:
         fen.load(options.fence)
+
+    logname = None
+    if getattr(options, 'cache', True):
+        logname = mp_logindex.log_filename(mlog)
+    cache_key = path_cache_key(options, flightmode_selections)
+    decimate = getattr(options, 'decimate', 0)
+    if logname is not None:
+        cached = mp_flightpath.load_cache(logname, cache_key)
+        if cached is not None:
+            (meta, paths) = cached
+            print("Using cached paths for %s" % logname)
+            for (seq, fields) in meta['mission']:
+                try:
+                    add_mission_item(wp, mavutil.mavlink.MAVLink_mission_item_message(0, 0, *fields), seq)
+                except Exception as e:
+                    print("Exception: %s" % str(e))
+            colour_source_min = min(colour_source_min, meta['colour_source_min'])
+            colour_source_max = max(colour_source_max, meta['colour_source_max'])
+            colour_over_255 += meta['colour_over_255']
+            used_flightmodes = dict([(mode, 1) for mode in meta['used_flightmodes']])
+            path = [path_points(p) for p in paths]
+            return [path, wp, fen, used_flightmodes, meta['mav_type'], meta['instances']]
+
     all_false = True
     for s in flightmode_selections:
         if s:
             all_false = False
     idx = 0
-    path = []
     expressions = []
 
     if options.types is not None:
@@ -399,8 +506,13 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
 
     print("Looking for types %s" % str(list(recv_match_types)))
 
-    last_timestamps = {}
     used_flightmodes = {}
+    mission = []
+    builders = [mp_flightpath.PathBuilder(functools.partial(colour_for_key, instance=i, options=options))
+                for i in range(len(expressions))]
+    count = 0
+    last_progress = time.time()
+    over_255_start = colour_over_255
 
     mlog.rewind()
 
@@ -412,6 +524,11 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
         except Exception:
             break
 
+        count += 1
+        if progress is not None and count % 1000 == 0 and time.time() - last_progress >= 1.0:
+            progress(builders)
+            last_progress = time.time()
+
         type = m.get_type()
 
         if type in ['MISSION_ITEM', 'MISSION_ITEM_INT']:
@@ -435,10 +552,9 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
                         m.y / 1.0e7,
                         m.z
                     )
-                while new_m.seq > wp.count():
-                    print("Adding dummy WP %u" % wp.count())
-                    wp.set(new_m, wp.count())
-                wp.set(new_m, m.seq)
+                seq = m.seq if new_m is not m else None
+                mission.append((seq, mission_item_fields(new_m)))
+                add_mission_item(wp, new_m, seq)
             except Exception as e:
                 print("Exception: %s" % str(e))
                 pass
@@ -462,10 +578,8 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
                     m.Alt
                 )
                 try:
-                    while m.seq > wp.count():
-                        print("Adding dummy WP %u" % wp.count())
-                        wp.set(m, wp.count())
-                    wp.set(m, m.seq)
+                    mission.append((None, mission_item_fields(m)))
+                    add_mission_item(wp, m)
                 except Exception:
                     pass
             continue
@@ -493,7 +607,7 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
                 else:
                     # we need to evaluate the expression to produce an object
                     try:
-                        v = mavutil.evaluate_expression(expression.expression, mlog.messages)
+                        v = mp_expression.evaluate_expression(expression.expression, mlog.messages)
                     except Exception:
                         continue
                 if v is None:
@@ -503,42 +617,117 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
                     continue
                 lat, lng = latlng
 
-                while len(path) <= instance:
-                    path.append([])
-
                 # only plot thing we have a valid-looking location for:
                 if abs(lat) <= 0.01 and abs(lng) <= 0.01:
                     continue
 
-                colour = colour_for_point(mlog, (lat, lng), instance, options)
-                if colour is None:
+                key = colour_key_for_point(mlog, options)
+                if key is None:
                     continue
 
-                tdays = grapher.timestamp_to_days(m._timestamp)
-                point = (lat, lng, colour, tdays)
-
-                if options.rate == 0 or expression.expression not in last_timestamps or m._timestamp - last_timestamps[expression.expression] > 1.0/options.rate:  # noqa:E501
-                    last_timestamps[expression.expression] = m._timestamp
-                    path[instance].append(point)
+                builders[instance].append(lat, lng, m._timestamp, key)
 
     # remove any empty paths and construct instances array
-    paths2 = []
+    paths = []
     instances = {}
     for instance in range(len(expressions)):
-        if instance >= len(path):
-            break
-        if len(path[instance]) == 0:
+        if len(builders[instance]) == 0:
             continue
-        paths2.append(path[instance])
+        paths.append(extract_path(builders[instance], options.rate, decimate))
         instances[expressions[instance].expression] = instance
 
-    path = paths2
-
-    if len(path) == 0:
+    if len(paths) == 0:
         print("No points to plot")
         return None
 
-    return [path, wp, fen, used_flightmodes, getattr(mlog, 'mav_type', None), instances]
+    mav_type = getattr(mlog, 'mav_type', None)
+    if logname is not None:
+        meta = {
+            'instances': instances,
+            'used_flightmodes': list(used_flightmodes.keys()),
+            'mav_type': mav_type,
+            'mission': mission,
+            'colour_source_min': colour_source_min,
+            'colour_source_max': colour_source_max,
+            'colour_over_255': colour_over_255 - over_255_start,
+        }
+        mp_flightpath.save_cache(logname, cache_key, meta, paths)
+
+    path = [path_points(p) for p in paths]
+    return [path, wp, fen, used_flightmodes, mav_type, instances]
+
+
+def map_area(boundary_path):
+    '''return (lat, lon, ground_width) of a map view showing a list of points'''
+    bounds = mp_util.polygon_bounds(boundary_path)
+    (lat, lon) = (bounds[0]+bounds[2], bounds[1])
+    (lat, lon) = mp_util.gps_newpos(lat, lon, -45, 50)
+    ground_width = mp_util.gps_distance(lat, lon, lat-bounds[2], lon+bounds[3])
+    while (mp_util.gps_distance(lat, lon, bounds[0], bounds[1]) >= ground_width-20 or
+           mp_util.gps_distance(lat, lon, lat, bounds[1]+bounds[3]) >= ground_width-20):
+        ground_width += 10
+    return (lat, lon, ground_width)
+
+
+def create_view_map(title, options, lat, lon, ground_width, timelim_pipe=None):
+    '''create the map window for a flight view'''
+    return mp_slipmap.MPSlipMap(title=title,
+                                service=options.service,
+                                elevation="SRTM3",
+                                width=600,
+                                height=600,
+                                ground_width=ground_width,
+                                lat=lat, lon=lon,
+                                debug=options.debug,
+                                show_flightmode_legend=options.show_flightmode_legend,
+                                timelim_pipe=timelim_pipe)
+
+
+def flight_path_object(key, points, options):
+    '''return the map object for a flight path'''
+    return mp_slipmap.SlipFlightPath(
+        key,
+        points,
+        layer='FlightPath',
+        linewidth=2,
+        showlines=(not getattr(options, "no_show_lines", False)),
+        colour=(255, 0, 180))
+
+
+class ProgressiveView(object):
+    '''show flight paths on a map while a log is still being read. The
+    map is opened with the first points, and each update adds the
+    points read since the last one'''
+    def __init__(self, title, options):
+        self.title = title
+        self.options = options
+        self.map = None
+        self.drawn = {}
+        self.parts = 0
+
+    def update(self, builders):
+        '''called from mavflightview_mav with the paths read so far'''
+        decimate = getattr(self.options, 'decimate', 0)
+        new_paths = []
+        for instance in range(len(builders)):
+            builder = builders[instance]
+            start = self.drawn.get(instance, 0)
+            if len(builder) - start < 2:
+                continue
+            # start from the last point drawn so the parts join up
+            path = extract_path(builder, self.options.rate, decimate, start=max(start-1, 0))
+            self.drawn[instance] = len(builder)
+            if len(path['lat']) > 1:
+                new_paths.append(path_points(path))
+        if len(new_paths) == 0:
+            return
+        if self.map is None:
+            (lat, lon, ground_width) = map_area([(p[0], p[1]) for p in new_paths[0]])
+            self.map = create_view_map(self.title, self.options, lat, lon, ground_width)
+        for points in new_paths:
+            self.map.add_object(flight_path_object('FlightPath-part%u-%s' % (self.parts, self.title),
+                                                   points, self.options))
+            self.parts += 1
 
 
 def mavflightview_show(path,
@@ -551,7 +740,10 @@ def mavflightview_show(path,
                        title=None,
                        timelim_pipe=None,
                        show_waypoints=True,
+                       map=None,
                        ):
+    '''show extracted paths on a map or in an image file. If map is
+    given the paths replace any already on that map'''
     if not title:
         title = 'MAVFlightView'
 
@@ -564,24 +756,12 @@ def mavflightview_show(path,
         for p in fence:
             boundary_path.append((p[0], p[1]))
 
-    bounds = mp_util.polygon_bounds(boundary_path)
-    (lat, lon) = (bounds[0]+bounds[2], bounds[1])
-    (lat, lon) = mp_util.gps_newpos(lat, lon, -45, 50)
-    ground_width = mp_util.gps_distance(lat, lon, lat-bounds[2], lon+bounds[3])
-    while (mp_util.gps_distance(lat, lon, bounds[0], bounds[1]) >= ground_width-20 or
-           mp_util.gps_distance(lat, lon, lat, bounds[1]+bounds[3]) >= ground_width-20):
-        ground_width += 10
+    (lat, lon, ground_width) = map_area(boundary_path)
 
     path_objs = []
     for i in range(len(path)):
         if len(path[i]) != 0:
-            path_objs.append(mp_slipmap.SlipPolygon(
-                'FlightPath[%u]-%s' % (i, title),
-                path[i],
-                layer='FlightPath',
-                linewidth=2,
-                showlines=(not getattr(options, "no_show_lines", False)),
-                colour=(255, 0, 180)))
+            path_objs.append(flight_path_object('FlightPath[%u]-%s' % (i, title), path[i], options))
     plist = []
     if options.show_waypoints:
         plist = wp.polygon_list()
@@ -615,19 +795,14 @@ def mavflightview_show(path,
         create_imagefile(options, options.imagefile, (lat, lon), ground_width, path_objs, mission_obj, fence_obj, kml_objects, used_flightmodes=used_flightmodes, mav_type=mav_type)  # noqa:E501
     else:
         global multi_map
-        if options.multi and multi_map is not None:
+        if map is not None:
+            map.add_object(mp_slipmap.SlipClearLayer('FlightPath'))
+            map.set_center(lat, lon)
+            map.set_zoom(ground_width)
+        elif options.multi and multi_map is not None:
             map = multi_map
         else:
-            map = mp_slipmap.MPSlipMap(title=title,
-                                       service=options.service,
-                                       elevation="SRTM3",
-                                       width=600,
-                                       height=600,
-                                       ground_width=ground_width,
-                                       lat=lat, lon=lon,
-                                       debug=options.debug,
-                                       show_flightmode_legend=options.show_flightmode_legend,
-                                       timelim_pipe=timelim_pipe)
+            map = create_view_map(title, options, lat, lon, ground_width, timelim_pipe=timelim_pipe)
         if options.multi:
             multi_map = map
         for path_obj in path_objs:
@@ -711,11 +886,17 @@ def load_kml(kml):
 def mavflightview(filename, options):
     print("Loading %s ..." % filename)
     mlog = mavutil.mavlink_connection(filename)
-    stuff = mavflightview_mav(mlog, options)
+    view = None
+    progress = None
+    if not options.imagefile and not options.multi:
+        view = ProgressiveView(filename, options)
+        progress = view.update
+    stuff = mavflightview_mav(mlog, options, progress=progress)
     if stuff is None:
         return
     [path, wp, fen, used_flightmodes, mav_type, instances] = stuff
-    mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, instances, title=filename)
+    mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, instances, title=filename,
+                       map=view.map if view is not None else None)
 
 
 class mavflightview_options(object):
@@ -742,6 +923,8 @@ class mavflightview_options(object):
         self._flightmodes = []
         self.colour_source = 'flightmode'
         self.show_waypoints = True
+        self.decimate = 0.1
+        self.cache = True
 
 
 if __name__ == "__main__":
@@ -772,6 +955,8 @@ if __name__ == "__main__":
     parser.add_option("--kml", default=None, help="add kml overlay")
     parser.add_option("--hide-waypoints", dest='show_waypoints', action='store_false', help="do not show waypoints", default=True)  # noqa:E501
     parser.add_option("--no-show-lines", action="store_true", default=False)
+    parser.add_option("--decimate", type='float', default=0.1, help="drop points within this many metres of the simplified path (0 keeps all points)")  # noqa:E501
+    parser.add_option("--no-cache", dest='cache', action='store_false', default=True, help="do not use or save cached paths")  # noqa:E501
 
     (opts, args) = parser.parse_args()
 